@@ -6,6 +6,16 @@ Usually, the config is located at /etc/hrm.conf and written in shell syntax as
 this file simply gets sourced by the bash init script and other shell based
 tools.
 
+The config is provided as the dict-like object CONFIG, which only parses the
+file on first access. The parsed values are stored as a (marshal) snapshot in
+a private cache directory and reused as long as the modification time and the
+size of the config file are unchanged. The following environment variables
+are evaluated when the config is loaded (see Config.reload()):
+
+    HRM_CONFIG_FILE  - the config file to use instead of /etc/hrm.conf
+    HRM_CONFIG_CACHE - the directory for the snapshots, empty to disable them
+    HRM_CONFIG_SET_<KEY> - override the value of <KEY> in the config file
+
 This module is not meant to be executed directly and doesn't do anything in
 this case.
 """
@@ -24,10 +34,22 @@ this case.
 # [1]: http://stackoverflow.com/questions/3503719/
 
 
-import shlex
+import marshal
+import os
+import stat
 import sys
 
 
+# the config file to use unless set in the environment:
+CONFIG_FILE = '/etc/hrm.conf'
+
+# environment variables for the config file, the snapshot directory and the
+# prefix for overriding single values:
+ENV_FILE = 'HRM_CONFIG_FILE'
+ENV_CACHE = 'HRM_CONFIG_CACHE'
+ENV_PREFIX = 'HRM_CONFIG_SET_'
+
+
 def parse_hrm_conf(filename):
     """Assemble a dict from the HRM config file (shell syntax).
 
@@ -54,8 +76,10 @@ def parse_hrm_conf(filename):
         'SUSER': 'hrm'
     }
     """
+    import shlex
     config = dict()
-    body = file(filename, 'r').read()
+    with open(filename, 'r') as infile:
+        body = infile.read()
     lexer = shlex.shlex(body)
     lexer.wordchars += '-./'
     while True:
@@ -91,9 +115,172 @@ def check_hrm_conf(config):
             raise SyntaxError('Missing "%s" in the HRM config file.' % entry)
 
 
+def private_dir(path):
+    """Make sure a directory exists and is accessible by its owner only.
+
+    Returns
+    =======
+    True if `path` is a directory owned by the current user and not accessible
+    by anyone else, False otherwise (the directory is not fixed in this case).
+    """
+    try:
+        os.mkdir(path, 0700)
+    except OSError:
+        pass
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return (stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and
+            not info.st_mode & 0077)
+
+
+class Config(object):
+
+    """Lazily loaded HRM config, behaving like a read-only dict."""
+
+    def __init__(self, filename=None, cache_dir=None):
+        """Set up the config, nothing is read at this point.
+
+        Parameters
+        ==========
+        filename : str - the config file, defaults to $HRM_CONFIG_FILE or
+                         CONFIG_FILE
+        cache_dir : str - the directory for snapshots of the parsed config,
+                          defaults to $HRM_CONFIG_CACHE or a directory named
+                          "hrm_config_<uid>" in $TMPDIR (or /tmp)
+        """
+        self._filename = filename
+        self._cache_dir = cache_dir
+        self._values = None
+
+    def _snapshot_name(self, filename):
+        """Assemble the snapshot filename for a config file, None if disabled.
+
+        As the config determines e.g. the paths to load Python code from, the
+        snapshots are only used from a directory private to the current user.
+        """
+        cache_dir = self._cache_dir
+        if cache_dir is None:
+            cache_dir = os.environ.get(ENV_CACHE, os.path.join(
+                os.environ.get('TMPDIR', '/tmp'),
+                'hrm_config_%s' % os.getuid()))
+        if not cache_dir or not private_dir(cache_dir):
+            return None
+        name = filename.strip('/').replace('/', '_') + '.snapshot'
+        return os.path.join(cache_dir, name)
+
+    def _load(self):
+        """Read the config from its snapshot or the file, apply overrides."""
+        filename = os.path.abspath(
+            self._filename or os.environ.get(ENV_FILE, CONFIG_FILE))
+        info = os.stat(filename)
+        source = (filename, info.st_mtime, info.st_size)
+        snapshot = self._snapshot_name(filename)
+        values = None
+        if snapshot is not None:
+            values = read_snapshot(snapshot, source)
+        if values is None:
+            values = parse_hrm_conf(filename)
+            if snapshot is not None:
+                write_snapshot(snapshot, source, values)
+        for (key, value) in os.environ.items():
+            if key.startswith(ENV_PREFIX):
+                values[key[len(ENV_PREFIX):]] = value
+        check_hrm_conf(values)
+        return values
+
+    def _config(self):
+        """Get the config dict, loading it on first access."""
+        if self._values is None:
+            self._values = self._load()
+        return self._values
+
+    def reload(self):
+        """Load the config again, e.g. in a long-running process.
+
+        The environment is evaluated again, but the config file is only parsed
+        in case it has been modified.
+
+        Returns
+        =======
+        True if the config values have changed, False otherwise.
+        """
+        previous = self._values
+        self._values = self._load()
+        return self._values != previous
+
+    def __getitem__(self, key):
+        return self._config()[key]
+
+    def __contains__(self, key):
+        return key in self._config()
+
+    def __iter__(self):
+        return iter(self._config())
+
+    def __len__(self):
+        return len(self._config())
+
+    def __repr__(self):
+        return 'Config(%r)' % self._config()
+
+    def get(self, key, default=None):
+        """Get the value of `key`, `default` if it's not in the config."""
+        return self._config().get(key, default)
+
+    def keys(self):
+        """Get the list of config keys."""
+        return self._config().keys()
+
+    def items(self):
+        """Get the list of (key, value) pairs of the config."""
+        return self._config().items()
+
+
+def read_snapshot(fname, source):
+    """Read the config values from a snapshot if it matches the source.
+
+    Parameters
+    ==========
+    fname : str - the snapshot filename
+    source : tuple - the name, modification time and size of the config file
+
+    Returns
+    =======
+    dict - the config values, None if there's no valid snapshot
+    """
+    try:
+        with open(fname, 'rb') as infile:
+            snap_source, values = marshal.load(infile)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if tuple(snap_source) != source or not isinstance(values, dict):
+        return None
+    return values
+
+
+def write_snapshot(fname, source, values):
+    """Store the config values (parsed from `source`) in a snapshot.
+
+    Failing to write the snapshot is not an error, the config will simply be
+    parsed again next time.
+    """
+    tmpname = '%s.%s' % (fname, os.getpid())
+    try:
+        with open(tmpname, 'wb') as outfile:
+            marshal.dump((source, values), outfile)
+        os.rename(tmpname, fname)
+    except (IOError, OSError):
+        try:
+            os.unlink(tmpname)
+        except OSError:
+            pass
+
+
+CONFIG = Config()
+
+
 if __name__ == "__main__":
     print __doc__
     sys.exit(1)
-
-CONFIG = parse_hrm_conf('/etc/hrm.conf')
-check_hrm_conf(CONFIG)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+"""Shared on-disk cache for the OMERO tree nodes of the HRM-OMERO connector.
+
+The JSON of the child nodes requested by the HRM (see gen_children() in
+ome_hrm) is stored in a small SQLite database, keyed by the OMERO user and the
+node ID string (e.g. "G:23:Dataset:42"). SQLite takes care of the locking, so
+the cache can be used by any number of connector processes at the same time.
+
+Entries expire after a configurable time-to-live and the total size of the
+cache is bounded, evicting the least recently used entries first. After
+changing the content of a container (e.g. uploading an image to a dataset)
+only the corresponding node needs to be invalidated, for all users.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import os
+import re
+import sqlite3
+import sys
+import time
+
+
+# default time-to-live in seconds for cached nodes:
+NODE_TTL = 600
+# default maximum total size in bytes of the cached JSON data:
+MAX_SIZE = 64 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS nodes (
+    user TEXT NOT NULL,
+    node TEXT NOT NULL,
+    gid TEXT NOT NULL,
+    obj_class TEXT NOT NULL,
+    obj_id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (user, node)
+);
+CREATE INDEX IF NOT EXISTS nodes_obj ON nodes (obj_class, obj_id);
+CREATE INDEX IF NOT EXISTS nodes_accessed ON nodes (accessed);
+"""
+
+
+def split_node_id(id_str):
+    """Split a node ID string into group ID, object class and object ID.
+
+    Parameters
+    ==========
+    id_str : str - a node ID string like "G:23:Dataset:42" or "ROOT", page
+                   specifications and version tokens (e.g.
+                   "G:23:Dataset:42@500+500#<ETag>") are ignored
+
+    Returns
+    =======
+    (gid, obj_class, obj_id) - strings, empty for the parts not available
+    """
+    parts = re.split('[@+#]', id_str)[0].split(':')
+    if len(parts) == 4:
+        return (parts[1], parts[2], parts[3])
+    elif len(parts) == 2:
+        return ('', parts[0], parts[1])
+    return ('', id_str, '')
+
+
+class TreeCache(object):
+
+    """LRU cache with a time-to-live for the JSON of tree nodes."""
+
+    def __init__(self, cache_dir, ttl=NODE_TTL, max_size=MAX_SIZE):
+        """Open (and create if necessary) the cache database.
+
+        Parameters
+        ==========
+        cache_dir : str - the directory for the cache database
+        ttl : int - seconds after which cached nodes expire
+        max_size : int - the maximum total size of the cached data in bytes
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.dbfile = os.path.join(cache_dir, 'tree_cache.db')
+        self._db = sqlite3.connect(self.dbfile, timeout=30)
+        os.chmod(self.dbfile, 0600)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def get(self, user, id_str):
+        """Get the cached JSON of a node, None if missing or expired."""
+        now = time.time()
+        with self._db:
+            row = self._db.execute(
+                'SELECT data, created FROM nodes WHERE user=? AND node=?',
+                (user, id_str)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._db.execute(
+                    'DELETE FROM nodes WHERE user=? AND node=?',
+                    (user, id_str))
+                return None
+            self._db.execute(
+                'UPDATE nodes SET accessed=? WHERE user=? AND node=?',
+                (now, user, id_str))
+        return row[0]
+
+    def put(self, user, id_str, data):
+        """Store the JSON of a node, evicting old entries if required."""
+        now = time.time()
+        gid, obj_class, obj_id = split_node_id(id_str)
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO nodes VALUES (?,?,?,?,?,?,?,?,?)',
+                (user, id_str, gid, obj_class, obj_id, data, len(data),
+                 now, now))
+            self._evict(now)
+
+    def _evict(self, now):
+        """Remove expired entries and shrink the cache below its limit."""
+        self._db.execute('DELETE FROM nodes WHERE created < ?',
+                         (now - self.ttl,))
+        total = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM nodes').fetchone()[0]
+        if total <= self.max_size:
+            return
+        rows = self._db.execute(
+            'SELECT user, node, size FROM nodes ORDER BY accessed').fetchall()
+        for (user, node, size) in rows:
+            if total <= self.max_size:
+                break
+            self._db.execute('DELETE FROM nodes WHERE user=? AND node=?',
+                             (user, node))
+            total -= size
+
+    def invalidate(self, id_str):
+        """Drop the cached children of an object for all users and groups.
+
+        Parameters
+        ==========
+        id_str : str - the node ID string of the object whose children have
+                       changed, e.g. "G:7:Dataset:23"
+        """
+        _, obj_class, obj_id = split_node_id(id_str)
+        with self._db:
+            self._db.execute(
+                'DELETE FROM nodes WHERE obj_class=? AND obj_id=?',
+                (obj_class, obj_id))
+
+    def close(self):
+        """Close the database connection."""
+        self._db.close()
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
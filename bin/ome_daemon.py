@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+"""Persistent daemon mode for the HRM-OMERO connector.
+
+Running the connector as a long-lived process avoids paying the Python
+interpreter startup, the import of the OMERO bindings and a full login to the
+OMERO server for every single request sent by the HRM web interface. The
+daemon listens on a local Unix domain socket and speaks a minimal line-based
+JSON protocol:
+
+    request:  {"action": "retrieveChildren", "user": "...", "password": "...",
+               "id": "G:23:Project:42", ...}
+    response: {"retval": 0, "output": "..."}
+
+Each request and each response is exactly one line. The request contains the
+parsed commandline arguments of the client invocation, the response contains
+the text the action printed and the (POSIX) exit status to use.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+
+# seconds a cached connection may stay unused before it gets closed:
+CONN_MAX_IDLE = 600
+# interval in seconds for pinging the server to keep sessions alive:
+KEEPALIVE_INTERVAL = 60
+
+
+class ThreadLocalStdout(object):
+
+    """File-like object redirecting writes to a per-thread buffer.
+
+    The connector actions report their results by printing to stdout. As the
+    daemon serves requests from multiple threads, the output of each request is
+    collected separately by installing an instance of this class as
+    sys.stdout. Threads not capturing anything write to the real stream.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def _stack(self):
+        """Get the stack of capture buffers of the current thread."""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def start_capture(self):
+        """Start collecting the output of the current thread.
+
+        Captures can be nested, output always goes to the innermost one.
+        """
+        self._stack().append([])
+
+    def stop_capture(self):
+        """Stop the innermost capture and return its output."""
+        stack = self._stack()
+        if not stack:
+            return ''
+        return ''.join(stack.pop())
+
+    def write(self, data):
+        """Write to the capture buffer if active, the real stream otherwise."""
+        stack = self._stack()
+        if not stack:
+            self._stream.write(data)
+        else:
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            stack[-1].append(data)
+
+    def flush(self):
+        """Flush the underlying stream."""
+        self._stream.flush()
+
+
+class ConnectionPool(object):
+
+    """Cache of logged-in OMERO connections, one per set of credentials.
+
+    Connections are looked up by the user name and a keyed digest of the
+    password (the plain password is never kept as a dict key), so a request
+    with wrong credentials will never be served by an existing session. Each
+    entry carries its own lock as a BlitzGateway object must not be used by
+    multiple threads at the same time (e.g. switching the group context).
+    """
+
+    def __init__(self, login, max_idle=CONN_MAX_IDLE):
+        """Set up the pool.
+
+        Parameters
+        ==========
+        login : callable - function(user, passwd) returning a connection
+        max_idle : int - seconds after which an unused connection is closed
+        """
+        self._login = login
+        self._max_idle = max_idle
+        self._secret = os.urandom(32)
+        self._lock = threading.Lock()
+        self._entries = dict()
+
+    def _key(self, user, passwd):
+        """Assemble the dict key for a set of credentials."""
+        if isinstance(passwd, unicode):
+            passwd = passwd.encode('utf-8')
+        digest = hmac.new(self._secret, passwd, hashlib.sha256).hexdigest()
+        return (user, digest)
+
+    def acquire(self, user, passwd):
+        """Get a (locked) connection for the given credentials.
+
+        Returns
+        =======
+        (key, conn) - the key has to be handed to release() afterwards
+        """
+        key = self._key(user, passwd)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {'conn': None, 'lock': threading.Lock(), 'used': 0}
+                self._entries[key] = entry
+        entry['lock'].acquire()
+        try:
+            conn = entry['conn']
+            if conn is not None and not conn.keepAlive():
+                conn = None
+            if conn is None:
+                conn = self._login(user, passwd)
+                # only keep connections that were actually established:
+                if conn.isConnected():
+                    entry['conn'] = conn
+                else:
+                    entry['conn'] = None
+        except:
+            entry['lock'].release()
+            raise
+        entry['used'] = time.time()
+        return (key, conn)
+
+    def release(self, key):
+        """Hand back a connection previously obtained by acquire()."""
+        entry = self._entries[key]
+        entry['used'] = time.time()
+        entry['lock'].release()
+
+    def maintain(self):
+        """Ping busy-free connections and close the ones idle for too long."""
+        now = time.time()
+        with self._lock:
+            items = self._entries.items()
+        for key, entry in items:
+            if not entry['lock'].acquire(False):
+                continue  # currently in use, nothing to do
+            try:
+                conn = entry['conn']
+                if conn is None:
+                    continue
+                if now - entry['used'] > self._max_idle:
+                    try:
+                        conn.close()
+                    except Exception:  # pylint: disable=broad-except
+                        pass
+                    entry['conn'] = None
+                elif not conn.keepAlive():
+                    entry['conn'] = None
+            finally:
+                entry['lock'].release()
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry['conn'] is None and not entry['lock'].locked():
+                    del self._entries[key]
+
+
+def handle_request(rfile, wfile, dispatch):
+    """Read a single JSON request from a stream and write back the reply."""
+    line = rfile.readline()
+    try:
+        request = json.loads(line)
+        retval, output = dispatch(request)
+    except Exception as err:  # pylint: disable=broad-except
+        retval, output = 1, 'ERROR processing connector request: %s\n' % err
+    if isinstance(output, str):
+        # the output may contain e.g. filenames that aren't valid UTF-8:
+        output = output.decode('utf-8', 'replace')
+    reply = json.dumps({'retval': int(retval), 'output': output})
+    wfile.write(reply + '\n')
+
+
+def make_server(socket_path, dispatch):
+    """Create a threaded Unix socket server passing requests to `dispatch`.
+
+    SocketServer is only imported here, clients merely forwarding their
+    requests to the daemon (see forward()) don't need it.
+    """
+    import SocketServer
+
+    class RequestHandler(SocketServer.StreamRequestHandler):
+
+        """Handle a single JSON request on the connector socket."""
+
+        def handle(self):
+            handle_request(self.rfile, self.wfile, self.server.dispatch)
+
+    class ConnectorServer(SocketServer.ThreadingMixIn,
+                          SocketServer.UnixStreamServer):
+
+        """Threaded Unix socket server passing requests on to a dispatcher."""
+
+        daemon_threads = True
+
+    server = ConnectorServer(socket_path, RequestHandler)
+    server.dispatch = dispatch
+    return server
+
+
+def remove_stale_socket(socket_path):
+    """Remove a socket file unless another daemon is listening on it.
+
+    Returns
+    =======
+    False in case a daemon is already serving the socket, True otherwise.
+    """
+    if not os.path.exists(socket_path):
+        return True
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        os.unlink(socket_path)
+        return True
+    finally:
+        sock.close()
+    return False
+
+
+def serve(socket_path, dispatch, mode=0660):
+    """Run the connector daemon on a Unix socket until interrupted.
+
+    Parameters
+    ==========
+    socket_path : str - the filename of the socket to listen on
+    dispatch : callable - function(request) returning a (retval, output) tuple
+    mode : int - file permissions for the socket, it has to be accessible by
+                 the user running the web server
+
+    Returns
+    =======
+    True in case the daemon was shut down cleanly, False otherwise.
+    """
+    if not remove_stale_socket(socket_path):
+        print("ERROR: a connector daemon is already listening on '%s'!"
+              % socket_path)
+        return False
+    server = make_server(socket_path, dispatch)
+    os.chmod(socket_path, mode)
+    print("OMERO connector daemon listening on '%s'." % socket_path)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+    return True
+
+
+def run_periodically(func, interval):
+    """Call a function every `interval` seconds in a background thread."""
+    def loop():
+        """Run the function forever, never letting an exception escape."""
+        while True:
+            time.sleep(interval)
+            try:
+                func()
+            except Exception:  # pylint: disable=broad-except
+                pass
+    thread = threading.Thread(target=loop, name='connector-maintenance')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def forward(socket_path, request):
+    """Send a request to a running connector daemon.
+
+    Parameters
+    ==========
+    socket_path : str - the filename of the daemon socket
+    request : dict - the request to be processed (parsed cmdline arguments)
+
+    Returns
+    =======
+    (retval, output) - the exit status and the text output of the request, or
+                       None in case no daemon could be reached or it didn't
+                       send a complete reply (e.g. because it crashed)
+    """
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error:
+        sock.close()
+        return None
+    try:
+        sock.sendall(json.dumps(request) + '\n')
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    try:
+        reply = json.loads(''.join(chunks))
+        retval, output = reply['retval'], reply['output']
+    except (ValueError, KeyError, TypeError):
+        return None
+    if isinstance(output, unicode):
+        output = output.encode('utf-8')
+    return (retval, output)
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
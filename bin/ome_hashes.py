@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Cache for the checksums of local files of the HRM-OMERO connector.
+
+Comparing local files with the original files in OMERO requires their
+checksums, which means reading the complete files. As the files in the HRM's
+data directories rarely change, the checksums are stored in a small SQLite
+database in the connector's cache directory, keyed by the absolute path and
+the checksum algorithm. An entry is only used as long as the modification time
+and the size of the file are unchanged.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import os
+import sqlite3
+import sys
+import time
+
+import ome_transfer
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (path, algorithm)
+);
+"""
+
+
+def hash_file(fname, algorithm, chunk_size=ome_transfer.CHUNK_SIZE):
+    """Compute the checksum of a file.
+
+    Parameters
+    ==========
+    fname : str - the file to hash
+    algorithm : str - an OMERO checksum algorithm name (e.g. "SHA1-160")
+    chunk_size : int - number of bytes to read at a time
+
+    Returns
+    =======
+    str - the hex digest, None if the algorithm is not supported
+    """
+    hasher = ome_transfer.new_hasher(algorithm)
+    if hasher is None:
+        return None
+    ome_transfer.hash_partial(fname, hasher, chunk_size)
+    return hasher.hexdigest()
+
+
+class HashCache(object):
+
+    """Checksums of local files, validated by modification time and size.
+
+    An instance must not be shared between threads.
+    """
+
+    def __init__(self, cache_dir):
+        """Open (and create if necessary) the cache database.
+
+        Parameters
+        ==========
+        cache_dir : str - the directory for the cache database
+        """
+        self.dbfile = os.path.join(cache_dir, 'hash_cache.db')
+        self._db = sqlite3.connect(self.dbfile, timeout=30)
+        os.chmod(self.dbfile, 0600)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def get(self, fname, algorithm):
+        """Get the cached checksum of a file, None if unknown or outdated."""
+        path = os.path.abspath(fname)
+        try:
+            info = os.stat(path)
+        except OSError:
+            return None
+        with self._db:
+            row = self._db.execute(
+                'SELECT mtime, size, digest FROM hashes '
+                'WHERE path=? AND algorithm=?', (path, algorithm)).fetchone()
+            if row is None:
+                return None
+            if row[0] != info.st_mtime or row[1] != info.st_size:
+                self._db.execute(
+                    'DELETE FROM hashes WHERE path=? AND algorithm=?',
+                    (path, algorithm))
+                return None
+            self._db.execute(
+                'UPDATE hashes SET accessed=? WHERE path=? AND algorithm=?',
+                (time.time(), path, algorithm))
+        return row[2]
+
+    def put(self, fname, algorithm, digest):
+        """Store the checksum of a file in its current state."""
+        path = os.path.abspath(fname)
+        info = os.stat(path)
+        with self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO hashes VALUES (?,?,?,?,?,?)',
+                (path, algorithm, info.st_mtime, info.st_size, digest,
+                 time.time()))
+
+    def digest(self, fname, algorithm):
+        """Get the checksum of a file, computing and caching it if required.
+
+        Returns
+        =======
+        str - the hex digest, None if the algorithm is not supported
+        """
+        digest = self.get(fname, algorithm)
+        if digest is None:
+            digest = hash_file(fname, algorithm)
+            if digest is not None:
+                self.put(fname, algorithm, digest)
+        return digest
+
+    def close(self):
+        """Close the database connection."""
+        self._db.close()
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -16,60 +16,237 @@ to an OMERO server for listing available images, transferring data, etc.
 
 
 import sys
-import hrm_config
+import ome_startup
+
+# profiling has to start before anything else gets imported:
+if '--profile-startup' in sys.argv:
+    ome_startup.enable()
 
-# optionally put EXT_LIB into our PYTHONPATH:
-if 'PYTHON_EXTLIB' in hrm_config.CONFIG:
-    sys.path.insert(0, hrm_config.CONFIG['PYTHON_EXTLIB'])
+import hrm_config
+import ome_metrics
+import ome_sessions
 
 try:
     import argparse
+    import hashlib
     import os
     import json
     import re
+    import tempfile
+    import threading
+    import time
 except ImportError as err:
     print "ERROR importing required Python packages:", err
     print "Current PYTHONPATH: ", sys.path
     sys.exit(1)
 
-# try to put OMERO into our PYTHONPATH:
-if 'OMERO_PKG' in hrm_config.CONFIG:
-    OMERO_LIB = '%s/lib/python' % hrm_config.CONFIG['OMERO_PKG']
-    sys.path.insert(0, OMERO_LIB)
-else:
-    print "Could not find configuration value 'OMERO_PKG', omitting."
-try:
-    from omero.gateway import BlitzGateway
-except ImportError as err:
-    print "ERROR importing the OMERO Python bindings:", err
-    print "Current PYTHONPATH: ", sys.path
-    sys.exit(2)
+# number of thumbnails to request from OMERO at once:
+THUMB_SET_SIZE = 100
+
+# maximum number of groups looked up at the same time for the base tree:
+TREE_WORKERS = 8
+
+# suffix of images exported as OME-TIFF as they have no original files:
+OME_TIFF_SUFFIX = '.ome.tif'
 
-# the connection values
-HOST = hrm_config.CONFIG['OMERO_HOSTNAME']
-if 'OMERO_PORT' in hrm_config.CONFIG:
-    PORT = hrm_config.CONFIG['OMERO_PORT']
-else:
-    PORT = 4064
+# the actions that can be run by the transfer queue (see ome_queue):
+TRANSFER_ACTIONS = ['OMEROtoHRM', 'OMEROtoHRMBatch', 'syncDataset',
+                    'HRMtoOMERO', 'HRMtoOMEROBatch']
+
+
+def load_settings():
+    """Set the connector's settings from the HRM config file.
+
+    This is called by main() once the arguments are parsed (so e.g. "--help"
+    doesn't need the config) and again by the connector daemon whenever the
+    HRM config changes (see hrm_config.Config.reload()). Code importing this
+    module has to call it before using the module's functions.
+    """
+    # pylint: disable=global-statement
+    global HOST, PORT, SOCKET, CACHE_DIR, SESSION_TTL, NODE_TTL
+    global NODE_CACHE_SIZE, CHUNK_SIZE, RETRIES, METRICS_LOG, METRICS_PROM
+    global QUEUE_WORKERS, QUEUE_ATTEMPTS, QUEUE_BACKOFF, TREE_TIMEOUT
+    global SEARCH_TTL, TRANSFER_WORKERS, BANDWIDTH, LIMITER
+
+    # the connection values
+    HOST = hrm_config.CONFIG['OMERO_HOSTNAME']
+    if 'OMERO_PORT' in hrm_config.CONFIG:
+        PORT = hrm_config.CONFIG['OMERO_PORT']
+    else:
+        PORT = 4064
+
+    # the socket of a running connector daemon (optional):
+    SOCKET = hrm_config.CONFIG.get('OMERO_CONNECTOR_SOCKET', None)
+
+    # the directory for the connector's caches (session keys etc.):
+    CACHE_DIR = hrm_config.CONFIG.get(
+        'OMERO_CONNECTOR_CACHE',
+        os.path.join(tempfile.gettempdir(),
+                     'hrm_omero_connector_%s' % os.getuid()))
+
+    # lifetime of cached OMERO session keys in seconds, '0' disables reusing
+    # them:
+    SESSION_TTL = int(hrm_config.CONFIG.get('OMERO_SESSION_TTL',
+                                            ome_sessions.SESSION_TTL))
+
+    # lifetime in seconds ('0' disables caching) and maximum total size in
+    # bytes of the shared cache for tree nodes:
+    # NOTE: the defaults of the following settings are the ones of the
+    # modules using them (ome_cache.NODE_TTL etc.), which are only imported
+    # by the actions needing them to keep the startup fast
+    NODE_TTL = int(hrm_config.CONFIG.get('OMERO_TREE_CACHE_TTL', 600))
+    NODE_CACHE_SIZE = int(hrm_config.CONFIG.get('OMERO_TREE_CACHE_SIZE',
+                                                64 * 1024 * 1024))
+
+    # seconds to wait for the members of all groups when looking them up
+    # group by group, slower groups are returned to be loaded on demand:
+    TREE_TIMEOUT = float(hrm_config.CONFIG.get('OMERO_TREE_TIMEOUT', 10))
+
+    # age in seconds after which a user's search index is refreshed in the
+    # background:
+    SEARCH_TTL = int(hrm_config.CONFIG.get('OMERO_SEARCH_TTL', 300))
+
+    # chunk size in bytes and number of retries for downloading original
+    # files:
+    CHUNK_SIZE = int(hrm_config.CONFIG.get('OMERO_TRANSFER_CHUNK_SIZE',
+                                           4 * 1024 * 1024))
+    RETRIES = int(hrm_config.CONFIG.get('OMERO_TRANSFER_RETRIES', 3))
+
+    # number of files of a fileset downloaded concurrently and the limit for
+    # the total throughput of all downloads in bytes per second ('0' for no
+    # limit), shared by all threads (and all requests served by a daemon):
+    TRANSFER_WORKERS = int(hrm_config.CONFIG.get('OMERO_TRANSFER_WORKERS', 4))
+    BANDWIDTH = int(hrm_config.CONFIG.get('OMERO_TRANSFER_BANDWIDTH', 0))
+    LIMITER = None
+    if BANDWIDTH > 0:
+        import ome_transfer
+        LIMITER = ome_transfer.RateLimiter(BANDWIDTH)
+
+    # the connector log receiving the per-action metrics as JSON lines and a
+    # Prometheus textfile accumulating them (both optional):
+    METRICS_LOG = hrm_config.CONFIG.get('OMERO_CONNECTOR_LOG', None)
+    METRICS_PROM = hrm_config.CONFIG.get('OMERO_CONNECTOR_PROMETHEUS', None)
+
+    # number of concurrent transfers of a queue worker, attempts per job and
+    # the delay in seconds before the first retry of a failed job:
+    QUEUE_WORKERS = int(hrm_config.CONFIG.get('OMERO_QUEUE_WORKERS', 2))
+    QUEUE_ATTEMPTS = int(hrm_config.CONFIG.get('OMERO_QUEUE_ATTEMPTS', 3))
+    QUEUE_BACKOFF = int(hrm_config.CONFIG.get('OMERO_QUEUE_BACKOFF', 30))
+
+
+ome_startup.mark('connector module loaded')
+
+
+def add_omero_path():
+    """Put the OMERO Python bindings into our PYTHONPATH.
+
+    This is only done once they are actually needed, as every entry at the
+    beginning of sys.path slows down all subsequent imports. The same applies
+    to the optional PYTHON_EXTLIB directory.
+    """
+    extlib = hrm_config.CONFIG.get('PYTHON_EXTLIB', None)
+    if extlib and extlib not in sys.path:
+        sys.path.insert(0, extlib)
+    if 'OMERO_PKG' not in hrm_config.CONFIG:
+        print "Could not find configuration value 'OMERO_PKG', omitting."
+        return
+    omero_lib = '%s/lib/python' % hrm_config.CONFIG['OMERO_PKG']
+    if omero_lib not in sys.path:
+        sys.path.insert(0, omero_lib)
+
+
+def thread_pool(workers):
+    """Create a pool of `workers` threads (at least one).
+
+    The multiprocessing package is rather expensive to import, it is therefore
+    only loaded by the actions running things concurrently. The threads
+    account their metrics to the action of the calling thread.
+    """
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(max(1, workers), ome_metrics.adopt,
+                      (ome_metrics.current(),))
 
 
-def omero_login(user, passwd, host, port):
+def query_service(conn):
+    """Get the query service of a connection, recording query metrics."""
+    return ome_metrics.TimedService(conn.getQueryService())
+
+
+def import_blitz_gateway():
+    """Import the BlitzGateway class from the OMERO Python bindings.
+
+    The import is deferred until a connection is actually required, so a
+    client only forwarding its request to a connector daemon doesn't have to
+    load the OMERO bindings at all.
+    """
+    add_omero_path()
+    try:
+        from omero.gateway import BlitzGateway
+    except ImportError as err:
+        print "ERROR importing the OMERO Python bindings:", err
+        print "Current PYTHONPATH: ", sys.path
+        sys.exit(2)
+    return BlitzGateway
+
+
+def omero_login(user, passwd, host, port, cached=True):
     """Establish the connection to an OMERO server.
 
+    If a session created by a previous invocation for the same user and
+    password is still alive, it is joined using its session key instead of
+    creating a new one. Otherwise a regular login is done and the key of the
+    new session is stored in the session cache (see ome_sessions). As joining
+    a session only checks the password against the cached hash, a regular
+    login can be enforced to verify the credentials with the server.
+
     Parameters
     ==========
     user : str - OMERO user name (e.g. "demo_user_01")
     passwd : str - OMERO user password
     host : str - OMERO server hostname to connect to
     port : int - OMERO server port number (e.g. 4064)
+    cached : bool - whether a cached session may be joined
 
     Returns
     =======
     conn : omero.gateway._BlitzGateway - OMERO connection object
     """
+    BlitzGateway = import_blitz_gateway()
+    cache = None
+    if SESSION_TTL > 0:
+        try:
+            cache = ome_sessions.SessionCache(CACHE_DIR, host, port,
+                                              SESSION_TTL)
+        except OSError:
+            # the cache directory isn't private, so don't keep sessions:
+            cache = None
+    sess_key = None
+    if cache is not None:
+        sess_key = cache.get(user, passwd)
+        if sess_key is not None and cached:
+            conn = BlitzGateway(host=host, port=port, secure=True,
+                                useragent="HRM-OMERO.connector")
+            try:
+                joined = conn.connect(sUuid=sess_key)
+            except Exception:  # pylint: disable=broad-except
+                joined = False
+            if joined:
+                conn.c.detachOnDestroy()
+                return conn
+            # the session has expired on the server, do a regular login:
+            cache.drop(user)
+            sess_key = None
     conn = BlitzGateway(user, passwd, host=host, port=port, secure=True,
                         useragent="HRM-OMERO.connector")
-    conn.connect()
+    if conn.connect():
+        if cache is not None:
+            # keep the session open on the server when this process
+            # terminates:
+            conn.c.detachOnDestroy()
+            cache.put(user, passwd, conn.c.getSessionId())
+    elif sess_key is not None:
+        # the cached password isn't valid anymore (e.g. it was changed):
+        cache.drop(user)
     return conn
 
 
@@ -79,24 +256,182 @@ def tree_to_json(obj_tree):
                       indent=4, separators=(',', ': '))
 
 
-def print_children_json(conn, id_str):
+def write_json_nodes(nodes, stream):
+    """Write a sequence of nodes as a compact JSON array.
+
+    Each node is serialized and written as soon as it is available, so the
+    output starts while the nodes are still being generated (e.g. by
+    iter_children()). Nothing is written before the first node is available,
+    in case generating it fails.
+
+    Parameters
+    ==========
+    nodes : iterable - the node dicts
+    stream : file - the stream to write to
+
+    Returns
+    =======
+    str - the complete JSON written to the stream
+    """
+    chunks = []
+    sep = '['
+    for node in nodes:
+        chunk = sep + json.dumps(node, separators=(',', ':'))
+        stream.write(chunk)
+        chunks.append(chunk)
+        sep = ','
+    chunks.append(']\n' if chunks else '[]\n')
+    stream.write(chunks[-1])
+    return ''.join(chunks)
+
+
+def check_cache_dir():
+    """Make sure the cache directory is usable, printing an error otherwise.
+
+    Returns
+    =======
+    bool - False if the directory can't be created or isn't private (see
+           ome_sessions.ensure_dir())
+    """
+    try:
+        ome_sessions.ensure_dir(CACHE_DIR)
+    except OSError as err:
+        print("ERROR: can't use the cache directory: %s" % err)
+        return False
+    return True
+
+
+def tree_cache():
+    """Open the shared cache for tree nodes (see ome_cache).
+
+    Returns
+    =======
+    ome_cache.TreeCache - the cache object, None if caching is disabled or the
+                          cache database can't be used
+    """
+    if NODE_TTL <= 0:
+        return None
+    import ome_cache
+    import sqlite3
+    try:
+        ome_sessions.ensure_dir(CACHE_DIR)
+        return ome_cache.TreeCache(CACHE_DIR, NODE_TTL, NODE_CACHE_SIZE)
+    except (OSError, sqlite3.Error):
+        return None
+
+
+# the reply of retrieveChildren if the children match the given ETag:
+NOT_MODIFIED = 'NOT MODIFIED'
+
+
+def node_etag(conn, id_str, offset=0, limit=0):
+    """Compute a version token (ETag) for the children of a node.
+
+    The token is derived from the signature of the children (see
+    SIGNATURE_QUERIES), which takes a single small query, and the requested
+    page.
+
+    Returns
+    =======
+    str - the token, None for nodes without a signature (the root node and
+          groups)
+    """
+    base_id = id_str.split('@')[0]
+    parts = base_id.split(':')
+    if len(parts) != 4 or parts[2] not in SIGNATURE_QUERIES:
+        return None
+    _, gid, obj_type, oid = parts
+    signature = query_signatures(conn, gid, obj_type, [oid]).get(long(oid),
+                                                                 'empty')
+    return hashlib.sha1('%s|%s|%s|%s' % (id_str, offset, limit,
+                                         signature)).hexdigest()[:20]
+
+
+def print_children_json(conn, id_str, refresh=False, offset=0, limit=0,
+                        pretty=False, etag=False, if_none_match=None):
     """Print the child nodes of the given ID in JSON format.
 
+    The JSON is served from the shared tree cache if possible, otherwise the
+    nodes are requested from OMERO, printed one by one as compact JSON (see
+    write_json_nodes()) and stored in the cache.
+
+    If requested, the version token of the children (see node_etag()) is
+    printed as a line "ETag: <token>" before the nodes. In case it is equal
+    to `if_none_match`, only the line NOT_MODIFIED follows instead of the
+    nodes. Cached nodes are only used if they belong to the current token.
+
     Parameters
     ==========
     conn : omero.gateway._BlitzGateway
     id_str : str - OMERO object ID string (e.g. "G:23:Image:42")
+    refresh : bool - ignore the cached nodes (but update the cache)
+    offset : int - the number of children to skip (see gen_children())
+    limit : int - the maximum number of children to return, 0 for all
+    pretty : bool - print the nodes sorted and indented (for debugging), this
+                    bypasses the cache
+    etag : bool - print the version token of the children
+    if_none_match : str - a version token received earlier (implies `etag`)
 
     Returns
     =======
     bool - True in case printing the nodes was successful, False otherwise.
     """
+    token = None
+    if etag or if_none_match is not None:
+        try:
+            token = node_etag(conn, id_str, offset, limit)
+        except Exception:  # pylint: disable=broad-except
+            token = None
+        if token is not None:
+            print 'ETag: %s' % token
+            if token == if_none_match:
+                print NOT_MODIFIED
+                return True
+    if pretty:
+        try:
+            children = gen_children(conn, id_str, offset, limit)
+        except:
+            print "ERROR generating OMERO tree / node!"
+            return False
+        with ome_metrics.Timer('json'):
+            print tree_to_json(children)
+        return True
+    cache = tree_cache()
+    if cache is not None:
+        import sqlite3
+    user = conn.getEventContext().userName
+    # pages of the same node are cached separately:
+    cache_key = id_str
+    if offset > 0 and '@' not in id_str:
+        cache_key += '@%s' % offset
+    if limit > 0:
+        cache_key += '+%s' % limit
+    if token is not None:
+        cache_key += '#%s' % token
+    if cache is not None and not refresh:
+        try:
+            cached = cache.get(user, cache_key)
+        except sqlite3.Error:
+            cached = None
+        if cached is not None:
+            ome_metrics.add('response_bytes', len(cached))
+            print cached
+            return True
     try:
-        children = gen_children(conn, id_str)
+        # NOTE: as the rows are processed while writing, this includes the
+        # time to receive them from OMERO
+        with ome_metrics.Timer('json'):
+            json_str = write_json_nodes(
+                iter_children(conn, id_str, offset, limit), sys.stdout)
     except:
-        print "ERROR generating OMERO tree / node!"
+        print "\nERROR generating OMERO tree / node!"
         return False
-    print tree_to_json(children)
+    ome_metrics.add('response_bytes', len(json_str))
+    if cache is not None:
+        try:
+            cache.put(user, cache_key, json_str.rstrip('\n'))
+        except sqlite3.Error:
+            pass
     return True
 
 
@@ -131,235 +466,1525 @@ def gen_obj_dict(obj, id_pfx=''):
     return obj_dict
 
 
-def gen_children(conn, id_str):
+# projection queries for the child nodes of the different object types: the
+# class of the children and the HQL returning the parent ID and the ID, name
+# and owner of the children for a list of parents:
+CHILD_QUERIES = {
+    'Experimenter': (
+        'Project',
+        "select o.id, p.id, p.name, o.omeName from Project p "
+        "join p.details.owner o where o.id in (:ids) "
+        "order by p.name, p.id"),
+    'Project': (
+        'Dataset',
+        "select l.parent.id, d.id, d.name, o.omeName from ProjectDatasetLink l "
+        "join l.child d join d.details.owner o where l.parent.id in (:ids) "
+        "order by d.name, d.id"),
+    'Dataset': (
+        'Image',
+        "select l.parent.id, i.id, i.name, o.omeName from DatasetImageLink l "
+        "join l.child i join i.details.owner o where l.parent.id in (:ids) "
+        "order by i.name, i.id"),
+}
+
+
+def query_children(conn, gid, obj_type, parent_ids, offset=0, limit=0):
+    """Run the projection query for the children of some objects.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    gid : str - the ID of the group to query in
+    obj_type : str - the class of the parent objects (e.g. "Dataset")
+    parent_ids : list - the IDs of the parent objects
+    offset : int - the number of rows to skip
+    limit : int - the maximum number of rows to return, 0 for all
+
+    Returns
+    =======
+    generator - (parent_id, node) tuples, the nodes being dicts as returned
+                by gen_obj_dict() (without the 'load_on_demand' flag), the
+                query is sent to OMERO when the first item is requested
+    """
+    from omero.sys import ParametersI
+    child_type, query = CHILD_QUERIES[obj_type]
+    params = ParametersI()
+    params.addIds([long(pid) for pid in parent_ids])
+    if offset > 0 or limit > 0:
+        # a limit of None only skips the first rows:
+        params.page(offset, limit or None)
+    rows = query_service(conn).projection(
+        query, params, {'omero.group': str(gid)})
+    for row in rows:
+        (parent_id, child_id, name, owner) = [
+            col.val if col is not None else None for col in row]
+        yield (parent_id, {
+            'label': name,
+            'class': child_type,
+            'owner': owner,
+            'id': 'G:%s:%s:%s' % (gid, child_type, child_id),
+            'children': [],
+        })
+
+
+# projection queries for the signatures of the children of the different
+# object types, changing whenever a child is added, removed or modified: the
+# parent ID, the number of children, the highest child (or link) ID and the
+# last update event of any child
+SIGNATURE_QUERIES = {
+    'Experimenter': (
+        "select o.id, count(p.id), max(p.id), "
+        "max(p.details.updateEvent.id) from Project p "
+        "join p.details.owner o where o.id in (:ids) group by o.id"),
+    'Project': (
+        "select l.parent.id, count(l.id), max(l.id), "
+        "max(d.details.updateEvent.id) from ProjectDatasetLink l "
+        "join l.child d where l.parent.id in (:ids) group by l.parent.id"),
+    'Dataset': (
+        "select l.parent.id, count(l.id), max(l.id), "
+        "max(i.details.updateEvent.id) from DatasetImageLink l "
+        "join l.child i where l.parent.id in (:ids) group by l.parent.id"),
+}
+
+
+def query_signatures(conn, gid, obj_type, parent_ids):
+    """Get the signatures of the children of some objects.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    gid : str - the ID of the group to query in
+    obj_type : str - the class of the parent objects (e.g. "Dataset")
+    parent_ids : list - the IDs of the parent objects
+
+    Returns
+    =======
+    dict - the signature strings (see SIGNATURE_QUERIES) with the parent IDs
+           as keys, parents without children are left out
+    """
+    from omero.sys import ParametersI
+    params = ParametersI()
+    params.addIds([long(pid) for pid in parent_ids])
+    rows = query_service(conn).projection(
+        SIGNATURE_QUERIES[obj_type], params, {'omero.group': str(gid)})
+    signatures = dict()
+    for row in rows:
+        values = [col.val if col is not None else None for col in row]
+        signatures[values[0]] = ':'.join(str(val) for val in values[1:])
+    return signatures
+
+
+def gen_children(conn, id_str, offset=0, limit=0):
     """Get the children for a given node.
 
+    The children are fetched with a projection query only returning the
+    fields required for the nodes, instead of loading the full objects. For
+    containers with many children, the nodes can be requested page by page
+    by specifying a limit. In case more children are available, a node of the
+    class 'Pager' is appended that has the ID string of the parent with the
+    offset of the next page (e.g. "G:23:Dataset:42@500"), so expanding it in
+    jqTree will load the next page.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    id_str : str - OMERO object ID string (e.g. "G:23:Image:42"), optionally
+                   followed by '@' and the offset of the page to fetch
+    offset : int - the number of children to skip
+    limit : int - the maximum number of children to return, 0 for all
+
+    Returns
+    =======
+    list - a list of the child nodes dicts, having the 'load_on_demand'
+           property set to True required by the jqTree JavaScript library
+    """
+    return list(iter_children(conn, id_str, offset, limit))
+
+
+def iter_children(conn, id_str, offset=0, limit=0):
+    """Generate the children for a given node one by one.
+
+    This is the generator behind gen_children() (see there for details), the
+    nodes are produced as the rows returned by OMERO are processed.
+    """
+    if id_str == 'ROOT':
+        for node in gen_base_tree(conn):
+            yield node
+        return
+    if id_str.startswith('ExperimenterGroup:'):
+        for node in iter_group_members(conn, id_str):
+            yield node
+        return
+    base_id = id_str
+    if '@' in id_str:
+        base_id, offset = id_str.split('@')
+        offset = int(offset)
+    _, gid, obj_type, oid = base_id.split(':')
+    # NOTE: with a limit, we fetch one item more than requested to know if
+    # there's another page:
+    children = query_children(conn, gid, obj_type, [oid], offset,
+                              limit + 1 if limit > 0 else 0)
+    for (count, (_, child)) in enumerate(children):
+        if limit > 0 and count == limit:
+            yield {
+                'label': '[ more: %s... ]' % (offset + limit + 1),
+                'class': 'Pager',
+                'owner': None,
+                'id': '%s@%s' % (base_id, offset + limit),
+                'children': [],
+                'load_on_demand': True,
+            }
+            return
+        # set the on-demand flag unless the children are the last level:
+        if not obj_type == 'Dataset':
+            child['load_on_demand'] = True
+        yield child
+
+
+def gen_subtree(conn, id_str, depth):
+    """Get the children of a node including several levels of descendants.
+
+    Each level of the Project / Dataset / Image hierarchy is fetched with one
+    query for all containers of the previous level, so the number of server
+    round trips only depends on the depth. For the 'ROOT' node the first
+    level is the base tree (see gen_base_tree()) and the deeper levels are
+    fetched per group.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    id_str : str - OMERO object ID string (e.g. "G:23:Experimenter:42")
+    depth : int - the number of levels to fetch (1 is the same as
+                  gen_children() without a limit)
+
+    Returns
+    =======
+    list - a list of nested node dicts, the 'load_on_demand' property being
+           set only for the nodes at the cut-off depth
+    """
+    if id_str == 'ROOT':
+        tree = gen_base_tree(conn)
+        if depth > 1:
+            for group in tree:
+                members = dict()
+                for user_dict in group['children']:
+                    members[user_dict['id'].split(':')[-1]] = [user_dict]
+                    del user_dict['load_on_demand']
+                gid = group['id'].split(':')[-1]
+                expand_nodes(conn, gid, 'Experimenter', members, depth - 1)
+        return tree
+    _, gid, obj_type, oid = id_str.split(':')
+    top = {'children': []}
+    expand_nodes(conn, gid, obj_type, {oid: [top]}, depth)
+    return top['children']
+
+
+def expand_nodes(conn, gid, obj_type, nodes, depth):
+    """Fill in the children of some nodes down to a given depth.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    gid : str - the ID of the group to query in
+    obj_type : str - the class of the nodes to expand (e.g. "Project")
+    nodes : dict - lists of node dicts to expand with their object IDs as keys
+                   (a list, as e.g. a dataset may be part of several projects)
+    depth : int - the number of levels to fetch
+    """
+    while depth > 0 and nodes and obj_type in CHILD_QUERIES:
+        children = query_children(conn, gid, obj_type, nodes.keys())
+        depth -= 1
+        expanded = dict()
+        for (parent_id, child) in children:
+            for parent in nodes[str(parent_id)]:
+                parent['children'].append(child)
+            child_id = child['id'].split(':')[-1]
+            expanded.setdefault(child_id, []).append(child)
+        obj_type = CHILD_QUERIES[obj_type][0]
+        nodes = expanded
+    # the nodes at the cut-off depth have to be loaded on demand:
+    if obj_type in CHILD_QUERIES:
+        for node_list in nodes.values():
+            for node in node_list:
+                node['load_on_demand'] = True
+
+
+def print_subtree_json(conn, id_str, depth, pretty=False):
+    """Print the subtree of the given ID in JSON format (see gen_subtree()).
+
+    The JSON is compact unless `pretty` (sorted and indented, for debugging)
+    is requested.
+
+    Returns
+    =======
+    bool - True in case printing the nodes was successful, False otherwise.
+    """
+    try:
+        subtree = gen_subtree(conn, id_str, depth)
+    except:
+        print "ERROR generating OMERO subtree!"
+        return False
+    with ome_metrics.Timer('json'):
+        if pretty:
+            json_str = tree_to_json(subtree)
+            print json_str
+        else:
+            json_str = write_json_nodes(subtree, sys.stdout)
+    ome_metrics.add('response_bytes', len(json_str))
+    return True
+
+
+def gen_base_tree(conn):
+    """Generate all group trees with their members as the basic tree.
+
+    The groups of the current user and their members are fetched with a
+    single cross-group query instead of several lookups per group (as done by
+    gen_base_tree_per_group(), which is used as a fallback in case the query
+    fails). The result is identical, including the rule that members of
+    private groups are only listed for the group's leaders.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+
+    Returns
+    =======
+    base : a list of grouptree dicts
+    """
+    try:
+        groups = query_member_groups(conn)
+    except Exception:  # pylint: disable=broad-except
+        return gen_base_tree_per_group(conn)
+    ctx = conn.getEventContext()
+    return [gen_group_tree(conn, group, ctx) for group in groups]
+
+
+def gen_group_tree(conn, group, ctx):
+    """Create the tree nodes for a group and its members.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    group : omero.model.ExperimenterGroup - the group having the
+            group-experimenter maps and the experimenters loaded
+    ctx : the event context of the current user
+
+    Returns
+    =======
+    grouptree : a nested dict of a group and its members as a list of dicts in
+                the 'children' item, starting with the current user as the
+                first entry
+    """
+    from omero.gateway import ExperimenterGroupWrapper, ExperimenterWrapper
+    gid = str(group.id.val)
+    group_dict = gen_obj_dict(ExperimenterGroupWrapper(conn, group))
+    members = [gem.child for gem in group.copyGroupExperimenterMap()
+               if gem is not None]
+    # the user's own tree comes first:
+    own = [exp for exp in members if exp.id.val == ctx.userId]
+    others = []
+    if (group.details.permissions.isGroupRead() or
+            group.id.val in set(ctx.leaderOfGroups)):
+        others = [exp for exp in members if exp.id.val != ctx.userId]
+    for exp in own + others:
+        user_dict = gen_obj_dict(ExperimenterWrapper(conn, exp),
+                                 'G:' + gid + ':')
+        user_dict['load_on_demand'] = True
+        group_dict['children'].append(user_dict)
+    return group_dict
+
+
+MEMBER_GROUPS_QUERY = (
+    "select distinct g from ExperimenterGroup g "
+    "left outer join fetch g.groupExperimenterMap m "
+    "left outer join fetch m.child e "
+    "where g.id in (:ids) and g.name != 'user'")
+
+
+def query_member_groups(conn, gids=None, group_ctx='-1'):
+    """Fetch the groups of the current user including all their members.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    gids : list - the IDs of the groups to fetch (default: all groups of the
+                  current user)
+    group_ctx : str - the group context of the query, cross-group by default
+
+    Returns
+    =======
+    list - omero.model.ExperimenterGroup objects having the group-experimenter
+           maps and the experimenters loaded, in the order of the user's
+           event context (the 'user' group is left out)
+    """
+    from omero.sys import ParametersI
+    if gids is None:
+        gids = list(conn.getEventContext().memberOfGroups)
+    params = ParametersI()
+    params.addIds(gids)
+    groups = query_service(conn).findAllByQuery(
+        MEMBER_GROUPS_QUERY, params, {'omero.group': str(group_ctx)})
+    order = dict((gid, pos) for (pos, gid) in enumerate(gids))
+    return sorted(groups, key=lambda group: order[group.id.val])
+
+
+def gen_base_tree_per_group(conn, workers=TREE_WORKERS, timeout=None):
+    """Generate the basic tree by looking up each group separately.
+
+    The members of each group are requested in the context of that group (see
+    query_member_groups()), the lookups run on a pool of at most `workers`
+    threads. Groups whose lookup didn't finish within `timeout` seconds (in
+    total) are returned without their members, flagged to be loaded on
+    demand. See gen_base_tree() for the preferred way.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    workers : int - the maximum number of concurrent group lookups
+    timeout : float - seconds to wait for all lookups (default: TREE_TIMEOUT)
+
+    Returns
+    =======
+    base : a list of grouptree dicts
+    """
+    from multiprocessing import TimeoutError
+    if timeout is None:
+        timeout = TREE_TIMEOUT
+    ctx = conn.getEventContext()
+    groups = conn.getGroupsMemberOf()
+    if not groups:
+        return []
+    pool = thread_pool(min(workers, len(groups)))
+    try:
+        lookups = [pool.apply_async(query_member_groups,
+                                    (conn, [group.getId()], group.getId()))
+                   for group in groups]
+    finally:
+        # slow lookups are abandoned, don't wait for them:
+        pool.close()
+    deadline = time.time() + timeout
+    tree = []
+    for (group, lookup) in zip(groups, lookups):
+        try:
+            found = lookup.get(max(0, deadline - time.time()))
+        except TimeoutError:
+            found = None
+        except Exception:  # pylint: disable=broad-except
+            found = None
+        if found:
+            tree.append(gen_group_tree(conn, found[0], ctx))
+        else:
+            group_dict = gen_obj_dict(group)
+            group_dict['load_on_demand'] = True
+            tree.append(group_dict)
+    return tree
+
+
+def iter_group_members(conn, id_str):
+    """Generate the member nodes of a group (e.g. "ExperimenterGroup:23").
+
+    This is used for expanding group nodes returned without their members by
+    gen_base_tree_per_group().
+    """
+    gid = long(id_str.split(':')[1])
+    groups = query_member_groups(conn, [gid], gid)
+    if not groups:
+        raise KeyError("group %s not found" % gid)
+    for node in gen_group_tree(conn, groups[0],
+                               conn.getEventContext())['children']:
+        yield node
+
+
+# maximum number of parent IDs per query when refreshing the search index:
+SEARCH_CHUNK = 500
+
+
+def query_dataset_signatures(conn, gid, dset_ids):
+    """Get the signatures of some datasets (see DATASET_SIGNATURE_QUERY).
+
+    Returns
+    =======
+    dict - the signature strings with the dataset IDs as keys, datasets
+           without images are left out
+    """
+    from omero.sys import ParametersI
+    params = ParametersI()
+    params.addIds([long(dset_id) for dset_id in dset_ids])
+    rows = query_service(conn).projection(
+        DATASET_SIGNATURE_QUERY, params, {'omero.group': str(gid)})
+    signatures = dict()
+    for row in rows:
+        values = [col.val if col is not None else None for col in row]
+        signatures[values[0]] = ':'.join(str(val) for val in values[1:])
+    return signatures
+
+
+def query_descendants(conn, gid, obj_type, parent_ids):
+    """Run the children query of query_children() in chunks of parents.
+
+    Returns
+    =======
+    list - (parent_id, class, ID, name, owner) tuples of the children
+    """
+    found = []
+    for pos in range(0, len(parent_ids), SEARCH_CHUNK):
+        chunk = parent_ids[pos:pos + SEARCH_CHUNK]
+        for (parent_id, node) in query_children(conn, gid, obj_type, chunk):
+            found.append((parent_id, node['class'],
+                          long(node['id'].split(':')[3]), node['label'],
+                          node['owner']))
+    return found
+
+
+def refresh_search_index(conn, index, user, passwd):
+    """Update a user's search index (see ome_search) from OMERO.
+
+    For every group the projects of all members shown in the tree and their
+    datasets are fetched with two bulk queries, plus one for the signatures
+    of the datasets. The images are only fetched for datasets whose signature
+    has changed since the last refresh.
+
+    Parameters
+    ==========
+    conn : omero.gateway._BlitzGateway
+    index : ome_search.SearchIndex
+    user : str - the OMERO user (the owner of the index)
+    passwd : str - the user's password, searching will require it
+
+    Returns
+    =======
+    bool - False if a refresh of the user's index is running already
+    """
+    if not index.start_refresh(user):
+        return False
+    try:
+        gids = set()
+        for group in gen_base_tree(conn):
+            gid = group['id'].split(':')[1]
+            gids.add(gid)
+            if group.get('load_on_demand'):
+                # the members couldn't be looked up, keep the group as is:
+                continue
+            members = [node['id'].split(':')[3] for node in group['children']]
+            projects = query_descendants(conn, gid, 'Experimenter', members)
+            datasets = query_descendants(
+                conn, gid, 'Project', [proj[2] for proj in projects])
+            dset_ids = sorted(set(dset[2] for dset in datasets))
+            signatures = dict()
+            for pos in range(0, len(dset_ids), SEARCH_CHUNK):
+                signatures.update(query_signatures(
+                    conn, gid, 'Dataset', dset_ids[pos:pos + SEARCH_CHUNK]))
+            for dset_id in dset_ids:
+                signatures.setdefault(dset_id, 'empty')
+            stored = index.signatures(user, gid)
+            changed = [dset_id for dset_id in dset_ids
+                       if stored.get(dset_id) != signatures[dset_id]]
+            images = dict((dset_id, []) for dset_id in changed)
+            for image in query_descendants(conn, gid, 'Dataset', changed):
+                images[image[0]].append(image)
+            index.update_group(user, gid, projects + datasets, images,
+                               signatures)
+        for gid in index.groups(user):
+            if gid not in gids:
+                index.drop_group(user, gid)
+    except:
+        index.finish_refresh(user)
+        raise
+    index.finish_refresh(user, passwd)
+    return True
+
+
+def check_credentials(conn):
+    """Check if supplied credentials are valid.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+
+    Returns
+    =======
+    conntected : bool
+        True if connecting was successful (i.e. credentials are correct), False
+        otherwise. In addition, a corresponding message is printed.
+    """
+    # the connection has been established by omero_login() already, calling
+    # connect() again would create yet another session on the server:
+    connected = conn.isConnected()
+    if connected:
+        print('Success logging into OMERO with user ID %s' % conn.getUserId())
+    else:
+        print('ERROR logging into OMERO.')
+    return connected
+
+
+def omero_to_hrm(conn, id_str, dest):
+    """Download the corresponding original file(s) from an image ID.
+
+    Images imported with OMERO versions before 5.0 don't have an "original
+    file" linked to them, their pixel data is exported as OME-TIFF instead
+    (see export_ome_tiff()).
+
+    Note that files will be downloaded with their original name, which is not
+    necessarily the name shown by OMERO, e.g. if an image name was changed in
+    OMERO. To keep filesets consistent, we have to preserve the original names!
+
+    In addition to the original file(s), it also downloads a thumbnail of the
+    requested file from OMERO and puts it into the appropriate place so HRM
+    will show it as a preview until the user hits "re-generate preview".
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    id_str: str - the ID of the OMERO image (e.g. "G:23:Image:42")
+    dest: str - destination directory
+
+    Returns
+    =======
+    True in case the download was successful, False otherwise.
+    """
+    plan = plan_image_download(conn, id_str, dest)
+    if plan is None:
+        return False
+    image_id, downloads, gid = plan
+    if not transfer_image(conn, image_id, downloads, gid=gid):
+        return False
+    # NOTE: for filesets with a single file or e.g. ICS/IDS pairs it makes
+    # sense to use the target name of the first file to construct the name for
+    # the thumbnail, but it is unclear whether this is a universal approach:
+    download_thumb(conn, image_id, downloads[0][1])
+    return True
+
+
+def plan_image_download(conn, id_str, dest):
+    """Determine the original files of an image and their target names.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    id_str: str - the ID of the OMERO image (e.g. "G:23:Image:42")
+    dest: str - destination directory
+
+    Returns
+    =======
+    (image_id, downloads, gid) - the OMERO image ID, a list of tuples with the
+    original file IDs and the target filenames and the group ID to use for
+    the transfer ('-1' for all groups), None in case of an error. For images
+    without original files, the list has a single tuple with None as file ID
+    and the name of the OME-TIFF to export the image to.
+    """
+    # FIXME: group switching required!!
+    _, gid, obj_type, image_id = id_str.split(':')
+    if not image_id:
+        print("Could not parse ID string '%s'. Expecting [GID]:[Type]:[Image_ID]" % id_str)
+        return None
+    # Provided that the tree displays only groups that the current user has access to, cross-group query (introduced in
+    # OMERO 4.4) is a generic way to get the image.
+    if not gid:
+        gid = '-1'
+    conn.SERVICE_OPTS.setOmeroGroup(gid)
+    # check if dest is a directory, rewrite it otherwise:
+    if not os.path.isdir(dest):
+        dest = os.path.dirname(dest)
+    # use image objects and getFileset() methods to determine original files,
+    # see the following OME forum thread for some more details:
+    # https://www.openmicroscopy.org/community/viewtopic.php?f=6&t=7563
+    with ome_metrics.Timer('query'):
+        image_obj = conn.getObject("Image", image_id)
+    if not image_obj:
+        print("ERROR: can't find image with ID %s!" % image_id)
+        return None
+    fset = image_obj.getFileset()
+    if not fset:
+        # the image was imported before OMERO 5.0 (issues #438 and #398), so
+        # there are no original files and the pixel data has to be exported:
+        # TODO: images uploaded with the "archive" option might still have
+        # their files available as archived files.
+        name = os.path.splitext(os.path.basename(image_obj.getName() or ''))[0]
+        tgt = os.path.join(dest, (name or 'image_%s' % image_id) +
+                           OME_TIFF_SUFFIX)
+        if os.path.exists(tgt):
+            print("ERROR: target file '%s' already existing!" % tgt)
+            return None
+        return (image_id, [(None, tgt)], gid)
+    downloads = []
+    # assemble a list of items to download, check if any files already exist:
+    for fset_file in fset.listFiles():
+        tgt = os.path.join(dest, fset_file.getName())
+        if os.path.exists(tgt):
+            print("ERROR: target file '%s' already existing!" % tgt)
+            return None
+        fset_id = fset_file.getId()
+        downloads.append((fset_id, tgt))
+    return (image_id, downloads, gid)
+
+
+def enough_space(targets):
+    """Check if files fit on their file systems before downloading them.
+
+    Parameters
+    ==========
+    targets : list - tuples of target filenames and their sizes in bytes
+
+    Returns
+    =======
+    True if there's enough space, False otherwise (printing an error).
+    """
+    import ome_transfer
+    lacking = ome_transfer.check_free_space(targets)
+    for (directory, required, available) in lacking:
+        print("ERROR: not enough space in '%s' (%s required, %s available)!"
+              % (directory, ome_transfer.format_size(required),
+                 ome_transfer.format_size(available)))
+    return not lacking
+
+
+def transfer_image(conn, image_id, downloads, workers=None, gid='-1'):
+    """Run the downloads determined by plan_image_download().
+
+    The files of a fileset are downloaded by at most `workers` threads
+    (default: TRANSFER_WORKERS). The group ID `gid` of the plan is passed
+    explicitly, as the group context of the connection is shared by all
+    threads.
+
+    Returns
+    =======
+    True in case all downloads were successful, False otherwise.
+    """
+    if downloads[0][0] is None:
+        return export_ome_tiff(conn, image_id, downloads[0][1], gid=gid)
+    return download_original_files(conn, downloads, workers)
+
+
+def export_ome_tiff(conn, image_id, tgt, workers=4, gid='-1'):
+    """Export the pixel data of an image as OME-TIFF (see ome_tiff).
+
+    The planes are read from the pixels store in strips of at most CHUNK_SIZE
+    bytes and written straight to the target file (first as "<tgt>.part").
+    At most twice as many strips as `workers` are kept in memory, these are
+    fetched concurrently by a pool of `workers` threads, each having its own
+    pixels store. A failed request is retried up to RETRIES times.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    image_id : str - the OMERO image ID
+    tgt : str - the filename of the OME-TIFF
+    workers : int - the maximum number of concurrent requests
+    gid : str - the ID of the image's group, '-1' for all groups
+
+    Returns
+    =======
+    True in case the export was successful, False otherwise.
+    """
+    # only needed for legacy images, so don't slow down the startup:
+    import ome_tiff
+    import ome_transfer
+    with ome_metrics.Timer('query'):
+        image = conn.getObject("Image", image_id,
+                               opts={'omero.group': gid or '-1'})
+    if image is None:
+        print("ERROR: can't find image with ID %s!" % image_id)
+        return False
+    sizes = (image.getSizeX(), image.getSizeY(), image.getSizeZ(),
+             image.getSizeC(), image.getSizeT())
+    pixel_type = image.getPixelsType()
+    channels = [{'name': chan.getLabel(),
+                 'excitation': chan.getExcitationWave(),
+                 'emission': chan.getEmissionWave()}
+                for chan in image.getChannels()]
+    description = ome_tiff.ome_xml(
+        image.getName(), pixel_type, sizes,
+        (image.getPixelSizeX(), image.getPixelSizeY(), image.getPixelSizeZ()),
+        channels)
+    pixels_id = image.getPrimaryPixels().getId()
+    local = threading.local()
+    stores = []
+    lock = threading.Lock()
+
+    def fetch(strip):
+        """Read a strip of a plane using the pixels store of the thread."""
+        (z_idx, c_idx, t_idx, row, rows) = strip
+        attempt = 0
+        while True:
+            try:
+                if getattr(local, 'store', None) is None:
+                    local.store = conn.c.sf.createRawPixelsStore()
+                    with lock:
+                        stores.append(local.store)
+                    local.store.setPixelsId(pixels_id, True,
+                                            {'omero.group': '-1'})
+                return local.store.getTile(z_idx, c_idx, t_idx, 0, row,
+                                           sizes[0], rows)
+            except Exception:  # pylint: disable=broad-except
+                attempt += 1
+                if attempt > RETRIES:
+                    raise
+                # start over with a new store:
+                local.store = None
+                time.sleep(2 ** (attempt - 1))
+
+    bits = ome_tiff.PIXEL_TYPES.get(pixel_type, (0, 0))[0]
+    if not enough_space([(tgt, sizes[0] * sizes[1] * sizes[2] * sizes[3] *
+                          sizes[4] * bits // 8)]):
+        return False
+
+    partial = tgt + ome_transfer.PART_SUFFIX
+    progress = None
+    pool = thread_pool(workers)
+    try:
+        with open(partial, 'wb') as outfile:
+            writer = ome_tiff.OmeTiffWriter(outfile, pixel_type, sizes,
+                                            description, CHUNK_SIZE)
+            progress = ome_transfer.Progress(
+                os.path.basename(tgt), writer.plane_bytes * sizes[2] *
+                sizes[3] * sizes[4])
+            strips = [plane + strip for plane in writer.planes()
+                      for strip in writer.strips()]
+            window = 2 * max(1, workers)
+            for pos in range(0, len(strips), window):
+                batch = strips[pos:pos + window]
+                for (strip, data) in zip(batch, pool.map(fetch, batch)):
+                    expected = strip[4] * writer.plane_bytes // sizes[1]
+                    if len(data) != expected:
+                        raise IOError('got %s bytes instead of %s for plane '
+                                      '%s' % (len(data), expected, strip[:3]))
+                    if strip[3] == 0:
+                        writer.start_plane()
+                    writer.write_strip(data)
+                    progress.update(len(data))
+                    if LIMITER is not None:
+                        LIMITER.consume(len(data))
+            writer.close()
+    except Exception as err:  # pylint: disable=broad-except
+        if progress is not None:
+            progress.record()
+        print("ERROR: exporting image %s to '%s' failed: %s" %
+              (image_id, tgt, err))
+        if os.path.exists(partial):
+            os.unlink(partial)
+        return False
+    finally:
+        pool.close()
+        pool.join()
+        for store in stores:
+            try:
+                store.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+    progress.record()
+    os.rename(partial, tgt)
+    print("Image %s exported as '%s' (%s, %s/s)" % (
+        image_id, os.path.basename(tgt), ome_transfer.format_size(
+            os.path.getsize(tgt)), ome_transfer.format_size(progress.rate())))
+    return True
+
+
+def download_original_files(conn, downloads, workers=None):
+    """Download a list of original files from OMERO.
+
+    The sizes (and checksums) of all files are fetched with a single query,
+    which is used to check the free space on the destination file systems
+    before anything is downloaded. The files are then downloaded by a pool of
+    at most `workers` threads, all sharing the bandwidth limit (see LIMITER).
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    downloads : list - tuples of original file IDs and target filenames
+    workers : int - the maximum number of concurrent downloads (default:
+                    TRANSFER_WORKERS)
+
+    Returns
+    =======
+    True in case all downloads were successful, False otherwise.
+    """
+    import ome_transfer
+    if workers is None:
+        workers = TRANSFER_WORKERS
+    try:
+        ofiles = load_original_files(conn, [fid for (fid, _) in downloads])
+    except Exception as err:  # pylint: disable=broad-except
+        print("ERROR: can't query original files: %s" % err)
+        return False
+    for (fset_id, tgt) in downloads:
+        if fset_id not in ofiles:
+            print("ERROR: original file %s not found!" % fset_id)
+            return False
+    if not enough_space([(tgt, ome_transfer.rfget(ofiles[fset_id], 'size', 0))
+                         for (fset_id, tgt) in downloads]):
+        return False
+
+    if workers <= 1 or len(downloads) == 1:
+        for (fset_id, tgt) in downloads:
+            if not ome_transfer.download_file(conn.c, ofiles[fset_id], tgt,
+                                              CHUNK_SIZE, RETRIES, LIMITER):
+                return False
+        return True
+
+    stdout = capturing_stdout()
+
+    def transfer(download):
+        """Download a single file, collecting its messages."""
+        fset_id, tgt = download
+        stdout.start_capture()
+        try:
+            success = ome_transfer.download_file(
+                conn.c, ofiles[fset_id], tgt, CHUNK_SIZE, RETRIES, LIMITER)
+        finally:
+            messages = stdout.stop_capture()
+        return (success, messages)
+
+    pool = thread_pool(min(workers, len(downloads)))
+    try:
+        results = pool.map(transfer, downloads)
+    finally:
+        pool.close()
+        pool.join()
+    # print the messages from this thread, which may be capturing them:
+    for (_, messages) in results:
+        sys.stdout.write(messages)
+    return all(success for (success, _) in results)
+
+
+def load_original_files(conn, file_ids):
+    """Fetch OriginalFile objects including their checksums in one query.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    file_ids : list - the IDs of the original files
+
+    Returns
+    =======
+    dict - the omero.model.OriginalFile objects with their IDs as keys
+    """
+    from omero.sys import ParametersI
+    params = ParametersI()
+    params.addIds(file_ids)
+    query = ("select f from OriginalFile f left outer join fetch f.hasher "
+             "where f.id in (:ids)")
+    ofiles = query_service(conn).findAllByQuery(
+        query, params, {'omero.group': '-1'})
+    return dict((ofile.id.val, ofile) for ofile in ofiles)
+
+
+def omero_to_hrm_batch(conn, images, workers=4):
+    """Download the original files of many images using a single session.
+
+    First the original files of all images are determined one after another
+    (this requires switching the group context of the connection), then the
+    actual transfers run on a pool of at most `workers` threads. Images
+    sharing a fileset (e.g. multi-series files) are only downloaded once.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    images : list - tuples of image ID strings (e.g. "G:23:Image:42") and
+                    their destination directories
+    workers : int - the maximum number of concurrent downloads
+
+    Returns
+    =======
+    True in case all images were downloaded successfully, False otherwise. The
+    per-image results are printed as a JSON object, mapping the ID strings to
+    a dict with the items 'success' (bool) and 'messages' (list of str).
+    """
+    stdout = capturing_stdout()
+    results = dict()
+    jobs = []
+    shared = []
+    scheduled = dict()
+    for (id_str, dest) in images:
+        stdout.start_capture()
+        try:
+            plan = plan_image_download(conn, id_str, dest)
+        except Exception as err:  # pylint: disable=broad-except
+            print("ERROR: can't process image '%s': %s" % (id_str, err))
+            plan = None
+        messages = stdout.stop_capture().splitlines()
+        results[id_str] = {'success': False, 'messages': messages}
+        if plan is None:
+            continue
+        files = tuple(sorted(fset_id for (fset_id, _) in plan[1]))
+        if files == (None,):
+            # exported images never share anything:
+            files = ('export', plan[0])
+        if files in scheduled:
+            shared.append((id_str, scheduled[files]))
+            continue
+        scheduled[files] = id_str
+        jobs.append((id_str, plan))
+
+    def transfer(job):
+        """Run the downloads of a single image, collecting its messages."""
+        id_str, (image_id, downloads, gid) = job
+        stdout.start_capture()
+        try:
+            success = transfer_image(conn, image_id, downloads,
+                                     file_workers, gid)
+        finally:
+            messages = stdout.stop_capture().splitlines()
+        return (id_str, success, messages)
+
+    # the threads for the files of a fileset are split between the images
+    # transferred concurrently:
+    file_workers = max(1, TRANSFER_WORKERS // max(1, min(workers, len(jobs))))
+    if jobs:
+        pool = thread_pool(min(workers, len(jobs)))
+        try:
+            for (id_str, success, messages) in pool.imap_unordered(transfer,
+                                                                   jobs):
+                results[id_str]['success'] = success
+                results[id_str]['messages'].extend(messages)
+        finally:
+            pool.close()
+            pool.join()
+
+    previews = fetch_previews(
+        conn, [(id_str, downloads[0][1]) for (id_str, (_, downloads, _)) in jobs
+               if results[id_str]['success']], workers)
+    for (id_str, (_, message)) in previews.items():
+        if message is not None:
+            results[id_str]['messages'].append(message)
+    for (id_str, primary) in shared:
+        results[id_str]['success'] = results[primary]['success']
+        results[id_str]['messages'].append(
+            "Fileset shared with '%s', downloaded only once." % primary)
+
+    print(json.dumps(results, sort_keys=True))
+    return all(res['success'] for res in results.values())
+
+
+# the original files of all images in a dataset, including images without a
+# fileset (imported before OMERO 5.0):
+DATASET_FILES_QUERY = (
+    "select i.id, fs.id, f.id, f.name, f.size, f.hash, h.value "
+    "from DatasetImageLink l join l.child i left outer join i.fileset fs "
+    "left outer join fs.usedFiles u left outer join u.originalFile f "
+    "left outer join f.hasher h where l.parent.id = :id "
+    "order by i.id, f.id")
+
+
+def query_dataset_files(conn, gid, dset_id):
+    """Get the filesets of all images in a dataset with a single query.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    gid : str - the ID of the group to query in
+    dset_id : str - the ID of the dataset
+
+    Returns
+    =======
+    (images, filesets) - a dict mapping the image IDs to their fileset IDs
+    (None for images without a fileset) and a dict mapping the fileset IDs to
+    lists of (file_id, name, size, hash, hasher) tuples
+    """
+    from omero.sys import ParametersI
+    params = ParametersI()
+    params.addId(long(dset_id))
+    rows = query_service(conn).projection(
+        DATASET_FILES_QUERY, params, {'omero.group': str(gid)})
+    images = dict()
+    filesets = dict()
+    for row in rows:
+        (image_id, fset_id, file_id, name, size, fhash, hasher) = [
+            col.val if col is not None else None for col in row]
+        images[image_id] = fset_id
+        # the files of shared filesets are listed for every image:
+        if file_id is not None:
+            filesets.setdefault(fset_id, dict())[file_id] = (
+                file_id, name, size, fhash, hasher)
+    for (fset_id, files) in filesets.items():
+        filesets[fset_id] = [files[file_id] for file_id in sorted(files)]
+    return (images, filesets)
+
+
+def is_identical(fname, size, fhash, hasher, hashes):
+    """Check if a local file matches an original file in OMERO.
+
+    The sizes are compared first, the checksum is only computed (or taken
+    from the cache) if they are equal. Files without a checksum in OMERO are
+    considered identical if the sizes match.
+
+    Parameters
+    ==========
+    fname : str - the local file
+    size, fhash, hasher : the size, checksum and checksum algorithm of the
+                          original file
+    hashes : ome_hashes.HashCache - the cache for checksums of local files
+    """
+    try:
+        if os.path.getsize(fname) != size:
+            return False
+    except OSError:
+        return False
+    if not fhash:
+        return True
+    digest = hashes.digest(fname, hasher)
+    return digest is None or digest.lower() == fhash.lower()
+
+
+def sync_dataset(conn, id_str, dest, workers=4):
+    """Mirror the original files of a dataset into a directory.
+
+    Only files that are missing in the destination or differ from the ones in
+    OMERO (by size or checksum) are downloaded, all others are left alone.
+    Filesets shared by several images of the dataset (e.g. multi-series files)
+    are transferred only once. Files in the destination that don't belong to
+    the dataset are not touched. The previews are created for the images
+    whose files were downloaded.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    id_str : str - the ID of the OMERO dataset (e.g. "G:23:Dataset:42")
+    dest : str - the destination directory
+    workers : int - the maximum number of filesets to download concurrently
+
+    Returns
+    =======
+    True in case all images are up to date, False otherwise. The per-image
+    results are printed as a JSON object, mapping the image ID strings to a
+    dict with the items 'success' (bool) and 'messages' (list of str).
+    """
+    import ome_hashes
+    import ome_transfer
+    _, gid, obj_type, dset_id = id_str.split(':')
+    if obj_type != 'Dataset' or not dset_id:
+        print("ERROR: '%s' is not a dataset ID string." % id_str)
+        return False
+    if not os.path.isdir(dest):
+        print("ERROR: destination '%s' is not a directory!" % dest)
+        return False
+    if not gid:
+        gid = '-1'
+    conn.SERVICE_OPTS.setOmeroGroup(gid)
+    try:
+        images, filesets = query_dataset_files(conn, gid, dset_id)
+    except Exception as err:  # pylint: disable=broad-except
+        print("ERROR: can't query the files of dataset %s: %s" % (dset_id, err))
+        return False
+
+    if not check_cache_dir():
+        return False
+    hashes = ome_hashes.HashCache(CACHE_DIR)
+    outdated = dict()
+    try:
+        for (fset_id, files) in filesets.items():
+            changed = [(file_id, os.path.join(dest, name), fhash, hasher)
+                       for (file_id, name, size, fhash, hasher) in files
+                       if not is_identical(os.path.join(dest, name), size,
+                                           fhash, hasher, hashes)]
+            if changed:
+                outdated[fset_id] = changed
+    finally:
+        hashes.close()
+
+    ofiles = dict()
+    file_ids = [file_id for changed in outdated.values()
+                for (file_id, _, _, _) in changed]
+    if file_ids:
+        try:
+            ofiles = load_original_files(conn, file_ids)
+        except Exception as err:  # pylint: disable=broad-except
+            print("ERROR: can't query original files: %s" % err)
+            return False
+        if not enough_space(
+                [(tgt, ome_transfer.rfget(ofiles[file_id], 'size', 0))
+                 for changed in outdated.values()
+                 for (file_id, tgt, _, _) in changed if file_id in ofiles]):
+            return False
+
+    stdout = capturing_stdout()
+
+    def transfer(job):
+        """Download the changed files of a single fileset."""
+        fset_id, changed = job
+        stdout.start_capture()
+        success = True
+        try:
+            for (file_id, tgt, _, _) in changed:
+                if file_id not in ofiles:
+                    print("ERROR: original file %s not found!" % file_id)
+                    success = False
+                    break
+                if not ome_transfer.download_file(conn.c, ofiles[file_id], tgt,
+                                                  CHUNK_SIZE, RETRIES,
+                                                  LIMITER):
+                    success = False
+                    break
+        finally:
+            messages = stdout.stop_capture().splitlines()
+        return (fset_id, success, messages)
+
+    fset_results = dict()
+    if outdated:
+        pool = thread_pool(min(workers, len(outdated)))
+        try:
+            for (fset_id, success, messages) in pool.imap_unordered(
+                    transfer, outdated.items()):
+                fset_results[fset_id] = (success, messages)
+        finally:
+            pool.close()
+            pool.join()
+        # the downloaded files were verified, remember their checksums:
+        hashes = ome_hashes.HashCache(CACHE_DIR)
+        try:
+            for (fset_id, changed) in outdated.items():
+                if not fset_results[fset_id][0]:
+                    continue
+                for (_, tgt, fhash, hasher) in changed:
+                    if fhash and ome_transfer.new_hasher(hasher) is not None:
+                        hashes.put(tgt, hasher, fhash)
+        finally:
+            hashes.close()
+
+    results = dict()
+    previews = []
+    first_image = dict()
+    for image_id in sorted(images):
+        key = 'G:%s:Image:%s' % (gid, image_id)
+        fset_id = images[image_id]
+        if fset_id not in filesets:
+            results[key] = {'success': False, 'messages': [
+                "ERROR: no original file(s) for image %s found!" % image_id]}
+            continue
+        if fset_id not in outdated:
+            results[key] = {'success': True, 'messages': ['Up to date.']}
+            continue
+        success, messages = fset_results[fset_id]
+        if fset_id in first_image:
+            messages = ["Fileset shared with '%s', downloaded only once."
+                        % first_image[fset_id]]
+        else:
+            first_image[fset_id] = key
+            messages = list(messages)
+            if success:
+                previews.append(
+                    (key, os.path.join(dest, filesets[fset_id][0][1])))
+        results[key] = {'success': success, 'messages': messages}
+
+    for (key, (_, message)) in fetch_previews(conn, previews,
+                                              workers).items():
+        if message is not None:
+            results[key]['messages'].append(message)
+    print("Dataset %s: %s of %s filesets downloaded, %s up to date." % (
+        dset_id, len([res for res in fset_results.values() if res[0]]),
+        len(filesets), len(filesets) - len(outdated)))
+    print(json.dumps(results, sort_keys=True))
+    return all(res['success'] for res in results.values())
+
+
+def capturing_stdout():
+    """Make sure sys.stdout allows capturing the output per thread.
+
+    Returns
+    =======
+    ome_daemon.ThreadLocalStdout - the object installed as sys.stdout
+    """
+    import ome_daemon
+    if not isinstance(sys.stdout, ome_daemon.ThreadLocalStdout):
+        sys.stdout = ome_daemon.ThreadLocalStdout(sys.stdout)
+    return sys.stdout
+
+
+def load_manifest(fname):
+    """Read the list of items to transfer from a JSON manifest.
+
+    The manifest has to contain a list, the entries being either plain strings
+    (image ID strings like "G:23:Image:42" for downloads, filenames for
+    uploads) or dicts with the items 'id' and (optionally) 'dest', the latter
+    overriding the default destination of a download.
+
     Parameters
     ==========
-    conn : omero.gateway._BlitzGateway
-    id_str : str - OMERO object ID string (e.g. "G:23:Image:42")
+    fname : str - the manifest filename, '-' to read from stdin
 
     Returns
     =======
-    list - a list of the child nodes dicts, having the 'load_on_demand'
-           property set to True required by the jqTree JavaScript library
+    list - tuples of items and destinations (None for the default)
     """
-    if id_str == 'ROOT':
-        return gen_base_tree(conn)
-    children = []
-    _, gid, obj_type, oid = id_str.split(':')
-    conn.SERVICE_OPTS.setOmeroGroup(gid)
-    obj = conn.getObject(obj_type, oid)
-    # we need different child-wrappers, depending on the object type:
-    if obj_type == 'Experimenter':
-        children_wrapper = conn.listProjects(oid)
-    elif obj_type == 'ExperimenterGroup':
-        children_wrapper = None  # FIXME
+    if fname == '-':
+        manifest = json.load(sys.stdin)
     else:
-        children_wrapper = obj.listChildren()
-    # now recurse into children:
-    for child in children_wrapper:
-        children.append(gen_obj_dict(child, 'G:' + gid + ':'))
-    # set the on-demand flag unless the children are the last level:
-    if not obj_type == 'Dataset':
-        for child in children:
-            child['load_on_demand'] = True
-    return children
+        with open(fname, 'r') as infile:
+            manifest = json.load(infile)
+    images = []
+    for entry in manifest:
+        if isinstance(entry, dict):
+            images.append((entry['id'], entry.get('dest', None)))
+        else:
+            images.append((entry, None))
+    return images
 
 
-def gen_base_tree(conn):
-    """Generate all group trees with their members as the basic tree.
+def download_thumb(conn, image_id, dest):
+    """Download the thumbnail of a given image from OMERO.
+
+    Download the thumbnail of a given OMERO image and place it as preview in
+    the corresponding HRM directory (see download_thumbs()).
 
     Parameters
     ==========
-    conn : omero.gateway._BlitzGateway
+    conn : omero.gateway.BlitzGateway
+    image_id: str - an OMERO object ID of an image (e.g. '102')
+    dest: str - destination filename
 
     Returns
     =======
-    base : a list of grouptree dicts
+    True in case the download was successful, False otherwise.
     """
-    tree = []
-    for group in conn.getGroupsMemberOf():
-        tree.append(gen_group_tree(conn, group))
-    return tree
+    success, message = download_thumbs(conn, [(image_id, dest)])[image_id]
+    if message is not None:
+        print(message)
+    return success
 
 
-def gen_group_tree(conn, group=None):
-    """Create the tree nodes for a group and its members.
+def download_thumbs(conn, items, workers=4):
+    """Download the thumbnails of many images and save them as previews.
+
+    The thumbnails are requested from OMERO in sets of THUMB_SET_SIZE images
+    at once, all images are required to be in the current group context of
+    the connection. Writing the previews runs on a pool of `workers` threads.
 
     Parameters
     ==========
-    conn : omero.gateway._BlitzGateway
+    conn : omero.gateway.BlitzGateway
+    items : list - tuples of OMERO image IDs (e.g. '102') and the filenames of
+                   the corresponding downloaded files
+    workers : int - the maximum number of concurrently written previews
 
     Returns
     =======
-    grouptree : a nested dict of a group (the default unless explicitly
-                requested) and its members as a list of dicts in the 'children'
-                item, starting with the current user as the first entry
+    dict - (success, message) tuples with the image IDs as keys, the message
+           being None if there is nothing to report
     """
-    if group is not None:
-        conn.SERVICE_OPTS.setOmeroGroup(group.getId())
-    else:
-        group = conn.getGroupFromContext()
-    gid = str(group.getId())
-    group_dict = gen_obj_dict(group)
-    # add the user's own tree first:
-    user = conn.getUser()
-    user_dict = gen_obj_dict(user, 'G:' + gid + ':')
-    user_dict['load_on_demand'] = True
-    group_dict['children'].append(user_dict)
-    # then add the trees for other group members
-    for user in conn.listColleagues():
-        user_dict = gen_obj_dict(user, 'G:' + gid + ':')
-        user_dict['load_on_demand'] = True
-        group_dict['children'].append(user_dict)
-    return group_dict
+    ids = list(set(long(image_id) for (image_id, _) in items))
+    thumbs = dict()
+    try:
+        for pos in range(0, len(ids), THUMB_SET_SIZE):
+            with ome_metrics.Timer('query'):
+                thumbs.update(conn.getThumbnailSet(
+                    ids[pos:pos + THUMB_SET_SIZE]))
+    except Exception as err:  # pylint: disable=broad-except
+        message = "ERROR retrieving thumbnails: %s" % err
+        return dict((image_id, (False, message)) for (image_id, _) in items)
+
+    def save(item):
+        """Save the preview for a single image."""
+        image_id, dest = item
+        data = thumbs.get(long(image_id))
+        if not data:
+            return (image_id, (False, "ERROR: no thumbnail for image %s "
+                               "available." % image_id))
+        return (image_id, save_preview(data, dest))
+
+    # starting and joining a pool takes longer than writing a single preview:
+    if len(items) == 1 or workers <= 1:
+        return dict(save(item) for item in items)
+    pool = thread_pool(min(workers, len(items)))
+    try:
+        return dict(pool.map(save, items))
+    finally:
+        pool.close()
+        pool.join()
 
 
-def check_credentials(conn):
-    """Check if supplied credentials are valid.
+def save_preview(image_data, dest):
+    """Save a thumbnail as preview for a file in the HRM.
+
+    OMERO delivers the thumbnails as JPEG already, so they are written as they
+    are. Other formats are converted to JPEG in case PIL (Python Imaging
+    Library) is installed.
 
     Parameters
     ==========
-    conn : omero.gateway.BlitzGateway
+    image_data : str - the (encoded) thumbnail image
+    dest: str - the filename of the file the preview is made for
 
     Returns
     =======
-    conntected : bool
-        True if connecting was successful (i.e. credentials are correct), False
-        otherwise. In addition, a corresponding message is printed.
+    (success, message) - a bool and a message (None if there's nothing to
+                         report, e.g. if PIL would be required but missing)
     """
-    connected = conn.connect()
-    if connected:
-        print('Success logging into OMERO with user ID %s' % conn.getUserId())
-    else:
-        print('ERROR logging into OMERO.')
-    return connected
-
+    base_dir, fname = os.path.split(dest)
+    target = "/hrm_previews/" + fname + ".preview_xy.jpg"
+    if not image_data.startswith('\xff\xd8'):
+        try:
+            import Image
+        except ImportError:
+            try:
+                from PIL import Image
+            except ImportError:
+                return (False, None)
+        import StringIO
+        jpeg = StringIO.StringIO()
+        try:
+            Image.open(StringIO.StringIO(image_data)).save(jpeg, 'JPEG')
+        except Exception:  # pylint: disable=broad-except
+            return (False, "ERROR converting thumbnail for '%s'." % target)
+        image_data = jpeg.getvalue()
+    try:
+        with open(base_dir + target, 'wb') as outfile:
+            outfile.write(image_data)
+        # TODO: os.chown() to fix permissions, see #457!
+        return (True, "Thumbnail downloaded to '%s'." % target)
+    except:
+        return (False, "ERROR downloading thumbnail to '%s'." % target)
 
-def omero_to_hrm(conn, id_str, dest):
-    """Download the corresponding original file(s) from an image ID.
 
-    This works only for image ID's that were created with OMERO 5.0 or later as
-    previous versions don't have an "original file" linked to an image.
+def fetch_previews(conn, items, workers=4):
+    """Download the previews for images of possibly different groups.
 
-    Note that files will be downloaded with their original name, which is not
-    necessarily the name shown by OMERO, e.g. if an image name was changed in
-    OMERO. To keep filesets consistent, we have to preserve the original names!
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    items : list - tuples of image ID strings (e.g. "G:23:Image:42") and the
+                   filenames of the corresponding downloaded files
+    workers : int - the maximum number of concurrently written previews
 
-    In addition to the original file(s), it also downloads a thumbnail of the
-    requested file from OMERO and puts it into the appropriate place so HRM
-    will show it as a preview until the user hits "re-generate preview".
+    Returns
+    =======
+    dict - (success, message) tuples with the image ID strings as keys
+    """
+    # the thumbnails are requested with one call per group:
+    by_group = dict()
+    for (id_str, dest) in items:
+        _, gid, _, image_id = id_str.split(':')
+        by_group.setdefault(gid or '-1', []).append((id_str, image_id, dest))
+    results = dict()
+    for (gid, group_items) in by_group.items():
+        conn.SERVICE_OPTS.setOmeroGroup(gid)
+        thumbs = download_thumbs(
+            conn, [(image_id, dest) for (_, image_id, dest) in group_items],
+            workers)
+        for (id_str, image_id, _) in group_items:
+            results[id_str] = thumbs[image_id]
+    return results
+
+
+def retrieve_thumbnails(conn, items, workers=4):
+    """Create previews for images that were downloaded already.
 
     Parameters
     ==========
     conn : omero.gateway.BlitzGateway
-    id_str: str - the ID of the OMERO image (e.g. "G:23:Image:42")
-    dest: str - destination directory
+    items : list - tuples of image ID strings (e.g. "G:23:Image:42") and the
+                   filenames of the corresponding downloaded files
+    workers : int - the maximum number of concurrently written previews
 
     Returns
     =======
-    True in case the download was successful, False otherwise.
+    True in case all previews were created, False otherwise. The per-image
+    results are printed as a JSON object, mapping the ID strings to a dict
+    with the items 'success' (bool) and 'messages' (list of str).
     """
-    # FIXME: group switching required!!
-    _, gid, obj_type, image_id = id_str.split(':')
-    if not image_id:
-        print("Could not parse ID string '%s'. Expecting [GID]:[Type]:[Image_ID]" % id_str)
-        return False
-    # Provided that the tree displays only groups that the current user has access to, cross-group query (introduced in
-    # OMERO 4.4) is a generic way to get the image.
-    if not gid:
-        gid = '-1'
-    conn.SERVICE_OPTS.setOmeroGroup(gid)
-    # check if dest is a directory, rewrite it otherwise:
-    if not os.path.isdir(dest):
-        dest = os.path.dirname(dest)
-    from omero_model_OriginalFileI import OriginalFileI
-    # use image objects and getFileset() methods to determine original files,
-    # see the following OME forum thread for some more details:
-    # https://www.openmicroscopy.org/community/viewtopic.php?f=6&t=7563
-    image_obj = conn.getObject("Image", image_id)
-    if not image_obj:
-        print("ERROR: can't find image with ID %s!" % image_id)
-        return False
-    fset = image_obj.getFileset()
-    if not fset:
-        print("ERROR: no original file(s) for image %s found!" % image_id)
-        return False
-    # TODO I (issue #438): in case the query fails, this means most likely that
-    # a file was uploaded in an older version of OMERO and therefore the
-    # original file is not available. However, it was possible to upload with
-    # the "archive" option, we should check if such archived files are
-    # retrieved with the above query.
-    # TODO II (issue #398): in case no archived file is available, we could
-    # fall back to downloading the OME-TIFF instead.
-    downloads = []
-    # assemble a list of items to download, check if any files already exist:
-    for fset_file in fset.listFiles():
-        tgt = os.path.join(dest, fset_file.getName())
-        if os.path.exists(tgt):
-            print("ERROR: target file '%s' already existing!" % tgt)
-            return False
-        fset_id = fset_file.getId()
-        downloads.append((fset_id, tgt))
-    # now initiate the downloads for all original files:
-    for (fset_id, tgt) in downloads:
-        try:
-            conn.c.download(OriginalFileI(fset_id), tgt)
-        except:
-            print("ERROR: downloading %s to '%s' failed!" % (fset_id, tgt))
-            return False
-        print("ID %s downloaded as '%s'" % (fset_id, os.path.basename(tgt)))
-    # NOTE: for filesets with a single file or e.g. ICS/IDS pairs it makes
-    # sense to use the target name of the first file to construct the name for
-    # the thumbnail, but it is unclear whether this is a universal approach:
-    download_thumb(conn, image_id, downloads[0][1])
-    return True
+    results = dict()
+    for (id_str, (success, message)) in fetch_previews(
+            conn, items, workers).items():
+        messages = [message] if message is not None else []
+        results[id_str] = {'success': success, 'messages': messages}
+    print(json.dumps(results, sort_keys=True))
+    return all(res['success'] for res in results.values())
 
 
-def download_thumb(conn, image_id, dest):
-    """Download the thumbnail of a given image from OMERO.
+def find_uploaded(conn, id_str, image_files, workers=4):
+    """Find local files that are already stored in a dataset in OMERO.
 
-    In case PIL (Python Imaging Library) is installed, download the thumbnail
-    of a given OMERO image and place it as preview in the corresponding HRM
-    directory.
+    The original files of the dataset are fetched with a single query (see
+    query_dataset_files()). Only local files having the same size as one of
+    them are hashed, using the checksum algorithm of the original files. The
+    checksums are taken from the cache of local file checksums if possible
+    (see ome_hashes), the others are computed on a pool of `workers` threads.
 
     Parameters
     ==========
     conn : omero.gateway.BlitzGateway
-    image_id: str - an OMERO object ID of an image (e.g. '102')
-    dest: str - destination filename
+    id_str: str - the ID of the target dataset in OMERO (e.g. "G:7:Dataset:23")
+    image_files: list - the local image files including their full paths
+    workers : int - the maximum number of files hashed at the same time
 
     Returns
     =======
-    True in case the download was successful, False otherwise.
+    dict - the OMERO image IDs of the files already in the dataset, with the
+           filenames as keys
     """
-    try:
-        import Image
-        import StringIO
-    except ImportError:
-        return False
-    image_obj = conn.getObject("Image", image_id)
-    image_data = image_obj.getThumbnail()
-    thumbnail = Image.open(StringIO.StringIO(image_data))
-    base_dir, fname = os.path.split(dest)
-    target = "/hrm_previews/" + fname + ".preview_xy.jpg"
-    try:
-        thumbnail.save(base_dir + target)
-        # TODO: os.chown() to fix permissions, see #457!
-        print("Thumbnail downloaded to '%s'." % target)
-        return True
-    except:
-        print("ERROR downloading thumbnail to '%s'." % target)
-        return False
-
+    import ome_hashes
+    import ome_transfer
+    _, gid, _, dset_id = id_str.split(':')
+    images, filesets = query_dataset_files(conn, gid or '-1', dset_id)
+    fset_images = dict()
+    for (image_id, fset_id) in sorted(images.items()):
+        fset_images.setdefault(fset_id, image_id)
+    # the remote checksums by size and algorithm:
+    remote = dict()
+    for (fset_id, files) in filesets.items():
+        for (_, _, size, fhash, hasher) in files:
+            if fhash and ome_transfer.new_hasher(hasher) is not None:
+                remote.setdefault((size, hasher), dict())[fhash.lower()] = (
+                    fset_images[fset_id])
+    candidates = []
+    sizes = dict()
+    for image_file in set(image_files):
+        try:
+            size = sizes[image_file] = os.path.getsize(image_file)
+        except OSError:
+            continue
+        candidates.extend((image_file, hasher) for (rsize, hasher) in remote
+                          if rsize == size)
+    if not candidates:
+        return dict()
+
+    def hash_candidate(item):
+        """Hash a local file, None if it can't be read."""
+        try:
+            return ome_hashes.hash_file(*item)
+        except (IOError, OSError):
+            return None
 
-def hrm_to_omero(conn, id_str, image_file):
+    ome_sessions.ensure_dir(CACHE_DIR)
+    hashes = ome_hashes.HashCache(CACHE_DIR)
+    try:
+        digests = dict((item, hashes.get(*item)) for item in candidates)
+        missing = [item for (item, digest) in digests.items()
+                   if digest is None]
+        if missing:
+            pool = thread_pool(min(workers, len(missing)))
+            try:
+                computed = pool.map(hash_candidate, missing)
+            finally:
+                pool.close()
+                pool.join()
+            for (item, digest) in zip(missing, computed):
+                digests[item] = digest
+                if digest is not None:
+                    hashes.put(item[0], item[1], digest)
+    finally:
+        hashes.close()
+
+    uploaded = dict()
+    for ((image_file, hasher), digest) in digests.items():
+        # the file may have vanished (or be unreadable) in the meantime:
+        if digest is None:
+            continue
+        size = sizes[image_file]
+        image_id = remote[(size, hasher)].get(digest.lower())
+        if image_id is not None:
+            uploaded[image_file] = image_id
+    return uploaded
+
+
+def hrm_to_omero(conn, id_str, image_file, cli=None, skip_duplicates=False):
     """Upload an image into a specific dataset in OMERO.
 
     In case we know from the suffix that a given file format is not supported
     by OMERO, the upload will not be initiated at all (e.g. for SVI-HDF5,
-    having the suffix '.h5').
+    having the suffix '.h5'). If `skip_duplicates` is True, a file already
+    stored in the dataset (having the same size and checksum as one of its
+    original files) is skipped (see find_uploaded()). This requires querying
+    the dataset and hashing the file, so it's only done on request (batch
+    uploads check all their files at once, see hrm_to_omero_batch()).
 
     The import itself is done by instantiating the CLI class, assembling the
     required arguments, and finally running cli.invoke(). This eventually
@@ -371,14 +1996,22 @@ def hrm_to_omero(conn, id_str, image_file):
     ==========
     id_str: str - the ID of the target dataset in OMERO (e.g. "G:7:Dataset:23")
     image_file: str - the local image file including the full path
+    cli: omero.cli.CLI - (optional) a CLI instance to re-use for the import,
+                         see import_cli()
+    skip_duplicates: bool - don't upload files already stored in the dataset
 
     Returns
     =======
-    True in case of success, False otherwise.
+    True in case of success (or the file being skipped), False otherwise.
     """
     if image_file.lower().endswith(('.h5', '.hdf5')):
         print 'ERROR: HDF5 files are not supported by OMERO!'
         return False
+    if skip_duplicates:
+        skipped = skip_uploaded(conn, id_str, [image_file])
+        if skipped:
+            print(skipped[image_file])
+            return True
     # TODO I: group switching required!!
     _, gid, obj_type, dset_id = id_str.split(':')
     # we have to create the annotations *before* we actually upload the image
@@ -400,14 +2033,8 @@ def hrm_to_omero(conn, id_str, image_file):
     ####     ann = conn.createFileAnnfromLocalFile(
     ####         basename + suffix, mimetype=mime, ns=namespace, desc=None)
     ####     annotations.append(ann.getId())
-    # currently there is no direct "Python way" to import data into OMERO, so
-    # we have to use the CLI wrapper for this:
-    from omero.cli import CLI
-    cli = CLI()
-    cli.loadplugins()
-    # NOTE: cli._client should be replaced with cli.set_client() when switching
-    # to support for OMERO 5.1 and later only:
-    cli._client = conn.c
+    if cli is None:
+        cli = import_cli(conn)
     import_args = ["import"]
     import_args.extend(['-d', dset_id])
     if comment is not None:
@@ -418,14 +2045,137 @@ def hrm_to_omero(conn, id_str, image_file):
     import_args.append(image_file)
     # print("import_args: " + str(import_args))
     try:
-        cli.invoke(import_args, strict=True)
+        with ome_metrics.Timer('import'):
+            cli.invoke(import_args, strict=True)
     except:
         print('ERROR: uploading "%s" to %s failed!' % (image_file, id_str))
         # print(import_args)
         return False
+    # the dataset has a new child now, so its cached node is outdated:
+    cache = tree_cache()
+    if cache is not None:
+        import sqlite3
+        try:
+            cache.invalidate(id_str)
+        except sqlite3.Error:
+            pass
     return True
 
 
+def import_cli(conn):
+    """Set up an OMERO CLI instance for importing data.
+
+    Currently there is no direct "Python way" to import data into OMERO, so we
+    have to use the CLI wrapper for this. Loading the CLI plugins is rather
+    expensive, so the instance should be re-used for multiple imports.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+
+    Returns
+    =======
+    omero.cli.CLI - the CLI object using the session of the given connection
+    """
+    from omero.cli import CLI
+    cli = CLI()
+    cli.loadplugins()
+    # NOTE: cli._client should be replaced with cli.set_client() when switching
+    # to support for OMERO 5.1 and later only:
+    cli._client = conn.c
+    return cli
+
+
+def skip_uploaded(conn, id_str, image_files, workers=4):
+    """Determine the files to skip as they are already stored in a dataset.
+
+    A failure of the check (see find_uploaded()) is reported, but the files
+    are considered as not uploaded then, so they are transferred anyway.
+
+    Returns
+    =======
+    dict - the message to report for each file to skip
+    """
+    try:
+        uploaded = find_uploaded(conn, id_str, image_files, workers)
+    except Exception as err:  # pylint: disable=broad-except
+        print("WARNING: can't check for files already in %s: %s" %
+              (id_str, err))
+        return dict()
+    return dict((image_file, '"%s" is already stored in %s as image %s, '
+                 'skipping it.' % (image_file, id_str, image_id))
+                for (image_file, image_id) in uploaded.items())
+
+
+def hrm_to_omero_batch(conn, id_str, image_files, workers=2,
+                       skip_duplicates=True):
+    """Upload many images into a specific dataset in OMERO.
+
+    All uploads use the same OMERO session, running at most `workers` imports
+    at the same time. Each worker thread sets up its import CLI only once and
+    re-uses it for all its files (unless an import fails). Every image gets
+    its own parameter summary annotation, just like with hrm_to_omero(). Files
+    already stored in the dataset are determined before, and skipped unless
+    `skip_duplicates` is False.
+
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    id_str: str - the ID of the target dataset in OMERO (e.g. "G:7:Dataset:23")
+    image_files: list - the local image files including their full paths
+    workers : int - the maximum number of concurrent imports
+    skip_duplicates: bool - don't upload files already stored in the dataset
+
+    Returns
+    =======
+    True in case all images were uploaded successfully, False otherwise. The
+    per-file results are printed as a JSON object, mapping the filenames to a
+    dict with the items 'success' (bool) and 'messages' (list of str).
+    """
+    stdout = capturing_stdout()
+    local = threading.local()
+    results = dict()
+    if skip_duplicates:
+        # hashing is I/O bound, so use more threads than for the imports:
+        skipped = skip_uploaded(conn, id_str, image_files, max(4, workers))
+        for (image_file, message) in skipped.items():
+            results[image_file] = {'success': True, 'messages': [message]}
+        image_files = [fname for fname in image_files if fname not in skipped]
+        if not image_files:
+            print(json.dumps(results, sort_keys=True))
+            return True
+
+    def upload(image_file):
+        """Import a single file using the CLI instance of the thread."""
+        if getattr(local, 'cli', None) is None:
+            local.cli = import_cli(conn)
+        stdout.start_capture()
+        try:
+            success = hrm_to_omero(conn, id_str, image_file, local.cli,
+                                   skip_duplicates=False)
+        except Exception as err:  # pylint: disable=broad-except
+            print('ERROR: uploading "%s" to %s failed: %s' %
+                  (image_file, id_str, err))
+            success = False
+        finally:
+            messages = stdout.stop_capture().splitlines()
+        if not success:
+            # don't rely on the state of a CLI object after a failed import:
+            local.cli = None
+        return (image_file, success, messages)
+
+    pool = thread_pool(min(workers, len(image_files)))
+    try:
+        for (image_file, success, messages) in pool.imap_unordered(
+                upload, image_files):
+            results[image_file] = {'success': success, 'messages': messages}
+    finally:
+        pool.close()
+        pool.join()
+    print(json.dumps(results, sort_keys=True))
+    return all(res['success'] for res in results.values())
+
+
 def gen_parameter_summary(fname):
     """Generate a parameter summary from the HRM-generated HTML file.
 
@@ -444,43 +2194,20 @@ def gen_parameter_summary(fname):
     | parameter | channel | (ignored) | value |
     -------------------------------------------
 
+    The parsing is done by ome_summary, caching the results so summaries
+    shared by many images are parsed only once.
+
     Parameters
     ==========
     fname : str - the filename of the HTML parameter summary
 
     Returns
     =======
-    str - the formatted string containing the parameter summary
+    str - the formatted string containing the parameter summary, None if the
+          file can't be read
     """
-    try:
-        from bs4 import BeautifulSoup
-    except ImportError:
-        try:
-            from BeautifulSoup import BeautifulSoup
-        except ImportError:
-            return """This file was imported via the HRM-OMERO connector.
-                   For a parameter summary, the 'BeautifulSoup' package for
-                   Python is required at import time on the HRM system.
-                   """
-    try:
-        soup = BeautifulSoup(open(fname, 'r'))
-    except IOError:
-        return None
-    summary = ''
-    for table in soup.findAll('table'):
-        rows = table.findAll('tr')
-        # the table header:
-        summary += "%s\n" % rows[0].findAll('td')[0].text
-        summary += "==============================\n"
-        # and the table body:
-        for row in rows[2:]:
-            cols = row.findAll('td')
-            summary += "%s [Ch: %s]: %s\n" % (
-                cols[0].text.replace('&mu;m', 'um').replace(u'\u03bc', 'u'),
-                cols[1].text,
-                cols[3].text)
-        summary += '\n'
-    return summary
+    import ome_summary
+    return ome_summary.CACHE.summary(fname)
 
 
 def bool_to_exitstatus(value):
@@ -497,8 +2224,18 @@ def bool_to_exitstatus(value):
         return value
 
 
-def parse_arguments():
-    """Parse the commandline arguments."""
+def add_output_arguments(parser):
+    """Add the options controlling the JSON output to a subparser."""
+    parser.add_argument(
+        '--pretty', action='store_true', default=False,
+        help='print sorted and indented JSON (for debugging)')
+    parser.add_argument(
+        '--gzip', action='store_true', default=False,
+        help='compress the output with gzip')
+
+
+def parse_arguments(argv=None):
+    """Parse the commandline arguments (sys.argv unless `argv` is given)."""
     argparser = argparse.ArgumentParser(
         description=__doc__,
         formatter_class=argparse.RawDescriptionHelpFormatter
@@ -507,13 +2244,27 @@ def parse_arguments():
         '-v', '--verbose', dest='verbosity', action='count', default=0,
         help='verbose messages (repeat for more details)')
 
+    argparser.add_argument(
+        '--profile-startup', action='store_true',
+        help='print a breakdown of the startup (import) times to stderr')
+
+    argparser.add_argument(
+        '--progress', action='store_true',
+        help='print the progress of transfers to stderr (default: only if '
+        'stderr is a terminal)')
+
+    argparser.add_argument(
+        '-s', '--socket', type=str, default=None,
+        help='Unix socket of the connector daemon (default: '
+        'OMERO_CONNECTOR_SOCKET of the HRM config)')
+
     # required arguments group
     req_args = argparser.add_argument_group(
         'required arguments', 'NOTE: MUST be given before any subcommand!')
     req_args.add_argument(
-        '-u', '--user', required=True, help='OMERO username')
+        '-u', '--user', help='OMERO username (not required for "daemon")')
     req_args.add_argument(
-        '-w', '--password', required=True, help='OMERO password')
+        '-w', '--password', help='OMERO password (not required for "daemon")')
 
     subparsers = argparser.add_subparsers(
         help='.', dest='action',
@@ -530,6 +2281,52 @@ def parse_arguments():
     parser_subtree.add_argument(
         '--id', type=str, required=True,
         help='ID string of the object to get the children for, e.g. "User:23"')
+    parser_subtree.add_argument(
+        '--refresh', action='store_true', default=False,
+        help='bypass the cache and request the nodes from OMERO')
+    parser_subtree.add_argument(
+        '--offset', type=int, default=0,
+        help='number of child nodes to skip (default: 0)')
+    parser_subtree.add_argument(
+        '--limit', type=int, default=0,
+        help='maximum number of child nodes to return, a "Pager" node is '
+        'added if there are more (default: 0, meaning no limit)')
+    parser_subtree.add_argument(
+        '--etag', action='store_true', default=False,
+        help='print the version token of the children ("ETag: ...") first')
+    parser_subtree.add_argument(
+        '--if-none-match', type=str, metavar='TOKEN',
+        help='only print "%s" (after the token) if the children still '
+        'match this version token' % NOT_MODIFIED)
+    add_output_arguments(parser_subtree)
+
+    # retrieveSubtree parser
+    parser_subtree_deep = subparsers.add_parser(
+        'retrieveSubtree',
+        help="get several levels of descendants of a node object (JSON)")
+    parser_subtree_deep.add_argument(
+        '--id', type=str, required=True,
+        help='ID string of the object to get the subtree for, e.g. '
+        '"G:23:Experimenter:42"')
+    parser_subtree_deep.add_argument(
+        '--depth', type=int, default=2,
+        help='the number of levels to fetch (default: 2)')
+    add_output_arguments(parser_subtree_deep)
+
+    # search parser
+    parser_search = subparsers.add_parser(
+        'search',
+        help='find projects, datasets and images by name or owner (JSON)')
+    parser_search.add_argument(
+        '-q', '--query', type=str, required=True,
+        help='the words to search for (matching the start of words)')
+    parser_search.add_argument(
+        '--limit', type=int, default=100,
+        help='maximum number of results (default: %(default)s, 0 for no '
+        'limit)')
+    parser_search.add_argument(
+        '--refresh', action='store_true', default=False,
+        help='update the search index from OMERO before searching')
 
     # OMEROtoHRM parser
     parser_o2h = subparsers.add_parser(
@@ -541,6 +2338,56 @@ def parse_arguments():
         '-d', '--dest', type=str, required=True,
         help='the destination directory where to put the downloaded file')
 
+    # OMEROtoHRMBatch parser
+    parser_o2hb = subparsers.add_parser(
+        'OMEROtoHRMBatch',
+        help='download multiple images from the OMERO server (JSON report)')
+    parser_o2hb.add_argument(
+        '-i', '--imageid', dest='imageids', action='append', default=[],
+        help='the OMERO ID of an image to download (may be repeated)')
+    parser_o2hb.add_argument(
+        '-m', '--manifest', type=str, required=False,
+        help='JSON file with a list of image IDs to download ("-" for stdin)')
+    parser_o2hb.add_argument(
+        '-d', '--dest', type=str, required=True,
+        help='the default destination directory for the downloaded files')
+    parser_o2hb.add_argument(
+        '-j', '--workers', type=int, default=4,
+        help='the maximum number of concurrent downloads (default: 4)')
+
+    # retrieveThumbnails parser
+    parser_thumbs = subparsers.add_parser(
+        'retrieveThumbnails',
+        help='create previews for downloaded images from their OMERO '
+        'thumbnails (JSON report)')
+    parser_thumbs.add_argument(
+        '-i', '--image', nargs=2, dest='previews', action='append',
+        default=[], metavar=('IMAGEID', 'FILE'),
+        help='the OMERO ID of an image and the file it was downloaded to '
+        '(may be repeated)')
+    parser_thumbs.add_argument(
+        '-m', '--manifest', type=str, required=False,
+        help='JSON file with a list of {"id": ..., "dest": ...} items, "dest" '
+        'being the downloaded file ("-" for stdin)')
+    parser_thumbs.add_argument(
+        '-j', '--workers', type=int, default=4,
+        help='the maximum number of concurrently written previews')
+
+    # syncDataset parser
+    parser_sync = subparsers.add_parser(
+        'syncDataset',
+        help='download the new and changed original files of a dataset '
+        '(JSON report)')
+    parser_sync.add_argument(
+        '--dset', required=True,
+        help='the ID of the dataset in OMERO, e.g. "G:7:Dataset:23"')
+    parser_sync.add_argument(
+        '-d', '--dest', type=str, required=True,
+        help='the destination directory for the files')
+    parser_sync.add_argument(
+        '-j', '--workers', type=int, default=4,
+        help='the maximum number of concurrent downloads (default: 4)')
+
     # HRMtoOMERO parser
     parser_h2o = subparsers.add_parser(
         'HRMtoOMERO', help='upload an image to the OMERO server')
@@ -556,32 +2403,514 @@ def parse_arguments():
     parser_h2o.add_argument(
         '-a', '--ann', type=str, required=False,
         help='annotation text to be added to the image in OMERO')
+    parser_h2o.add_argument(
+        '--skip-duplicates', action='store_true', default=False,
+        help='don\'t upload the file if it is already stored in the dataset '
+        '(requires hashing it)')
+
+    # daemon parser
+    parser_daemon = subparsers.add_parser(
+        'daemon', help='serve requests on the Unix socket given by --socket')
+    parser_daemon.add_argument(
+        '--max-idle', type=int, default=600,
+        help='seconds after which unused OMERO connections are closed')
+
+    # HRMtoOMEROBatch parser
+    parser_h2ob = subparsers.add_parser(
+        'HRMtoOMEROBatch',
+        help='upload multiple images to the OMERO server (JSON report)')
+    parser_h2ob.add_argument(
+        '-d', '--dset', required=True, dest='dset',
+        help='the ID of the target dataset in OMERO, e.g. "Dataset:23"')
+    parser_h2ob.add_argument(
+        '-f', '--file', dest='files', action='append', default=[],
+        help='an image file to upload, including the full path (may be '
+        'repeated)')
+    parser_h2ob.add_argument(
+        '-m', '--manifest', type=str, required=False,
+        help='JSON file with a list of image files to upload ("-" for stdin)')
+    parser_h2ob.add_argument(
+        '-j', '--workers', type=int, default=2,
+        help='the maximum number of concurrent uploads (default: 2)')
+    parser_h2ob.add_argument(
+        '--force', action='store_true', default=False,
+        help='upload all files, even those already stored in the dataset')
+
+    # enqueue parser
+    parser_enqueue = subparsers.add_parser(
+        'enqueue',
+        help='queue a transfer to be run by a worker, prints the job ID (JSON)')
+    parser_enqueue.add_argument(
+        'command', nargs=argparse.REMAINDER,
+        help='the transfer action and its arguments, e.g. '
+        '"OMEROtoHRMBatch -m manifest.json -d /dest", one of: %s'
+        % ', '.join(TRANSFER_ACTIONS))
+
+    # status parser
+    parser_status = subparsers.add_parser(
+        'status', help='get the state of queued transfers (JSON)')
+    parser_status.add_argument(
+        '--job', type=int, required=False,
+        help='the ID of the job (default: all jobs of the user)')
+
+    # cancel parser
+    parser_cancel = subparsers.add_parser(
+        'cancel', help='cancel a queued transfer that is not running yet')
+    parser_cancel.add_argument(
+        '--job', type=int, required=True, help='the ID of the job')
+
+    # worker parser
+    parser_worker = subparsers.add_parser(
+        'worker', help='run the queued transfers')
+    parser_worker.add_argument(
+        '-j', '--workers', type=int, default=None,
+        help='the number of concurrent transfers (default: '
+        'OMERO_QUEUE_WORKERS of the HRM config)')
+    parser_worker.add_argument(
+        '--once', action='store_true', default=False,
+        help='exit once the queue is empty instead of waiting for new jobs')
 
     try:
-        return argparser.parse_args()
+        args = argparser.parse_args(argv)
     except IOError as err:
         argparser.error(str(err))
+    if args.action == 'daemon':
+        if not args.socket:
+            argparser.error('the daemon requires a socket (--socket)')
+    elif args.action == 'worker':
+        pass
+    elif args.user is None or args.password is None:
+        argparser.error('arguments -u/--user and -w/--password are required')
+    if args.action == 'OMEROtoHRMBatch':
+        # the manifest is resolved here so the image list can be forwarded to
+        # a connector daemon together with the other arguments:
+        args.images = [(id_str, args.dest) for id_str in args.imageids]
+        if args.manifest is not None:
+            try:
+                manifest = load_manifest(args.manifest)
+            except (IOError, ValueError, KeyError, TypeError) as err:
+                argparser.error('invalid manifest: %s' % err)
+            args.images.extend([(id_str, dest or args.dest)
+                                for (id_str, dest) in manifest])
+            args.manifest = None
+        if not args.images:
+            argparser.error('no images given (--imageid or --manifest)')
+    if args.action == 'retrieveThumbnails':
+        if args.manifest is not None:
+            try:
+                manifest = load_manifest(args.manifest)
+            except (IOError, ValueError, KeyError, TypeError) as err:
+                argparser.error('invalid manifest: %s' % err)
+            if None in [dest for (_, dest) in manifest]:
+                argparser.error('invalid manifest: "dest" is required')
+            args.previews.extend(manifest)
+            args.manifest = None
+        if not args.previews:
+            argparser.error('no images given (--image or --manifest)')
+    if args.action == 'HRMtoOMEROBatch':
+        if args.manifest is not None:
+            try:
+                manifest = load_manifest(args.manifest)
+            except (IOError, ValueError, KeyError, TypeError) as err:
+                argparser.error('invalid manifest: %s' % err)
+            args.files.extend([fname for (fname, _) in manifest])
+            args.manifest = None
+        if not args.files:
+            argparser.error('no files given (--file or --manifest)')
+    if args.action == 'enqueue':
+        if not args.command or args.command[0] not in TRANSFER_ACTIONS:
+            argparser.error('the transfer action must be one of: %s'
+                            % ', '.join(TRANSFER_ACTIONS))
+        # parse the transfer's arguments (resolving any manifest) now, so
+        # the worker doesn't depend on files that may be gone by then:
+        request = vars(parse_arguments(
+            ['-u', args.user, '-w', args.password] + args.command))
+        for key in ['user', 'password', 'socket', 'profile_startup',
+                    'progress']:
+            del request[key]
+        args.request = request
+        args.command = None
+    return args
+
+
+def run_action(conn, args):
+    """Run the action requested in the (parsed) arguments.
 
+    Parameters
+    ==========
+    conn : omero.gateway.BlitzGateway
+    args : argparse.Namespace - the parsed commandline arguments
 
-def main():
-    """Parse commandline arguments and initiate the requested tasks."""
-    args = parse_arguments()
-
-    conn = omero_login(args.user, args.password, HOST, PORT)
-
+    Returns
+    =======
+    The return value of the corresponding action function.
+    """
     # TODO: implement requesting groups via cmdline option
-
     if args.action == 'checkCredentials':
         return check_credentials(conn)
     elif args.action == 'retrieveChildren':
-        return print_children_json(conn, args.id)
+        return print_children_json(conn, args.id, args.refresh,
+                                   args.offset, args.limit,
+                                   getattr(args, 'pretty', False),
+                                   getattr(args, 'etag', False),
+                                   getattr(args, 'if_none_match', None))
+    elif args.action == 'retrieveSubtree':
+        return print_subtree_json(conn, args.id, args.depth,
+                                  getattr(args, 'pretty', False))
     elif args.action == 'OMEROtoHRM':
         return omero_to_hrm(conn, args.imageid, args.dest)
+    elif args.action == 'OMEROtoHRMBatch':
+        return omero_to_hrm_batch(conn, args.images, args.workers)
+    elif args.action == 'syncDataset':
+        return sync_dataset(conn, args.dset, args.dest, args.workers)
+    elif args.action == 'retrieveThumbnails':
+        return retrieve_thumbnails(conn, args.previews, args.workers)
     elif args.action == 'HRMtoOMERO':
-        return hrm_to_omero(conn, args.dset, args.file)
+        return hrm_to_omero(conn, args.dset, args.file,
+                            skip_duplicates=getattr(args, 'skip_duplicates',
+                                                    False))
+    elif args.action == 'HRMtoOMEROBatch':
+        return hrm_to_omero_batch(
+            conn, args.dset, args.files, args.workers,
+            skip_duplicates=not getattr(args, 'force', False))
     else:
         raise Exception('Huh, how could this happen?!')
 
 
+def run_daemon(args):
+    """Serve connector requests on a Unix socket (see ome_daemon).
+
+    The daemon keeps one logged-in connection per set of credentials around,
+    so subsequent requests of the same user only pay for the actual query or
+    transfer. Downloaded files will be owned by the user running the daemon,
+    which therefore should be the HRM system user (SUSER in hrm.conf).
+    """
+    import ome_daemon
+    def login(user, passwd):
+        """Log in for a request not served by a pooled connection."""
+        with ome_metrics.Timer('login'):
+            return omero_login(user, passwd, HOST, PORT)
+
+    pool = ome_daemon.ConnectionPool(login, max_idle=args.max_idle)
+    stdout = ome_daemon.ThreadLocalStdout(sys.stdout)
+    sys.stdout = stdout
+
+    def dispatch(request):
+        """Process a single request forwarded by a connector client."""
+        req_args = argparse.Namespace(**request)
+        metrics = ome_metrics.start(req_args.action, req_args.user)
+        stdout.start_capture()
+        try:
+            if req_args.action == 'checkCredentials':
+                # a pooled connection doesn't prove the password is valid:
+                with ome_metrics.Timer('login'):
+                    conn = omero_login(req_args.user, req_args.password,
+                                       HOST, PORT, False)
+                try:
+                    retval = run_action(conn, req_args)
+                finally:
+                    # keep the (cached) session alive on the server:
+                    conn.close(hard=False)
+            else:
+                key, conn = pool.acquire(req_args.user, req_args.password)
+                try:
+                    retval = run_action(conn, req_args)
+                finally:
+                    pool.release(key)
+        except Exception as err:  # pylint: disable=broad-except
+            print("ERROR running '%s': %s" % (req_args.action, err))
+            retval = 1
+        output = stdout.stop_capture()
+        ome_metrics.finish(metrics, bool_to_exitstatus(retval) == 0,
+                           METRICS_LOG, METRICS_PROM)
+        return (bool_to_exitstatus(retval), output)
+
+    def reload_config():
+        """Apply changes of the HRM config without restarting the daemon."""
+        if hrm_config.CONFIG.reload():
+            load_settings()
+
+    ome_daemon.run_periodically(pool.maintain, ome_daemon.KEEPALIVE_INTERVAL)
+    ome_daemon.run_periodically(reload_config, ome_daemon.KEEPALIVE_INTERVAL)
+    return ome_daemon.serve(args.socket, dispatch)
+
+
+def transfer_queue():
+    """Open the transfer queue in the connector's cache directory."""
+    import ome_queue
+    ome_sessions.ensure_dir(CACHE_DIR)
+    return ome_queue.TransferQueue(CACHE_DIR, QUEUE_ATTEMPTS, QUEUE_BACKOFF)
+
+
+def run_queue_action(args):
+    """Enqueue a transfer, report or cancel queued transfers (see ome_queue).
+
+    These actions only access the queue database, they don't log into OMERO.
+    Only the jobs enqueued with the given password can be reported or
+    cancelled.
+    The result is printed as JSON: the ID of a new job ({"job": 42}), the list
+    of jobs (see ome_queue.TransferQueue.status()) or the result of cancelling
+    a job ({"success": ..., "message": ...}).
+    """
+    if not check_cache_dir():
+        return False
+    queue = transfer_queue()
+    try:
+        if args.action == 'enqueue':
+            job_id = queue.enqueue(args.user, args.password,
+                                   args.request['action'], args.request)
+            print(json.dumps({'job': job_id}))
+            return True
+        elif args.action == 'status':
+            jobs = queue.status(args.user, args.password, args.job)
+            print(json.dumps(jobs, sort_keys=True))
+            return args.job is None or bool(jobs)
+        success, message = queue.cancel(args.user, args.password, args.job)
+        print(json.dumps({'success': success, 'message': message},
+                         sort_keys=True))
+        return success
+    finally:
+        queue.close()
+
+
+def retry_request(request, output):
+    """Reduce the request of a failed batch transfer to the failed items.
+
+    Retrying the complete batch would fail for every image downloaded before
+    (as its target exists by then), so only the images (or files) reported
+    as failed in the JSON output of the batch are transferred again.
+
+    Parameters
+    ==========
+    request : dict - the arguments of the transfer action
+    output : str - what the action printed, the per-item results of a batch
+                   being the last line
+
+    Returns
+    =======
+    dict - the request for the retry, None to retry the request unchanged
+    (e.g. the action isn't a batch or didn't report any results)
+    """
+    if request['action'] not in ['OMEROtoHRMBatch', 'HRMtoOMEROBatch']:
+        return None
+    try:
+        results = json.loads(output.strip().splitlines()[-1])
+        failed = set(item for (item, res) in results.items()
+                     if not res['success'])
+    except (IndexError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+    retry = dict(request)
+    if request['action'] == 'OMEROtoHRMBatch':
+        retry['images'] = [(id_str, dest) for (id_str, dest)
+                           in request['images'] if id_str in failed]
+    else:
+        retry['files'] = [fname for fname in request['files']
+                          if fname in failed]
+    return retry
+
+
+def run_worker(args):
+    """Run the queued transfers (see ome_queue.run_worker()).
+
+    Like the connector daemon, the worker keeps the connections of the users
+    around for subsequent jobs, and the files are owned by the user running
+    the worker, which therefore should be the HRM system user.
+    """
+    import ome_daemon
+    import ome_queue
+    def login(user, passwd):
+        """Log in for a job not served by a pooled connection."""
+        with ome_metrics.Timer('login'):
+            return omero_login(user, passwd, HOST, PORT)
+
+    pool = ome_daemon.ConnectionPool(login)
+    stdout = capturing_stdout()
+
+    def run_job(job):
+        """Run a single transfer job, collecting its output."""
+        req_args = argparse.Namespace(**job['request'])
+        metrics = ome_metrics.start(job['action'], job['user'])
+        stdout.start_capture()
+        try:
+            key, conn = pool.acquire(job['user'], job['password'])
+            try:
+                retval = run_action(conn, req_args)
+            finally:
+                pool.release(key)
+        except Exception as err:  # pylint: disable=broad-except
+            print("ERROR running '%s': %s" % (job['action'], err))
+            retval = False
+        output = stdout.stop_capture()
+        ome_metrics.finish(metrics, bool_to_exitstatus(retval) == 0,
+                           METRICS_LOG, METRICS_PROM)
+        request = None
+        if bool_to_exitstatus(retval) != 0:
+            request = retry_request(job['request'], output)
+        return (int(bool_to_exitstatus(retval)), output, request)
+
+    if not check_cache_dir():
+        return False
+    ome_daemon.run_periodically(pool.maintain, ome_daemon.KEEPALIVE_INTERVAL)
+    workers = args.workers if args.workers is not None else QUEUE_WORKERS
+    ome_queue.run_worker(CACHE_DIR, run_job, workers, args.once,
+                         QUEUE_ATTEMPTS, QUEUE_BACKOFF)
+    return True
+
+
+def search_nodes(rows):
+    """Turn search results (see ome_search) into tree nodes."""
+    nodes = []
+    for (gid, obj_class, obj_id, name, owner) in rows:
+        node = {
+            'label': name,
+            'class': obj_class,
+            'owner': owner,
+            'id': 'G:%s:%s:%s' % (gid, obj_class, obj_id),
+            'children': [],
+        }
+        if obj_class != 'Image':
+            node['load_on_demand'] = True
+        nodes.append(node)
+    return nodes
+
+
+def refresh_in_background(user, passwd):
+    """Refresh a user's search index in a detached child process.
+
+    The child closes the standard streams, so the caller (e.g. the HRM
+    waiting for the output) doesn't have to wait for it.
+    """
+    import ome_search
+    sys.stdout.flush()
+    if os.fork() > 0:
+        return
+    # pylint: disable=protected-access,broad-except
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for stream in (0, 1, 2):
+            os.dup2(devnull, stream)
+        conn = omero_login(user, passwd, HOST, PORT)
+        if not conn.isConnected():
+            os._exit(1)
+        index = ome_search.SearchIndex(CACHE_DIR)
+        try:
+            refresh_search_index(conn, index, user, passwd)
+        finally:
+            index.close()
+    except Exception:
+        os._exit(1)
+    os._exit(0)
+
+
+def run_search(args):
+    """Search the user's index and print the matching nodes as JSON.
+
+    The search itself only uses the local index (see ome_search), OMERO is
+    only contacted to build the index on the first search of a user (or if
+    requested by --refresh). An index older than SEARCH_TTL is refreshed in
+    the background after the results have been printed.
+
+    Without a matching password (see ome_search.SearchIndex.age()) only an
+    index refreshed by this very call is searched, so if a refresh of the
+    user's index is running already this fails instead.
+    """
+    import ome_search
+    if not check_cache_dir():
+        return False
+    metrics = ome_metrics.start(args.action, args.user)
+    index = ome_search.SearchIndex(CACHE_DIR)
+    try:
+        age = index.age(args.user, args.password)
+        if age is None or args.refresh:
+            with ome_metrics.Timer('login'):
+                conn = omero_login(args.user, args.password, HOST, PORT)
+            if not conn.isConnected():
+                print('ERROR logging into OMERO.')
+                ome_metrics.finish(metrics, False, METRICS_LOG, METRICS_PROM)
+                return False
+            try:
+                refreshed = refresh_search_index(conn, index, args.user,
+                                                 args.password)
+            except Exception as err:  # pylint: disable=broad-except
+                print("ERROR: refreshing the search index failed: %s" % err)
+                ome_metrics.finish(metrics, False, METRICS_LOG, METRICS_PROM)
+                return False
+            if not refreshed and age is None:
+                print("ERROR: the search index of '%s' is being refreshed, "
+                      "please try again later." % args.user)
+                ome_metrics.finish(metrics, False, METRICS_LOG, METRICS_PROM)
+                return False
+        rows = index.search(args.user, args.query, args.limit)
+    finally:
+        index.close()
+    write_json_nodes(search_nodes(rows), sys.stdout)
+    ome_metrics.finish(metrics, True, METRICS_LOG, METRICS_PROM)
+    if age is not None and age > SEARCH_TTL and not args.refresh:
+        refresh_in_background(args.user, args.password)
+    return True
+
+
+def main():
+    """Parse commandline arguments and initiate the requested tasks."""
+    args = parse_arguments()
+    ome_startup.mark('arguments parsed')
+    load_settings()
+    if args.socket is None:
+        args.socket = SOCKET
+    ome_startup.mark('settings loaded')
+    if args.progress:
+        import ome_transfer
+        ome_transfer.PROGRESS = True
+
+    if args.action == 'daemon':
+        return run_daemon(args)
+    if args.action in ['enqueue', 'status', 'cancel']:
+        return run_queue_action(args)
+    if args.action == 'worker':
+        return run_worker(args)
+    if args.action == 'search':
+        return run_search(args)
+
+    if not getattr(args, 'gzip', False):
+        return process_request(args)
+    # compress everything printed by the action (the daemon's reply, too):
+    import gzip
+    stdout = sys.stdout
+    sys.stdout = gzip.GzipFile(filename='', mode='wb', fileobj=stdout)
+    try:
+        return process_request(args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        stdout.flush()
+
+
+def process_request(args):
+    """Run an action, through the connector daemon if one is available."""
+    # act as a thin client in case a connector daemon is running:
+    if args.socket:
+        import ome_daemon
+        request = dict(vars(args))
+        del request['socket']
+        del request['profile_startup']
+        del request['progress']
+        reply = ome_daemon.forward(args.socket, request)
+        if reply is not None:
+            retval, output = reply
+            sys.stdout.write(output)
+            return retval
+
+    metrics = ome_metrics.start(args.action, args.user)
+    with ome_metrics.Timer('login'):
+        # checking the credentials requires a real login:
+        conn = omero_login(args.user, args.password, HOST, PORT,
+                           args.action != 'checkCredentials')
+    retval = run_action(conn, args)
+    ome_metrics.finish(metrics, bool_to_exitstatus(retval) == 0,
+                       METRICS_LOG, METRICS_PROM)
+    return retval
+
+
 if __name__ == "__main__":
     sys.exit(bool_to_exitstatus(main()))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""Per-action metrics for the HRM-OMERO connector.
+
+Each connector action (e.g. "retrieveChildren" or "OMEROtoHRMBatch") gets a
+record collecting where its time is spent: logging in, querying OMERO,
+serializing the JSON response, transferring files and running the importer.
+Once the action is finished, the record is appended as a single JSON line to
+the connector log and optionally accumulated into a Prometheus textfile (to be
+picked up by the textfile collector of the node exporter).
+
+The record of the running action is kept per thread, so the connector daemon
+can serve several requests at the same time. Thread pools working for an
+action have to adopt its record (see adopt()).
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+
+# metric names, types and descriptions for the Prometheus textfile:
+PROM_METRICS = [
+    ('actions_total', 'counter', 'Number of connector actions processed.'),
+    ('action_seconds_total', 'counter', 'Time spent processing actions.'),
+    ('login_seconds_total', 'counter', 'Time spent logging into OMERO.'),
+    ('queries_total', 'counter', 'Number of queries sent to OMERO.'),
+    ('query_seconds_total', 'counter', 'Time spent on OMERO queries.'),
+    ('response_bytes_total', 'counter', 'Size of the JSON responses.'),
+    ('transfer_bytes_total', 'counter', 'Bytes downloaded from OMERO.'),
+    ('transfer_seconds_total', 'counter', 'Time spent downloading files.'),
+    ('import_seconds_total', 'counter', 'Time spent running the importer.'),
+]
+PROM_PREFIX = 'hrm_omero_'
+
+_LOCAL = threading.local()
+
+
+class ActionMetrics(object):
+
+    """The metrics collected while processing a single action."""
+
+    def __init__(self, action, user):
+        self.action = action
+        self.user = user
+        self.start = time.time()
+        self.values = dict()
+        self._lock = threading.Lock()
+
+    def add(self, name, value):
+        """Add a value to a metric (e.g. a number of bytes)."""
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def as_dict(self, success):
+        """Assemble the log record of the action."""
+        record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                  time.localtime(self.start)),
+            'action': self.action,
+            'user': self.user,
+            'pid': os.getpid(),
+            'success': bool(success),
+            'duration': round(time.time() - self.start, 6),
+        }
+        with self._lock:
+            for (name, value) in self.values.items():
+                if isinstance(value, float):
+                    value = round(value, 6)
+                record[name] = value
+        if record.get('transfer_time'):
+            record['transfer_rate'] = int(
+                record.get('transfer_bytes', 0) / record['transfer_time'])
+        return record
+
+
+class Timer(object):
+
+    """Context manager adding its duration to the metric "<name>_time".
+
+    In addition, the metric "<name>_count" is increased by one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        add(self.name + '_time', time.time() - self.start)
+        add(self.name + '_count', 1)
+
+
+class TimedService(object):
+
+    """Proxy for an OMERO service, timing every call as a query."""
+
+    def __init__(self, service, name='query'):
+        self._service = service
+        self._name = name
+
+    def __getattr__(self, attr):
+        func = getattr(self._service, attr)
+        if not callable(func):
+            return func
+
+        def timed(*args, **kwargs):
+            """Call the service method with a timer."""
+            with Timer(self._name):
+                return func(*args, **kwargs)
+        return timed
+
+
+def start(action, user):
+    """Create the metrics record for an action run by the current thread."""
+    _LOCAL.record = ActionMetrics(action, user)
+    return _LOCAL.record
+
+
+def current():
+    """Get the metrics record of the current thread (None if there's none)."""
+    return getattr(_LOCAL, 'record', None)
+
+
+def adopt(record):
+    """Collect the metrics of the current thread in an existing record.
+
+    Intended as initializer for the threads of a pool working for an action.
+    """
+    _LOCAL.record = record
+
+
+def add(name, value):
+    """Add a value to a metric of the current action, if there is one."""
+    record = current()
+    if record is not None:
+        record.add(name, value)
+
+
+def finish(record, success, logfile=None, promfile=None):
+    """Write the metrics of a finished action.
+
+    Errors writing the metrics are reported on stderr but never affect the
+    action itself.
+
+    Parameters
+    ==========
+    record : ActionMetrics - the record returned by start()
+    success : bool - the result of the action
+    logfile : str - the connector log to append a JSON line to (optional)
+    promfile : str - the Prometheus textfile to update (optional)
+    """
+    if current() is record:
+        _LOCAL.record = None
+    if not logfile and not promfile:
+        return
+    entry = record.as_dict(success)
+    try:
+        if logfile:
+            with open(logfile, 'a') as outfile:
+                outfile.write(json.dumps(entry, sort_keys=True) + '\n')
+        if promfile:
+            update_textfile(promfile, entry)
+    except (IOError, OSError, ValueError) as err:
+        sys.stderr.write("WARNING: can't write connector metrics: %s\n" % err)
+
+
+def update_textfile(promfile, entry):
+    """Accumulate the metrics of an action into a Prometheus textfile.
+
+    The counters are kept in a JSON file next to the textfile, which is
+    locked while it's updated as many connector processes may finish at the
+    same time. The textfile itself is replaced atomically.
+    """
+    action = entry['action']
+    status = 'success' if entry['success'] else 'failure'
+    increments = [
+        ('actions_total', {'action': action, 'status': status}, 1),
+        ('action_seconds_total', {'action': action}, entry['duration']),
+        ('login_seconds_total', {}, entry.get('login_time', 0)),
+        ('queries_total', {'action': action}, entry.get('query_count', 0)),
+        ('query_seconds_total', {'action': action},
+         entry.get('query_time', 0)),
+        ('response_bytes_total', {'action': action},
+         entry.get('response_bytes', 0)),
+        ('transfer_bytes_total', {}, entry.get('transfer_bytes', 0)),
+        ('transfer_seconds_total', {}, entry.get('transfer_time', 0)),
+        ('import_seconds_total', {}, entry.get('import_time', 0)),
+    ]
+    statefile = promfile + '.json'
+    with open(statefile, 'a+') as state_fh:
+        fcntl.flock(state_fh, fcntl.LOCK_EX)
+        state_fh.seek(0)
+        data = state_fh.read()
+        counters = json.loads(data) if data else dict()
+        for (name, labels, value) in increments:
+            if not value and name not in ('actions_total',
+                                          'action_seconds_total'):
+                continue
+            label_str = ','.join('%s="%s"' % item
+                                 for item in sorted(labels.items()))
+            series = counters.setdefault(name, dict())
+            series[label_str] = series.get(label_str, 0) + value
+        state_fh.seek(0)
+        state_fh.truncate()
+        state_fh.write(json.dumps(counters, sort_keys=True))
+        state_fh.flush()
+        write_textfile(promfile, counters)
+
+
+def write_textfile(promfile, counters):
+    """Render the counters in the Prometheus text format."""
+    lines = []
+    for (name, mtype, desc) in PROM_METRICS:
+        if name not in counters:
+            continue
+        lines.append('# HELP %s%s %s' % (PROM_PREFIX, name, desc))
+        lines.append('# TYPE %s%s %s' % (PROM_PREFIX, name, mtype))
+        for (label_str, value) in sorted(counters[name].items()):
+            labels = '{%s}' % label_str if label_str else ''
+            lines.append('%s%s%s %s' % (PROM_PREFIX, name, labels, value))
+    tmpname = '%s.%s' % (promfile, os.getpid())
+    with open(tmpname, 'w') as outfile:
+        outfile.write('\n'.join(lines) + '\n')
+    os.rename(tmpname, promfile)
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
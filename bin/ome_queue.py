@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+
+"""Persistent transfer queue for the HRM-OMERO connector.
+
+Transfers between OMERO and the HRM can take minutes, which is too long to
+keep a web request waiting. Instead, the HRM can enqueue a transfer and poll
+its status, while the transfers are run by a separate worker process (see the
+"worker" action of ome_hrm). The queue is a small SQLite database in the
+connector's cache directory, so it needs no additional service and survives
+restarts of both the web server and the worker.
+
+Each job stores the arguments of the connector action to run (e.g.
+"OMEROtoHRMBatch") as JSON. Failed jobs are retried with an exponential
+backoff until the maximum number of attempts is reached, a retry of a batch
+only includes the items that failed before. Workers pick the
+next job in a round-robin fashion between users, preferring users with fewer
+running jobs, so a large batch of one user doesn't block everybody else.
+
+NOTE: the worker needs the user's credentials to log into OMERO, therefore
+the password is stored in the database (only readable by its owner) until the
+job has finished or was cancelled. Reporting or cancelling a job requires the
+password it was enqueued with, which is kept as a salted hash for this (see
+ome_sessions.hash_password()).
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import binascii
+import errno
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import ome_sessions
+
+
+# default number of concurrent transfers per worker process:
+WORKERS = 2
+# default number of attempts to run a job before giving up:
+MAX_ATTEMPTS = 3
+# default delay in seconds before the first retry, doubled for every further
+# retry up to BACKOFF_MAX:
+BACKOFF = 30
+BACKOFF_MAX = 3600
+# seconds a worker waits before checking an empty queue again:
+POLL_INTERVAL = 2
+
+# the job states:
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    password TEXT,
+    pwhash TEXT,
+    action TEXT NOT NULL,
+    request TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    max_attempts INTEGER NOT NULL,
+    next_try REAL NOT NULL,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    worker INTEGER,
+    retval INTEGER,
+    output TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, next_try);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user, started);
+CREATE TABLE IF NOT EXISTS salts (
+    user TEXT PRIMARY KEY,
+    salt TEXT NOT NULL
+);
+"""
+
+# the next job to run: fewest running jobs of the same user first, then the
+# user who was served least recently, then the oldest job:
+NEXT_JOB = """
+SELECT id FROM jobs AS j WHERE state = ? AND next_try <= ?
+ORDER BY (SELECT COUNT(*) FROM jobs WHERE user = j.user AND state = ?),
+         (SELECT COALESCE(MAX(started), 0) FROM jobs WHERE user = j.user),
+         id
+LIMIT 1
+"""
+
+# the columns reported by status():
+STATUS_COLUMNS = ['id', 'action', 'state', 'attempts', 'max_attempts',
+                  'next_try', 'created', 'started', 'finished', 'retval',
+                  'output']
+
+
+def backoff_delay(attempts, backoff=BACKOFF):
+    """Get the delay in seconds before retrying a job after `attempts` runs."""
+    return min(backoff * 2 ** max(0, attempts - 1), BACKOFF_MAX)
+
+
+def process_alive(pid):
+    """Check if a process with the given PID exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        # EPERM means the process exists but belongs to somebody else:
+        return err.errno == errno.EPERM
+    return True
+
+
+class TransferQueue(object):
+
+    """The queue of transfer jobs stored in an SQLite database.
+
+    An instance must not be shared between threads, every worker thread opens
+    its own one.
+    """
+
+    def __init__(self, cache_dir, max_attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+        """Open (and create if necessary) the queue database.
+
+        Parameters
+        ==========
+        cache_dir : str - the directory for the queue database
+        max_attempts : int - the number of attempts for new jobs
+        backoff : int - seconds before the first retry of a failed job
+        """
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.dbfile = os.path.join(cache_dir, 'transfer_queue.db')
+        # transactions are handled explicitly (see claim()):
+        self._db = sqlite3.connect(self.dbfile, timeout=30,
+                                   isolation_level=None)
+        os.chmod(self.dbfile, 0600)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+        # databases from before jobs were protected by a password hash:
+        columns = [row[1] for row in
+                   self._db.execute('PRAGMA table_info(jobs)').fetchall()]
+        if 'pwhash' not in columns:
+            self._db.execute('ALTER TABLE jobs ADD COLUMN pwhash TEXT')
+
+    def _hash(self, user, passwd):
+        """Hash a password with the salt of a user (created if necessary)."""
+        self._db.execute('INSERT OR IGNORE INTO salts VALUES (?,?)',
+                         (user, binascii.hexlify(os.urandom(16))))
+        row = self._db.execute(
+            'SELECT salt FROM salts WHERE user=?', (user,)).fetchone()
+        return ome_sessions.hash_password(passwd, binascii.unhexlify(row[0]))
+
+    def enqueue(self, user, passwd, action, request):
+        """Add a job to the queue.
+
+        Parameters
+        ==========
+        user : str - the OMERO user running the transfer
+        passwd : str - the user's OMERO password
+        action : str - the connector action, e.g. "OMEROtoHRMBatch"
+        request : dict - the arguments of the action (without credentials)
+
+        Returns
+        =======
+        int - the ID of the new job
+        """
+        now = time.time()
+        cur = self._db.execute(
+            'INSERT INTO jobs (user, password, pwhash, action, request, '
+            'state, attempts, max_attempts, next_try, created) '
+            'VALUES (?,?,?,?,?,?,?,?,?,?)',
+            (user, passwd, self._hash(user, passwd), action,
+             json.dumps(request), QUEUED, 0, self.max_attempts, now, now))
+        return cur.lastrowid
+
+    def status(self, user, passwd, job_id=None):
+        """Get the state of a user's jobs, all of them if no ID is given.
+
+        Only the jobs enqueued with the given password are reported.
+
+        Returns
+        =======
+        list - a dict per job with the items listed in STATUS_COLUMNS
+        """
+        query = ('SELECT %s FROM jobs WHERE user=? AND pwhash=?' %
+                 ', '.join(STATUS_COLUMNS))
+        params = [user, self._hash(user, passwd)]
+        if job_id is not None:
+            query += ' AND id=?'
+            params.append(job_id)
+        rows = self._db.execute(query + ' ORDER BY id', params).fetchall()
+        return [dict(zip(STATUS_COLUMNS, row)) for row in rows]
+
+    def cancel(self, user, passwd, job_id):
+        """Cancel a job of a user unless it's running or finished already.
+
+        The job has to be enqueued with the given password.
+
+        Returns
+        =======
+        (bool, str) - whether the job was cancelled and a message
+        """
+        cur = self._db.execute(
+            'UPDATE jobs SET state=?, password=NULL, finished=? '
+            'WHERE id=? AND user=? AND pwhash=? AND state=?',
+            (CANCELLED, time.time(), job_id, user,
+             self._hash(user, passwd), QUEUED))
+        if cur.rowcount:
+            return (True, 'Job %s cancelled.' % job_id)
+        jobs = self.status(user, passwd, job_id)
+        if not jobs:
+            return (False, 'No job %s for user %s.' % (job_id, user))
+        return (False, "Job %s can't be cancelled, it is %s." % (
+            job_id, jobs[0]['state']))
+
+    def claim(self, worker):
+        """Take the next job that is due and mark it as running.
+
+        Parameters
+        ==========
+        worker : int - the PID of the worker process running the job
+
+        Returns
+        =======
+        dict - the job with the items 'id', 'user', 'password', 'action',
+               'request' (dict) and 'attempts', None if no job is due
+        """
+        now = time.time()
+        # lock the database right away, so no other worker claims the job:
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            row = self._db.execute(NEXT_JOB, (QUEUED, now, RUNNING)).fetchone()
+            if row is None:
+                self._db.execute('COMMIT')
+                return None
+            self._db.execute(
+                'UPDATE jobs SET state=?, started=?, worker=?, '
+                'attempts=attempts+1 WHERE id=?',
+                (RUNNING, now, worker, row[0]))
+            job = self._db.execute(
+                'SELECT id, user, password, action, request, attempts '
+                'FROM jobs WHERE id=?', (row[0],)).fetchone()
+            self._db.execute('COMMIT')
+        except:
+            self._db.execute('ROLLBACK')
+            raise
+        job = dict(zip(['id', 'user', 'password', 'action', 'request',
+                        'attempts'], job))
+        job['request'] = json.loads(job['request'])
+        return job
+
+    def complete(self, job_id, retval, output, request=None):
+        """Record the result of a job, scheduling a retry if it failed.
+
+        Parameters
+        ==========
+        job_id : int - the ID of the job
+        retval : int - the exit status of the action, 0 for success
+        output : str - what the action printed
+        request : dict - the arguments for a retry, e.g. with only the images
+                         of a batch that failed (None to retry the job as is)
+
+        Returns
+        =======
+        str - the new state of the job
+        """
+        now = time.time()
+        row = self._db.execute(
+            'SELECT attempts, max_attempts FROM jobs WHERE id=?',
+            (job_id,)).fetchone()
+        if retval != 0 and row is not None and row[0] < row[1]:
+            if request is not None:
+                self._db.execute('UPDATE jobs SET request=? WHERE id=?',
+                                 (json.dumps(request), job_id))
+            self._db.execute(
+                'UPDATE jobs SET state=?, next_try=?, retval=?, output=? '
+                'WHERE id=?',
+                (QUEUED, now + backoff_delay(row[0], self.backoff), retval,
+                 output, job_id))
+            return QUEUED
+        state = DONE if retval == 0 else FAILED
+        self._db.execute(
+            'UPDATE jobs SET state=?, finished=?, retval=?, output=?, '
+            'password=NULL WHERE id=?',
+            (state, now, retval, output, job_id))
+        return state
+
+    def recover(self):
+        """Requeue running jobs whose worker process has died.
+
+        Returns
+        =======
+        int - the number of requeued jobs
+        """
+        rows = self._db.execute(
+            'SELECT id, worker FROM jobs WHERE state=?', (RUNNING,)).fetchall()
+        dead = [job_id for (job_id, worker) in rows
+                if worker is None or not process_alive(worker)]
+        for job_id in dead:
+            self.complete(job_id, 1, 'The worker running the job has died.')
+        return len(dead)
+
+    def close(self):
+        """Close the database connection."""
+        self._db.close()
+
+
+def run_worker(cache_dir, run_job, workers=WORKERS, once=False,
+               max_attempts=MAX_ATTEMPTS, backoff=BACKOFF):
+    """Process the queued jobs with a number of threads.
+
+    Parameters
+    ==========
+    cache_dir : str - the directory of the queue database
+    run_job : function - called with a job dict (see TransferQueue.claim()),
+                         returning a tuple of the exit status (0 meaning
+                         success), the output of the job and the request to
+                         retry it with (see TransferQueue.complete())
+    workers : int - the number of jobs to run concurrently
+    once : bool - return once no job is due instead of waiting for new ones
+    max_attempts, backoff : see TransferQueue
+
+    Returns
+    =======
+    int - the number of jobs processed
+    """
+    queue = TransferQueue(cache_dir, max_attempts, backoff)
+    queue.recover()
+    queue.close()
+    processed = [0]
+    lock = threading.Lock()
+
+    def work():
+        """Claim and run jobs until stopped."""
+        queue = TransferQueue(cache_dir, max_attempts, backoff)
+        try:
+            while True:
+                job = queue.claim(os.getpid())
+                if job is None:
+                    if once:
+                        return
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                try:
+                    retval, output, request = run_job(job)
+                except Exception as err:  # pylint: disable=broad-except
+                    retval, output, request = (1, 'ERROR running job %s: %s\n'
+                                               % (job['id'], err), None)
+                queue.complete(job['id'], retval, output, request)
+                with lock:
+                    processed[0] += 1
+        finally:
+            queue.close()
+
+    threads = []
+    for num in range(max(1, workers)):
+        thread = threading.Thread(target=work, name='transfer-%s' % num)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    # join with a timeout, so the main thread still receives KeyboardInterrupt:
+    while any(thread.is_alive() for thread in threads):
+        for thread in threads:
+            thread.join(1)
+    return processed[0]
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+"""Local full-text search index over the OMERO tree of the HRM users.
+
+Finding an image by expanding the tree level by level takes one connector
+call per level. Instead, the names and owners of the projects, datasets and
+images visible to a user are kept in an SQLite full-text index (FTS4) in the
+connector's cache directory, so searching doesn't involve the OMERO server at
+all. The index is kept per OMERO user, as every user sees a different tree.
+
+The index is refreshed from a few bulk queries (see refresh_search_index() in
+ome_hrm). Projects and datasets are replaced on every refresh, while the
+images are only re-indexed for datasets whose signature (number of images,
+last link and last update of an image) has changed.
+
+Searching requires the password used for the last refresh, which is stored as
+a salted hash (see ome_sessions.hash_password()).
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import binascii
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import ome_sessions
+
+
+# default age in seconds after which an index is refreshed:
+SEARCH_TTL = 300
+# default maximum number of search results:
+MAX_RESULTS = 100
+# seconds after which an unfinished refresh is considered to have died:
+REFRESH_TIMEOUT = 600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user TEXT PRIMARY KEY,
+    salt TEXT NOT NULL,
+    pwhash TEXT NOT NULL,
+    refreshed REAL,
+    refreshing REAL
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    user TEXT NOT NULL,
+    gid TEXT NOT NULL,
+    obj_class TEXT NOT NULL,
+    obj_id INTEGER NOT NULL,
+    parent INTEGER NOT NULL,
+    name TEXT,
+    owner TEXT,
+    UNIQUE (user, gid, obj_class, obj_id, parent)
+);
+CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (user, gid, obj_class, parent);
+CREATE VIRTUAL TABLE IF NOT EXISTS nodes_fts USING fts4 (name, owner);
+CREATE TABLE IF NOT EXISTS signatures (
+    user TEXT NOT NULL,
+    gid TEXT NOT NULL,
+    dset_id INTEGER NOT NULL,
+    signature TEXT NOT NULL,
+    PRIMARY KEY (user, gid, dset_id)
+);
+"""
+
+# the order of the classes in the search results:
+CLASS_ORDER = {'Project': 0, 'Dataset': 1, 'Image': 2}
+
+
+def fts_query(text):
+    """Convert a search text into an FTS query matching all of its words.
+
+    Every word is used as a prefix, e.g. "GFP cell" will find "GFP_cells".
+    Returns None if the text contains no words at all.
+    """
+    words = re.findall(r'\w+', text, re.UNICODE)
+    if not words:
+        return None
+    return ' '.join('"%s"*' % word for word in words)
+
+
+class SearchIndex(object):
+
+    """The search index of all users, stored in an SQLite database."""
+
+    def __init__(self, cache_dir):
+        """Open (and create if necessary) the index database.
+
+        Parameters
+        ==========
+        cache_dir : str - the directory for the index database
+        """
+        self.dbfile = os.path.join(cache_dir, 'search_index.db')
+        self._db = sqlite3.connect(self.dbfile, timeout=30)
+        os.chmod(self.dbfile, 0600)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def age(self, user, passwd):
+        """Get the time since the last refresh of a user's index.
+
+        Returns
+        =======
+        float - the age in seconds, None if the user has no index or the
+                password doesn't match the one used for the last refresh
+        """
+        row = self._db.execute(
+            'SELECT salt, pwhash, refreshed FROM users WHERE user=?',
+            (user,)).fetchone()
+        if row is None or row[2] is None:
+            return None
+        salt = binascii.unhexlify(row[0])
+        if ome_sessions.hash_password(passwd, salt) != row[1]:
+            return None
+        return time.time() - row[2]
+
+    def start_refresh(self, user):
+        """Mark a user's index as being refreshed.
+
+        Returns
+        =======
+        bool - False if a refresh is running already
+        """
+        now = time.time()
+        with self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO users (user, salt, pwhash) "
+                "VALUES (?, '', '')", (user,))
+            cur = self._db.execute(
+                'UPDATE users SET refreshing=? WHERE user=? AND '
+                '(refreshing IS NULL OR refreshing < ?)',
+                (now, user, now - REFRESH_TIMEOUT))
+        return cur.rowcount > 0
+
+    def finish_refresh(self, user, passwd=None):
+        """Mark the refresh of a user's index as done (or aborted).
+
+        Parameters
+        ==========
+        user : str - the OMERO user
+        passwd : str - the password used for the refresh, None if it failed
+        """
+        with self._db:
+            if passwd is None:
+                self._db.execute(
+                    'UPDATE users SET refreshing=NULL WHERE user=?', (user,))
+                return
+            salt = os.urandom(16)
+            self._db.execute(
+                'UPDATE users SET salt=?, pwhash=?, refreshed=?, '
+                'refreshing=NULL WHERE user=?',
+                (binascii.hexlify(salt),
+                 ome_sessions.hash_password(passwd, salt), time.time(), user))
+
+    def signatures(self, user, gid):
+        """Get the stored signatures of a user's datasets in a group."""
+        rows = self._db.execute(
+            'SELECT dset_id, signature FROM signatures WHERE user=? AND gid=?',
+            (user, gid)).fetchall()
+        return dict(rows)
+
+    def groups(self, user):
+        """Get the IDs of the groups indexed for a user."""
+        rows = self._db.execute(
+            'SELECT DISTINCT gid FROM nodes WHERE user=?', (user,)).fetchall()
+        return [row[0] for row in rows]
+
+    def _delete(self, where, params):
+        """Remove nodes (and their full-text entries) matching a condition."""
+        self._db.execute(
+            'DELETE FROM nodes_fts WHERE docid IN '
+            '(SELECT rowid FROM nodes WHERE %s)' % where, params)
+        self._db.execute('DELETE FROM nodes WHERE %s' % where, params)
+
+    def _insert(self, user, gid, nodes):
+        """Add (parent, class, ID, name, owner) tuples to the index."""
+        for (parent, obj_class, obj_id, name, owner) in nodes:
+            cur = self._db.execute(
+                'INSERT OR IGNORE INTO nodes VALUES (?,?,?,?,?,?,?)',
+                (user, gid, obj_class, obj_id, parent, name, owner))
+            if cur.rowcount:
+                self._db.execute(
+                    'INSERT INTO nodes_fts (docid, name, owner) '
+                    'VALUES (?,?,?)', (cur.lastrowid, name, owner))
+
+    def update_group(self, user, gid, containers, images, signatures):
+        """Store the result of refreshing a group in a single transaction.
+
+        Parameters
+        ==========
+        user : str - the OMERO user
+        gid : str - the group ID
+        containers : list - (parent, class, ID, name, owner) tuples of all
+                            projects and datasets of the group
+        images : dict - lists of (parent, class, ID, name, owner) tuples of
+                        the images of the re-indexed datasets, with the
+                        dataset IDs as keys
+        signatures : dict - the current signatures of all datasets
+        """
+        with self._db:
+            self._delete("user=? AND gid=? AND obj_class != 'Image'",
+                         (user, gid))
+            self._insert(user, gid, containers)
+            # images of datasets that are gone or were re-indexed:
+            stored = self.signatures(user, gid)
+            for dset_id in stored:
+                if dset_id not in signatures or dset_id in images:
+                    self._delete("user=? AND gid=? AND obj_class='Image' "
+                                 "AND parent=?", (user, gid, dset_id))
+            for (dset_id, nodes) in images.items():
+                self._insert(user, gid, nodes)
+            self._db.execute(
+                'DELETE FROM signatures WHERE user=? AND gid=?', (user, gid))
+            self._db.executemany(
+                'INSERT INTO signatures VALUES (?,?,?,?)',
+                [(user, gid, dset_id, sig)
+                 for (dset_id, sig) in signatures.items()])
+
+    def drop_group(self, user, gid):
+        """Remove a group from a user's index."""
+        with self._db:
+            self._delete('user=? AND gid=?', (user, gid))
+            self._db.execute(
+                'DELETE FROM signatures WHERE user=? AND gid=?', (user, gid))
+
+    def search(self, user, text, limit=MAX_RESULTS):
+        """Find the projects, datasets and images matching a search text.
+
+        All words of the text have to match the beginning of a word in the
+        name or the owner of an object.
+
+        Returns
+        =======
+        list - (gid, class, ID, name, owner) tuples, projects first, then
+               datasets and images, each sorted by name
+        """
+        query = fts_query(text)
+        if query is None:
+            return []
+        rows = self._db.execute(
+            'SELECT DISTINCT n.gid, n.obj_class, n.obj_id, n.name, n.owner '
+            'FROM nodes_fts JOIN nodes AS n ON n.rowid = nodes_fts.docid '
+            'WHERE nodes_fts MATCH ? AND n.user = ?',
+            (query, user)).fetchall()
+        rows.sort(key=lambda row: (CLASS_ORDER.get(row[1], 3),
+                                   (row[3] or '').lower(), row[2]))
+        return rows[:limit] if limit > 0 else rows
+
+    def close(self):
+        """Close the database connection."""
+        self._db.close()
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+
+"""Per-user cache of OMERO session keys for the HRM-OMERO connector.
+
+Creating a new session on the OMERO server is the most expensive part of
+short-lived connector invocations. Instead, the session key of a previous
+login is stored on disk and subsequent invocations simply join that session.
+
+Each user has a small JSON file in the cache directory, containing the session
+key, a salted hash of the password that was used to create the session and the
+time the session was created. A cached session is only handed out if the
+supplied password matches the stored hash and the session was created within
+the configured time-to-live, which should be shorter than the idle timeout of
+the OMERO server (10 minutes by default). The lifetime is not extended by using
+the session, so a changed password or a disabled account is noticed by the
+next regular login at the latest.
+
+NOTE: a session key grants access to the OMERO account just like a password,
+therefore the cache directory and the files in it are only readable by their
+owner (the user running the web server). A cache directory that is owned by
+somebody else or accessible by others is refused (see ensure_dir()).
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import binascii
+import errno
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import hrm_config
+
+
+# default time-to-live in seconds for a cached session key:
+SESSION_TTL = 540
+# number of PBKDF2 iterations for hashing the password:
+HASH_ROUNDS = 10000
+
+
+def ensure_dir(path, mode=0700):
+    """Create a directory (including parents) unless it exists already.
+
+    The directory has to be private (see hrm_config.private_dir()), as it is
+    used for session keys, passwords and other data of the users.
+
+    Raises
+    ======
+    OSError - if the directory can't be created or is not private
+    """
+    try:
+        os.makedirs(path, mode)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    if not hrm_config.private_dir(path):
+        raise OSError(errno.EACCES, 'not a private directory (owned by the '
+                      'current user and accessible by nobody else)', path)
+    return path
+
+
+def write_atomic(fname, data, mode=0600):
+    """Write data to a file by renaming a temporary file into place.
+
+    Concurrent readers will therefore see either the old or the new content,
+    but never a partially written file.
+    """
+    dirname = os.path.dirname(fname)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp_')
+    try:
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(data)
+        os.rename(tmpname, fname)
+    except:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+
+def hash_password(passwd, salt):
+    """Derive a hex digest from a password and a (binary) salt."""
+    if isinstance(passwd, unicode):
+        passwd = passwd.encode('utf-8')
+    digest = hashlib.pbkdf2_hmac('sha256', passwd, salt, HASH_ROUNDS)
+    return binascii.hexlify(digest)
+
+
+class SessionCache(object):
+
+    """Store and look up OMERO session keys per user and server."""
+
+    def __init__(self, cache_dir, host, port, ttl=SESSION_TTL):
+        """Set up the cache.
+
+        Parameters
+        ==========
+        cache_dir : str - directory to store the session files in
+        host : str - the OMERO server hostname
+        port : int - the OMERO server port
+        ttl : int - seconds after its creation when a session is considered
+                    expired
+        """
+        self.cache_dir = ensure_dir(os.path.join(ensure_dir(cache_dir),
+                                                 'sessions'))
+        self.server = '%s:%s' % (host, port)
+        self.ttl = ttl
+
+    def _fname(self, user):
+        """Assemble the filename of a user's session file."""
+        if isinstance(user, unicode):
+            user = user.encode('utf-8')
+        name = hashlib.sha1('%s@%s' % (user, self.server)).hexdigest()
+        return os.path.join(self.cache_dir, name + '.json')
+
+    def _load(self, user):
+        """Read the session entry of a user, None if there is none."""
+        try:
+            with open(self._fname(user), 'r') as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return None
+
+    def get(self, user, passwd):
+        """Get the session key of a user if it is valid for the password.
+
+        Returns
+        =======
+        str - the session key, or None if no (valid) session is cached
+        """
+        entry = self._load(user)
+        if entry is None:
+            return None
+        if time.time() - entry.get('created', 0) > self.ttl:
+            self.drop(user)
+            return None
+        salt = binascii.unhexlify(entry['salt'])
+        if hash_password(passwd, salt) != entry['pwhash']:
+            return None
+        return entry['uuid']
+
+    def put(self, user, passwd, uuid):
+        """Store the session key for a user with the given password."""
+        salt = os.urandom(16)
+        entry = {
+            'uuid': uuid,
+            'salt': binascii.hexlify(salt),
+            'pwhash': hash_password(passwd, salt),
+            'created': time.time(),
+        }
+        write_atomic(self._fname(user), json.dumps(entry))
+
+    def drop(self, user):
+        """Remove a user's cached session (e.g. after it expired)."""
+        try:
+            os.unlink(self._fname(user))
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
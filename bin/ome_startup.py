@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Startup profiling for the HRM-OMERO connector.
+
+The connector is executed by the HRM for every single request, so the time it
+takes to start up adds to each and every click in the web interface. Running
+the connector with "--profile-startup" installs an import hook that records
+how long loading each module takes (including the modules it imports itself)
+and prints a breakdown to stderr when the process terminates.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import __builtin__
+import atexit
+import sys
+import time
+
+
+class ImportProfiler(object):
+
+    """Measure the time spent on importing modules.
+
+    Only imports actually loading new modules are recorded, the ones simply
+    returning an entry of sys.modules are negligible.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.records = []
+        self.marks = []
+        self._depth = 0
+        self._orig_import = None
+
+    def install(self, stream=sys.stderr):
+        """Hook into the import machinery, report to `stream` at exit."""
+        self._orig_import = __builtin__.__import__
+        __builtin__.__import__ = self._import
+        atexit.register(self.report, stream)
+
+    def uninstall(self):
+        """Restore the original import function."""
+        if self._orig_import is not None:
+            __builtin__.__import__ = self._orig_import
+            self._orig_import = None
+
+    def _import(self, name, *args, **kwargs):
+        """Wrapper for __import__ recording the duration of the import."""
+        known = set(sys.modules)
+        record = [self._depth, name, 0.0]
+        self.records.append(record)
+        self._depth += 1
+        start = time.time()
+        try:
+            return self._orig_import(name, *args, **kwargs)
+        finally:
+            record[2] = time.time() - start
+            self._depth -= 1
+            # Python 2 adds None entries for failed relative imports:
+            if not [mod for mod in set(sys.modules) - known
+                    if sys.modules[mod] is not None]:
+                self.records.remove(record)
+
+    def mark(self, label):
+        """Record the time (since the profiler was created) of an event."""
+        self.marks.append((label, time.time() - self.start))
+
+    def report(self, stream=sys.stderr):
+        """Print the recorded import times and marks.
+
+        The first column is the time of the import including its nested
+        imports, the second one excludes the nested imports.
+        """
+        self.uninstall()
+        lines = ["startup profile (ms, cumulative / self):"]
+        for (pos, (depth, name, duration)) in enumerate(self.records):
+            nested = 0.0
+            for (sub_depth, _, sub_duration) in self.records[pos + 1:]:
+                if sub_depth <= depth:
+                    break
+                if sub_depth == depth + 1:
+                    nested += sub_duration
+            lines.append("%8.1f %8.1f  %s%s" % (
+                duration * 1000, (duration - nested) * 1000,
+                '  ' * depth, name))
+        for (label, elapsed) in self.marks:
+            lines.append("%8.1f ms  %s" % (elapsed * 1000, label))
+        lines.append("%8.1f ms  total" % ((time.time() - self.start) * 1000))
+        stream.write('\n'.join(lines) + '\n')
+
+
+# the profiler instance used by the connector, None unless enabled:
+PROFILER = None
+
+
+def enable():
+    """Start profiling, usually as the very first thing of the connector."""
+    global PROFILER  # pylint: disable=global-statement
+    if PROFILER is None:
+        PROFILER = ImportProfiler()
+        PROFILER.install()
+    return PROFILER
+
+
+def mark(label):
+    """Record an event in case profiling is enabled."""
+    if PROFILER is not None:
+        PROFILER.mark(label)
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""Parameter summary parser for the HRM-OMERO connector.
+
+When uploading a deconvolved image to OMERO, the HTML parameter summary
+written by the HRM (the "*.parameters.txt" file) is attached to the image as
+plain text. The HTML is processed in a single pass by a tokenizer based on the
+standard library's HTMLParser, only keeping the text of the table cells,
+instead of building a complete document tree.
+
+As images deconvolved with the same settings have identical summaries, the
+results are cached per file (path, modification time and size) and per
+content, so each parameter set is only parsed once per process.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import HTMLParser
+import hashlib
+import htmlentitydefs
+import os
+import sys
+import threading
+
+
+# maximum number of summaries kept in the cache:
+CACHE_SIZE = 256
+
+
+class SummaryParser(HTMLParser.HTMLParser):
+
+    """Collect the text of the table cells of an HTML document.
+
+    After feeding the document, `tables` contains a list of tables, each
+    being a list of rows, each being a list of the cell texts. Missing end
+    tags (e.g. "</td>") are tolerated, a new cell, row or table implicitly
+    closes the previous one.
+    """
+
+    def __init__(self):
+        HTMLParser.HTMLParser.__init__(self)
+        self.tables = []
+        self._row = None
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self._close_row()
+            self.tables.append([])
+        elif tag == 'tr' and self.tables:
+            self._close_row()
+            self._row = []
+            self.tables[-1].append(self._row)
+        elif tag == 'td' and self._row is not None:
+            self._close_cell()
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if tag == 'td':
+            self._close_cell()
+        elif tag in ('tr', 'table'):
+            self._close_row()
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+    def handle_entityref(self, name):
+        if name in htmlentitydefs.name2codepoint:
+            self.handle_data(unichr(htmlentitydefs.name2codepoint[name]))
+        else:
+            self.handle_data('&%s;' % name)
+
+    def handle_charref(self, name):
+        try:
+            if name[0] in 'xX':
+                self.handle_data(unichr(int(name[1:], 16)))
+            else:
+                self.handle_data(unichr(int(name)))
+        except ValueError:
+            self.handle_data('&#%s;' % name)
+
+    def _close_cell(self):
+        """Finish the current cell, if any."""
+        if self._cell is not None:
+            self._row.append(u''.join(self._cell))
+            self._cell = None
+
+    def _close_row(self):
+        """Finish the current row (and cell), if any."""
+        self._close_cell()
+        self._row = None
+
+
+def format_summary(tables):
+    """Assemble the plain-text summary from the parsed tables.
+
+    The first row of each table contains its title, the second one is ignored
+    (column legend) and the subsequent rows have the parameter name, the
+    channel and the value in the first, second and fourth column.
+    """
+    lines = []
+    for rows in tables:
+        if not rows or not rows[0]:
+            continue
+        lines.append(rows[0][0])
+        lines.append(u"==============================")
+        for cols in rows[2:]:
+            if len(cols) < 4:
+                continue
+            name = cols[0].replace('&mu;m', 'um').replace(u'\u03bc', 'u')
+            lines.append(u"%s [Ch: %s]: %s" % (name, cols[1], cols[3]))
+        lines.append(u'')
+    if not lines:
+        return u''
+    return u'\n'.join(lines) + u'\n'
+
+
+def parse_summary(html):
+    """Convert the HTML of a parameter summary to plain text."""
+    parser = SummaryParser()
+    if not isinstance(html, unicode):
+        try:
+            html = html.decode('utf-8')
+        except UnicodeDecodeError:
+            html = html.decode('latin-1')
+    parser.feed(html)
+    parser.close()
+    return format_summary(parser.tables)
+
+
+class SummaryCache(object):
+
+    """Thread-safe cache for parsed parameter summaries.
+
+    Summaries are looked up by the file's path, modification time and size
+    first, then by the digest of its content (so copies of the same summary
+    are parsed only once, too).
+    """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self._by_file = dict()
+        self._by_digest = dict()
+        self._lock = threading.Lock()
+
+    def summary(self, fname):
+        """Get the plain-text summary of an HTML parameter summary file.
+
+        Returns
+        =======
+        unicode - the summary, None if the file can't be read
+        """
+        try:
+            info = os.stat(fname)
+            file_key = (os.path.abspath(fname), info.st_mtime, info.st_size)
+            with self._lock:
+                if file_key in self._by_file:
+                    return self._by_file[file_key]
+            with open(fname, 'rb') as infile:
+                html = infile.read()
+        except (IOError, OSError):
+            return None
+        digest = hashlib.sha1(html).hexdigest()
+        with self._lock:
+            summary = self._by_digest.get(digest)
+        if summary is None:
+            summary = parse_summary(html)
+        with self._lock:
+            if len(self._by_file) >= self.size:
+                self._by_file.clear()
+            if len(self._by_digest) >= self.size:
+                self._by_digest.clear()
+            self._by_file[file_key] = summary
+            self._by_digest[digest] = summary
+        return summary
+
+    def clear(self):
+        """Drop all cached summaries."""
+        with self._lock:
+            self._by_file.clear()
+            self._by_digest.clear()
+
+
+CACHE = SummaryCache()
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""Streaming OME-TIFF writer for the HRM-OMERO connector.
+
+Images imported into OMERO before version 5.0 have no original files, the only
+way to get them into the HRM is exporting their pixel data. The image is
+written as an uncompressed OME-TIFF with one directory (IFD) per plane, in the
+order given by the "XYZCT" dimension order. Each plane is split into strips of
+a bounded size, which are requested and written one after another, so the
+memory used doesn't depend on the size of the image. The tags of all planes
+are written at the end of the file, followed by the header pointing to them.
+
+Files that may exceed 4 GB are written as BigTIFF.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import struct
+import sys
+from xml.sax.saxutils import quoteattr
+
+
+# default maximum size in bytes of a single strip:
+STRIP_SIZE = 4 * 1024 * 1024
+# files larger than this (including some slack for the tags) use BigTIFF:
+CLASSIC_LIMIT = 2 ** 32 - 2 ** 25
+
+# bits per sample and TIFF sample format (1: unsigned, 2: signed, 3: float)
+# of the OMERO pixel types:
+PIXEL_TYPES = {
+    'int8': (8, 2),
+    'uint8': (8, 1),
+    'int16': (16, 2),
+    'uint16': (16, 1),
+    'int32': (32, 2),
+    'uint32': (32, 1),
+    'float': (32, 3),
+    'double': (64, 3),
+}
+
+# TIFF field types: (code, struct format)
+ASCII = (2, 'B')
+SHORT = (3, 'H')
+LONG = (4, 'I')
+LONG8 = (16, 'Q')
+
+OME_NS = 'http://www.openmicroscopy.org/Schemas/OME/2016-06'
+
+
+def ome_xml(name, pixel_type, sizes, physical_sizes=None, channels=None):
+    """Assemble the OME-XML metadata of an image stored in a single file.
+
+    Parameters
+    ==========
+    name : str - the image name
+    pixel_type : str - the OMERO pixel type, e.g. "uint16"
+    sizes : (x, y, z, c, t) - the dimensions of the image
+    physical_sizes : (x, y, z) - the pixel sizes in micrometers (or None)
+    channels : list - a dict per channel with the (optional) items 'name',
+                      'excitation' and 'emission' (the wavelengths in nm)
+
+    Returns
+    =======
+    str - the (UTF-8 encoded) OME-XML document
+    """
+    size_x, size_y, size_z, size_c, size_t = sizes
+    attrs = [
+        ('ID', 'Pixels:0'), ('DimensionOrder', 'XYZCT'),
+        ('Type', pixel_type), ('BigEndian', 'true'),
+        ('SizeX', size_x), ('SizeY', size_y), ('SizeZ', size_z),
+        ('SizeC', size_c), ('SizeT', size_t),
+    ]
+    for (dim, value) in zip('XYZ', physical_sizes or []):
+        if value:
+            attrs.append(('PhysicalSize' + dim, value))
+    xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+           '<OME xmlns="%s">' % OME_NS,
+           '<Image ID="Image:0" Name=%s>' % quoteattr(name),
+           '<Pixels %s>' % ' '.join('%s="%s"' % item for item in attrs)]
+    for num in range(size_c):
+        info = (channels or [])[num] if num < len(channels or []) else {}
+        ch_attrs = [('ID', '"Channel:0:%s"' % num), ('SamplesPerPixel', '"1"')]
+        if info.get('name'):
+            ch_attrs.append(('Name', quoteattr(info['name'])))
+        if info.get('excitation'):
+            ch_attrs.append(('ExcitationWavelength',
+                             '"%s"' % info['excitation']))
+        if info.get('emission'):
+            ch_attrs.append(('EmissionWavelength', '"%s"' % info['emission']))
+        xml.append('<Channel %s/>' % ' '.join('%s=%s' % item
+                                              for item in ch_attrs))
+    xml.append('<TiffData IFD="0" PlaneCount="%s"/>' %
+               (size_z * size_c * size_t))
+    xml.append('</Pixels></Image></OME>')
+    xml = ''.join(xml)
+    if isinstance(xml, unicode):
+        xml = xml.encode('utf-8')
+    return xml
+
+
+class OmeTiffWriter(object):
+
+    """Write the planes of an image as (Big)TIFF to a seekable stream.
+
+    The planes have to be written in the order of the planes() generator,
+    every plane as a sequence of strips (see strips()).
+    """
+
+    def __init__(self, stream, pixel_type, sizes, description,
+                 strip_size=STRIP_SIZE):
+        """Set up the writer and write the start of the file.
+
+        Parameters
+        ==========
+        stream : file - the output file, opened in binary mode
+        pixel_type : str - the OMERO pixel type, e.g. "uint16"
+        sizes : (x, y, z, c, t) - the dimensions of the image
+        description : str - the OME-XML stored in the first directory
+        strip_size : int - the maximum size of a strip in bytes
+        """
+        if pixel_type not in PIXEL_TYPES:
+            raise ValueError('unsupported pixel type: %s' % pixel_type)
+        self.stream = stream
+        self.bits, self.sample_format = PIXEL_TYPES[pixel_type]
+        self.size_x, self.size_y = sizes[0], sizes[1]
+        self.sizes = sizes
+        row_bytes = self.size_x * self.bits // 8
+        self.plane_bytes = row_bytes * self.size_y
+        self.rows_per_strip = max(1, min(self.size_y, strip_size // row_bytes))
+        total = self.plane_bytes * sizes[2] * sizes[3] * sizes[4]
+        self.bigtiff = total + len(description) > CLASSIC_LIMIT
+        self._planes = []
+        self._offset = 0
+        if self.bigtiff:
+            self._write(struct.pack('>2sHHHQ', 'MM', 43, 8, 0, 0))
+        else:
+            self._write(struct.pack('>2sHI', 'MM', 42, 0))
+        self._description = self._offset
+        self._desc_len = len(description) + 1
+        self._write(description + '\0')
+
+    def _write(self, data):
+        """Write data at the end of the file, keeping track of the size."""
+        self.stream.write(data)
+        self._offset += len(data)
+
+    def _align(self):
+        """Pad the file to a word boundary (required for the directories)."""
+        if self._offset % 2:
+            self._write('\0')
+
+    def planes(self):
+        """Generate the (z, c, t) indexes of the planes in the file order."""
+        size_z, size_c, size_t = self.sizes[2:]
+        for t_idx in range(size_t):
+            for c_idx in range(size_c):
+                for z_idx in range(size_z):
+                    yield (z_idx, c_idx, t_idx)
+
+    def strips(self):
+        """Generate the (first row, number of rows) of a plane's strips."""
+        for row in range(0, self.size_y, self.rows_per_strip):
+            yield (row, min(self.rows_per_strip, self.size_y - row))
+
+    def start_plane(self):
+        """Start a new plane, its strips are added with write_strip()."""
+        self._planes.append(([], []))
+
+    def write_strip(self, data):
+        """Write the (big-endian) pixel data of the next strip."""
+        offsets, counts = self._planes[-1]
+        offsets.append(self._offset)
+        counts.append(len(data))
+        self._write(data)
+
+    def close(self):
+        """Write the directories of all planes and finish the header."""
+        offset_type = LONG8 if self.bigtiff else LONG
+        arrays = []
+        for (offsets, counts) in self._planes:
+            if len(offsets) != len(counts) or not offsets:
+                raise ValueError('a plane has no strips')
+            arrays.append((self._write_array(offset_type, offsets),
+                           self._write_array(offset_type, counts)))
+        self._align()
+        first = self._offset
+        for (num, (offsets, counts)) in enumerate(arrays):
+            entries = [
+                (256, LONG, 1, self.size_x),
+                (257, LONG, 1, self.size_y),
+                (258, SHORT, 1, self.bits),
+                (259, SHORT, 1, 1),
+                (262, SHORT, 1, 1),
+            ]
+            if num == 0:
+                entries.append((270, ASCII, self._desc_len, self._description))
+            entries.extend([
+                (273, offset_type) + offsets,
+                (277, SHORT, 1, 1),
+                (278, LONG, 1, self.rows_per_strip),
+                (279, offset_type) + counts,
+                (284, SHORT, 1, 1),
+                (339, SHORT, 1, self.sample_format),
+            ])
+            last = num == len(arrays) - 1
+            self._write_ifd(entries, last)
+        self.stream.seek(8 if self.bigtiff else 4)
+        self.stream.write(struct.pack('>Q' if self.bigtiff else '>I', first))
+        self.stream.seek(0, 2)
+
+    def _write_array(self, field_type, values):
+        """Write values that don't fit into a directory entry.
+
+        Returns
+        =======
+        (count, value) - the count of the entry and either the single value
+                         itself or the offset of the array
+        """
+        if len(values) == 1:
+            return (1, values[0])
+        self._align()
+        offset = self._offset
+        self._write(struct.pack('>%s%s' % (len(values), field_type[1]),
+                                *values))
+        return (len(values), offset)
+
+    def _write_ifd(self, entries, last):
+        """Write a directory, pointing to the one written right after it."""
+        if self.bigtiff:
+            head, entry_fmt, field, size = ('>Q', '>HHQ', 8, 20)
+        else:
+            head, entry_fmt, field, size = ('>H', '>HHI', 4, 12)
+        data = [struct.pack(head, len(entries))]
+        for (tag, (code, fmt), count, value) in entries:
+            if count > 1 or code == ASCII[0]:
+                # arrays and strings are stored elsewhere, point to them:
+                fmt = 'Q' if self.bigtiff else 'I'
+            packed = struct.pack('>' + fmt, value)
+            data.append(struct.pack(entry_fmt, tag, code, count) +
+                        packed + '\0' * (field - len(packed)))
+        ifd_size = len(data[0]) + size * len(entries) + field
+        next_ifd = 0 if last else self._offset + ifd_size
+        data.append(struct.pack('>Q' if self.bigtiff else '>I', next_ifd))
+        self._write(''.join(data))
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
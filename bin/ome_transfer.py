@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+"""Download engine for original files of the HRM-OMERO connector.
+
+Files are read from OMERO in chunks through a raw file store and written to a
+temporary file next to the target ("<target>.part"). In case of an error the
+transfer is resumed from the last written offset, both within the same run
+(using a number of retries) and by a later invocation that finds the partial
+file. Once complete, the file is verified against the hash stored with the
+OriginalFile in OMERO before it gets renamed to its final name. The total
+throughput of concurrent transfers can be capped with a shared RateLimiter.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import hashlib
+import os
+import sys
+import threading
+import time
+import zlib
+
+import ome_metrics
+
+
+# default size in bytes of the chunks read from the raw file store:
+CHUNK_SIZE = 4 * 1024 * 1024
+# default number of attempts to resume a failed transfer:
+RETRIES = 3
+# interval in seconds for printing progress information:
+PROGRESS_INTERVAL = 5
+# print progress information at all (None: only if stderr is a terminal, as
+# it ends up in the web server's log otherwise):
+PROGRESS = None
+# suffix for files being downloaded:
+PART_SUFFIX = '.part'
+# default number of files of a fileset downloaded concurrently:
+WORKERS = 4
+# seconds of unused bandwidth a RateLimiter may catch up with at once:
+BURST = 1.0
+
+
+class ChecksumHasher(object):
+
+    """Incremental hasher for the 32 bit checksums OMERO may use."""
+
+    def __init__(self, func):
+        self._func = func
+        self._value = func('')
+
+    def update(self, data):
+        """Add a chunk of data to the checksum."""
+        self._value = self._func(data, self._value)
+
+    def hexdigest(self):
+        """Return the checksum as hex string."""
+        return '%08x' % (self._value & 0xffffffff)
+
+
+def new_hasher(name):
+    """Create a hasher object for an OMERO checksum algorithm name.
+
+    Parameters
+    ==========
+    name : str - the value of the OriginalFile's hasher (e.g. "SHA1-160")
+
+    Returns
+    =======
+    An object providing update() and hexdigest(), None if the algorithm is
+    unknown (or no hash is available at all).
+    """
+    if name == 'SHA1-160':
+        return hashlib.sha1()
+    elif name == 'MD5-128':
+        return hashlib.md5()
+    elif name == 'Adler-32':
+        return ChecksumHasher(zlib.adler32)
+    elif name == 'CRC-32':
+        return ChecksumHasher(zlib.crc32)
+    return None
+
+
+def format_size(nbytes):
+    """Format a number of bytes in a human readable way."""
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(nbytes) < 1024.0:
+            return '%.1f %s' % (nbytes, unit)
+        nbytes /= 1024.0
+    return '%.1f TB' % nbytes
+
+
+class Progress(object):
+
+    """Report the progress and throughput of a transfer on stderr.
+
+    The messages go to stderr as stdout is parsed by the HRM, e.g. for the
+    JSON reports of batch transfers. They are only printed if requested (see
+    PROGRESS), the throughput is recorded in the metrics in any case.
+    """
+
+    def __init__(self, name, total, offset=0, interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.total = total
+        self.done = offset
+        self.start_offset = offset
+        self.start = time.time()
+        self.interval = interval
+        self.report = PROGRESS
+        if self.report is None:
+            self.report = sys.stderr.isatty()
+        self._last = self.start
+
+    def record(self):
+        """Add the bytes and time of this run to the action's metrics."""
+        ome_metrics.add('transfer_bytes', self.done - self.start_offset)
+        ome_metrics.add('transfer_time', time.time() - self.start)
+
+    def update(self, nbytes):
+        """Account for another chunk being transferred."""
+        self.done += nbytes
+        now = time.time()
+        if self.report and now - self._last >= self.interval:
+            self._last = now
+            sys.stderr.write("%s: %s\n" % (self.name, self.status()))
+
+    def rate(self):
+        """The throughput of this run in bytes per second."""
+        elapsed = max(time.time() - self.start, 1e-6)
+        return (self.done - self.start_offset) / elapsed
+
+    def status(self):
+        """Assemble a short status text."""
+        percent = 100.0
+        if self.total:
+            percent = 100.0 * self.done / self.total
+        return "%.0f%% (%s of %s, %s/s)" % (
+            percent, format_size(self.done), format_size(self.total),
+            format_size(self.rate()))
+
+
+class RateLimiter(object):
+
+    """Limit the total throughput of the transfers of several threads.
+
+    Every thread calls consume() for the data it has transferred, which
+    blocks as long as required to keep the rate of all of them together at
+    or below the limit (allowing for bursts of BURST seconds).
+    """
+
+    def __init__(self, rate):
+        """Set up the limiter for `rate` bytes per second."""
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._until = time.time()
+
+    def consume(self, nbytes):
+        """Account for `nbytes` transferred, sleeping if over the limit."""
+        with self._lock:
+            now = time.time()
+            self._until = max(self._until, now - BURST) + nbytes / self.rate
+            delay = self._until - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def free_space(path):
+    """Get the number of bytes available to the user at a path."""
+    info = os.statvfs(path)
+    return info.f_bavail * info.f_frsize
+
+
+def check_free_space(targets):
+    """Check if the files to download fit on their file systems.
+
+    Data already downloaded to partial files is taken into account.
+
+    Parameters
+    ==========
+    targets : list - tuples of target filenames and their sizes in bytes
+
+    Returns
+    =======
+    list - (directory, required bytes, available bytes) tuples for the file
+           systems lacking space, an empty list if everything fits
+    """
+    required = dict()
+    for (target, size) in targets:
+        directory = os.path.dirname(os.path.abspath(target))
+        partial = target + PART_SUFFIX
+        if os.path.exists(partial):
+            size = max(0, size - os.path.getsize(partial))
+        device = os.stat(directory).st_dev
+        if device not in required:
+            required[device] = [directory, 0]
+        required[device][1] += size
+    lacking = []
+    for (directory, size) in sorted(required.values()):
+        available = free_space(directory)
+        if size > available:
+            lacking.append((directory, size, available))
+    return lacking
+
+
+def rfget(obj, attr, default=None):
+    """Unwrap an rtype attribute of an OMERO model object, if set."""
+    value = getattr(obj, attr, None)
+    if value is None:
+        return default
+    return value.val
+
+
+def hash_partial(fname, hasher, chunk_size):
+    """Feed the content of an existing (partial) file to a hasher."""
+    with open(fname, 'rb') as infile:
+        while True:
+            data = infile.read(chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+
+
+def download_file(client, ofile, target, chunk_size=CHUNK_SIZE,
+                  retries=RETRIES, limiter=None):
+    """Download an original file from OMERO with resume and verification.
+
+    Parameters
+    ==========
+    client : omero.client - the client of an established connection
+    ofile : omero.model.OriginalFile - the file to download, having the size,
+            hash and hasher loaded (see load_original_files() in ome_hrm)
+    target : str - the filename to store the downloaded file as
+    chunk_size : int - number of bytes to read from OMERO at a time
+    retries : int - number of attempts to resume after a failure
+    limiter : RateLimiter - shared limit for the throughput (optional)
+
+    Returns
+    =======
+    True in case the download was successful, False otherwise.
+    """
+    file_id = ofile.id.val
+    size = rfget(ofile, 'size', 0)
+    expected = rfget(ofile, 'hash')
+    hasher_name = None
+    if getattr(ofile, 'hasher', None) is not None:
+        hasher_name = rfget(ofile.hasher, 'value')
+    partial = target + PART_SUFFIX
+    if os.path.exists(partial) and os.path.getsize(partial) > size:
+        # not the file we are looking for, start over:
+        os.unlink(partial)
+
+    def resume():
+        """Get the offset to continue at and a hasher primed up to it."""
+        hasher = None
+        if expected:
+            hasher = new_hasher(hasher_name)
+        if not os.path.exists(partial):
+            return (0, hasher)
+        if hasher is not None:
+            hash_partial(partial, hasher, chunk_size)
+        return (os.path.getsize(partial), hasher)
+
+    offset, hasher = resume()
+    if offset > 0:
+        sys.stderr.write("%s: resuming at %s\n" %
+                         (os.path.basename(target), format_size(offset)))
+    progress = Progress(os.path.basename(target), size, offset)
+    attempt = 0
+    while True:
+        store = None
+        try:
+            store = client.sf.createRawFileStore()
+            store.setFileId(file_id, {'omero.group': '-1'})
+            with open(partial, 'ab') as outfile:
+                while offset < size:
+                    length = min(chunk_size, size - offset)
+                    data = store.read(offset, length)
+                    if not data:
+                        raise IOError('no data received at offset %s' % offset)
+                    outfile.write(data)
+                    if hasher is not None:
+                        hasher.update(data)
+                    offset += len(data)
+                    progress.update(len(data))
+                    if limiter is not None:
+                        limiter.consume(len(data))
+            break
+        except Exception as err:  # pylint: disable=broad-except
+            attempt += 1
+            if attempt > retries:
+                progress.record()
+                print("ERROR: downloading %s to '%s' failed at %s: %s" %
+                      (file_id, target, format_size(offset), err))
+                return False
+            # the partial file holds everything written so far, continue
+            # right after it:
+            offset, hasher = resume()
+            progress.done = offset
+            sys.stderr.write("%s: %s, retrying (%s/%s)\n" %
+                             (os.path.basename(target), err, attempt, retries))
+            time.sleep(2 ** (attempt - 1))
+        finally:
+            if store is not None:
+                try:
+                    store.close()
+                except Exception:  # pylint: disable=broad-except
+                    pass
+    progress.record()
+    if hasher is not None:
+        actual = hasher.hexdigest()
+        if actual.lower() != expected.lower():
+            print("ERROR: checksum mismatch for '%s' (%s: expected %s, got %s)!"
+                  % (target, hasher_name, expected, actual))
+            os.unlink(partial)
+            return False
+    elif expected:
+        print("WARNING: can't verify '%s', unsupported checksum type '%s'."
+              % (target, hasher_name))
+    os.rename(partial, target)
+    print("ID %s downloaded as '%s' (%s, %s/s)" % (
+        file_id, os.path.basename(target), format_size(size),
+        format_size(progress.rate())))
+    return True
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
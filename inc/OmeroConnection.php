@@ -53,6 +53,46 @@ class OmeroConnection
      */
     private $nodeChildren = array();
 
+    /**
+     * Version tokens (ETags) of the children in $nodeChildren.
+     *
+     * @var array
+     */
+    private $nodeETags = array();
+
+    /**
+     * Children from before the last refresh of the tree.
+     *
+     * These are revalidated with their ETag when requested again, so nodes
+     * that didn't change don't have to be listed by the connector again.
+     * Nodes without an ETag are requested from the OMERO server instead of
+     * the shared cache of the connector. Either way, a node is removed from
+     * here once it has been fetched again.
+     *
+     * @var array
+     */
+    private $staleNodes = array();
+
+    /**
+     * Maximum number of child nodes to request at once.
+     *
+     * Containers with more children get a 'Pager' node appended by the
+     * connector, expanding it loads the next page.
+     *
+     * @var int
+     */
+    private $nodePageSize = 500;
+
+    /**
+     * Number of levels to prefetch when expanding a user node.
+     *
+     * With the default of 2 the projects and their datasets are loaded at
+     * once, the images of the datasets are still loaded on demand.
+     *
+     * @var int
+     */
+    private $subtreeDepth = 2;
+
 
     /**
      * OmeroConnection constructor.
@@ -122,25 +162,41 @@ class OmeroConnection
         $selected = json_decode($images, true);
         $fail = "";
         $done = "";
+        // all images are requested with a single connector call, which
+        // reports the result for each of them as a JSON object on the last
+        // line of its output:
+        $param = array("--dest", $fileServer->sourceFolder());
         foreach ($selected as $img) {
-            $fileAndPath = $fileServer->sourceFolder() . "/" . $img['name'];
-            $param = array("--imageid", $img{'id'}, "--dest", $fileAndPath);
-            $cmd = $this->buildCmd("OMEROtoHRM", $param);
-
-            $this->omelog('requesting ' . $img['id'] . ' to ' . $fileAndPath);
-            // somehow exec() seems to append to $out instead of overwriting
-            // it, so we create an empty array for it explicitly:
-            $out = array();
-            exec($cmd, $out, $retval);
-            $this->omelog(implode(' ', $out));
-            if ($retval != 0) {
-                $this->omelog("failed retrieving " . $img['id'], 1);
-                $this->omelog("ERROR: downloadFromOMERO(): " . implode(' ', $out), 2);
-                $fail .= "<br/>" . $img['id'] . "&nbsp;&nbsp;&nbsp;&nbsp;";
+            array_push($param, "--imageid", $img['id']);
+        }
+        $cmd = $this->buildCmd("OMEROtoHRMBatch", $param);
+
+        $this->omelog('requesting ' . count($selected) . ' image(s) to ' .
+            $fileServer->sourceFolder());
+        exec($cmd, $out, $retval);
+        $results = json_decode(end($out), true);
+        if (!is_array($results)) {
+            $this->omelog("ERROR: downloadFromOMERO(): " . implode(' ', $out), 2);
+            $results = array();
+        }
+        foreach ($selected as $img) {
+            $id = $img['id'];
+            if (!isset($results[$id])) {
+                $this->omelog("failed retrieving " . $id, 1);
+                $fail .= "<br/>" . $id . "&nbsp;&nbsp;&nbsp;&nbsp;";
                 $fail .= "[" . implode(' ', $out) . "]<br/>";
+                continue;
+            }
+            $messages = $results[$id]['messages'];
+            $this->omelog(implode(' ', $messages));
+            if (!$results[$id]['success']) {
+                $this->omelog("failed retrieving " . $id, 1);
+                $this->omelog("ERROR: downloadFromOMERO(): " . implode(' ', $messages), 2);
+                $fail .= "<br/>" . $id . "&nbsp;&nbsp;&nbsp;&nbsp;";
+                $fail .= "[" . implode(' ', $messages) . "]<br/>";
             } else {
-                $this->omelog("successfully retrieved " . $img['id'], 1);
-                $done .= "<br/>" . implode('<br/>', $out) . "<br/>";
+                $this->omelog("successfully retrieved " . $id, 1);
+                $done .= "<br/>" . implode('<br/>', $messages) . "<br/>";
             }
         }
         // build the return message:
@@ -183,32 +239,47 @@ class OmeroConnection
 
         $datasetId = $postedParams['OmeDatasetId'];
 
-        /* Export all the selected files. */
+        /* Export all the selected files with a single connector call. */
         $fail = "";
         $done = "";
+        $param = array("--dset", $datasetId);
         foreach ($selectedFiles as $file) {
             // TODO: check if $file may contain relative paths!
             $fileAndPath = $fileServer->destinationFolder() . "/" . $file;
-            $param = array("--file", $fileAndPath, "--dset", $datasetId);
-            $cmd = $this->buildCmd("HRMtoOMERO", $param);
+            array_push($param, "--file", $fileAndPath);
+        }
+        $cmd = $this->buildCmd("HRMtoOMEROBatch", $param);
 
-            $this->omelog('uploading "' . $fileAndPath . '" to dataset ' . $datasetId);
-            // somehow exec() seems to append to $out instead of overwriting
-            // it, so we create an empty array for it explicitly:
-            $out = array();
-            exec($cmd, $out, $retval);
-            if ($retval != 0) {
-                $this->omelog("failed uploading file to OMERO: " . $file, 1);
-                $this->omelog("ERROR: uploadToOMERO(): " . implode(' ', $out), 2);
-                $fail .= "<br/>" . $file . "&nbsp;&nbsp;&nbsp;&nbsp;";
-                $fail .= "[" . implode(' ', $out) . "]<br/>";
-            } else {
+        $this->omelog('uploading ' . count($selectedFiles) .
+            ' file(s) to dataset ' . $datasetId);
+        exec($cmd, $out, $retval);
+        // the per-file results are reported as JSON on the last output line:
+        $results = json_decode(end($out), true);
+        if (!is_array($results)) {
+            $this->omelog("ERROR: uploadToOMERO(): " . implode(' ', $out), 2);
+            $results = array();
+        }
+        foreach ($selectedFiles as $file) {
+            $fileAndPath = $fileServer->destinationFolder() . "/" . $file;
+            if (isset($results[$fileAndPath])
+                && $results[$fileAndPath]['success']) {
                 $this->omelog("success uploading file to OMERO: " . $file, 2);
                 $done .= "<br/>" . $file;
+                continue;
             }
+            if (isset($results[$fileAndPath])) {
+                $messages = $results[$fileAndPath]['messages'];
+            } else {
+                $messages = $out;
+            }
+            $this->omelog("failed uploading file to OMERO: " . $file, 1);
+            $this->omelog("ERROR: uploadToOMERO(): " . implode(' ', $messages), 2);
+            $fail .= "<br/>" . $file . "&nbsp;&nbsp;&nbsp;&nbsp;";
+            $fail .= "[" . implode(' ', $messages) . "]<br/>";
         }
-        // reload the OMERO tree:
-        $this->resetNodes();
+        // only the target dataset has changed, the connector has invalidated
+        // its cached node already so we simply drop our own copy:
+        unset($this->nodeChildren[$datasetId]);
         // build the return message:
         $msg = "";
         if ($done != "") {
@@ -277,15 +348,40 @@ class OmeroConnection
     public function getChildren($id)
     {
         if (!isset($this->nodeChildren[$id])) {
-            $param = array('--id', $id);
-            $cmd = $this->buildCmd("retrieveChildren", $param);
+            if (strpos($id, ':Experimenter:') !== FALSE) {
+                // fetch a user's projects together with their datasets, so
+                // browsing them doesn't require any further requests:
+                $param = array('--id', $id, '--depth', $this->subtreeDepth);
+                $cmd = $this->buildCmd("retrieveSubtree", $param);
+            } else {
+                $param = array('--id', $id, '--limit', $this->nodePageSize);
+                if (isset($this->staleNodes[$id], $this->nodeETags[$id])) {
+                    // the connector's cache is keyed by the token, so this
+                    // never returns outdated nodes:
+                    array_push($param, '--if-none-match',
+                        $this->nodeETags[$id]);
+                } else {
+                    array_push($param, '--etag');
+                    if (array_key_exists($id, $this->staleNodes)) {
+                        array_push($param, '--refresh');
+                    }
+                }
+                $cmd = $this->buildCmd("retrieveChildren", $param);
+            }
             exec($cmd, $out, $retval);
             if ($retval != 0) {
                 $this->omelog("ERROR: getChildren(): " . implode(' ', $out), 1);
                 return FALSE;
+            }
+            if (count($out) > 0 && strpos($out[0], 'ETag: ') === 0) {
+                $this->nodeETags[$id] = substr(array_shift($out), 6);
+            }
+            if (count($out) == 1 && $out[0] == 'NOT MODIFIED') {
+                $this->nodeChildren[$id] = $this->staleNodes[$id];
             } else {
                 $this->nodeChildren[$id] = implode(' ', $out);
             }
+            unset($this->staleNodes[$id]);
         }
         return $this->nodeChildren[$id];
     }
@@ -293,11 +389,15 @@ class OmeroConnection
     /**
      * Reset the array keeping the node data.
      *
-     * This is useful to refresh the tree, as all calls to getChildren() will
-     * then request up-to-date information from OMERO.
+     * This is useful to refresh the tree, as the next call to getChildren()
+     * for any of the nodes will then request up-to-date information from
+     * OMERO (bypassing the cache of the connector). Nodes having an ETag are
+     * only revalidated, which is a single small query if they didn't change.
      */
     public function resetNodes()
     {
+        $this->staleNodes = array_merge($this->staleNodes,
+            $this->nodeChildren);
         $this->nodeChildren = array();
     }
 
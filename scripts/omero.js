@@ -69,7 +69,12 @@ function getSelectedDataset() {
     // dataset in case an image is selected
     var node = $("#omeroTree").tree('getSelectedNode');
     if (node.class == 'Image') {
-        return node.parent.id;
+        // images of large datasets may be nested in 'Pager' nodes:
+        var parent = node.parent;
+        while (parent.class == 'Pager') {
+            parent = parent.parent;
+        }
+        return parent.id;
     } else if (node.class = 'Dataset') {
         return node.id;
     } else {
@@ -100,6 +105,10 @@ function processNodeHTML(node, li) {
     };
     var context = li.find('.jqtree-element').context;
     var orig = context.innerHTML;
+    if (!(node.class in icons)) {
+        // e.g. 'Pager' nodes to load the next page of a large container
+        return;
+    }
     var css_class = 'jqtree-' + node.class;
     var icon = '<img class="' + css_class
         + '" src="' + icons[node.class] + '"> ';
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""Offline benchmarks for the HRM-OMERO connector.
+
+Measures the tree generation, the JSON serialization, the download throughput
+and the parameter summary of the connector (bin/ome_hrm.py) against an
+in-process fake OMERO server (see fake_gateway), so no OMERO installation, no
+server and no HRM config file are required. Run it from any directory:
+
+$ python bench_connector.py [--latency 2] [--images 50] [--json results.json]
+
+To catch regressions, save the results of a reference run with "--json" and
+compare later runs against it with "--baseline", the exit status is non-zero
+in case any benchmark got slower by more than the given tolerance:
+
+$ python bench_connector.py --baseline results.json --tolerance 0.25
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import fake_gateway
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', '..', '..', 'bin')
+
+
+class NullWriter(object):
+
+    """Swallow everything written to it (the connector's messages)."""
+
+    def write(self, data):
+        """Discard the data."""
+        pass
+
+    def flush(self):
+        """Nothing to flush."""
+        pass
+
+
+def setup_connector(workdir):
+    """Import the connector with a minimal config and the fake OMERO."""
+    conf = os.path.join(workdir, 'hrm.conf')
+    with open(conf, 'w') as outfile:
+        outfile.write('OMERO_PKG="%s"\n' % workdir)
+        outfile.write('OMERO_HOSTNAME="localhost"\n')
+        outfile.write('OMERO_CONNECTOR_CACHE="%s"\n' % workdir)
+    os.environ['HRM_CONFIG_FILE'] = conf
+    os.environ['HRM_CONFIG_CACHE'] = ''
+    os.environ['HRM_CONFIG_SET_OMERO_TREE_CACHE_TTL'] = '0'
+    fake_gateway.install_fake_omero()
+    sys.path.insert(0, BIN_DIR)
+    import ome_hrm
+    ome_hrm.load_settings()
+    return ome_hrm
+
+
+def gen_summary_html(fname, rows):
+    """Write a parameter summary like the ones generated by the HRM."""
+    with open(fname, 'w') as outfile:
+        outfile.write('<html><body>\n')
+        for title in ['Image parameters', 'Restoration parameters',
+                      'Analysis parameters']:
+            outfile.write('<table>\n<tr><td colspan="4">%s</td></tr>\n'
+                          '<tr><td>Parameter</td><td>Channel</td>'
+                          '<td>Source</td><td>Value</td></tr>\n' % title)
+            for num in range(rows):
+                outfile.write(
+                    '<tr><td>Parameter %s (&mu;m)</td><td>%s</td>'
+                    '<td>User</td><td>%s.5</td></tr>\n' % (num, num % 4, num))
+            outfile.write('</table>\n')
+        outfile.write('</body></html>\n')
+
+
+def run(func, repeat):
+    """Call func() `repeat` times with stdout silenced, return the times."""
+    times = []
+    stdout = sys.stdout
+    sys.stdout = NullWriter()
+    try:
+        for _ in range(repeat):
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+    finally:
+        sys.stdout = stdout
+    return times
+
+
+def median(values):
+    """The median of a list of numbers."""
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def benchmarks(ome_hrm, server, workdir, args):
+    """Assemble the benchmarks as (name, function, units, unit name) tuples.
+
+    The units are the number of items processed per call, e.g. nodes or
+    bytes, to report a throughput in addition to the latency.
+    """
+    conn = fake_gateway.FakeGateway(server)
+    gid = server.groups[1].id.val
+    user_id = server.users[0].id.val
+    proj = server.by_parent[('Project', user_id)][0]
+    dset = server.by_parent[('Dataset', proj.oid)][0]
+    user_node = 'G:%s:Experimenter:%s' % (gid, user_id)
+    dset_node = 'G:%s:Dataset:%s' % (gid, dset.oid)
+    subtree = ome_hrm.gen_subtree(conn, user_node, 3)
+    dset_etag = ome_hrm.node_etag(conn, dset_node)
+    images = server.by_parent[('Image', dset.oid)][:args.downloads]
+    summary = os.path.join(workdir, 'summary.html')
+    gen_summary_html(summary, args.summary_rows)
+    # a dataset mirrored once, for measuring a sync without changes:
+    mirror = os.path.join(workdir, 'mirror')
+    os.makedirs(os.path.join(mirror, 'hrm_previews'))
+    ome_hrm.CACHE_DIR = workdir
+    run(lambda: ome_hrm.sync_dataset(conn, dset_node, mirror), 1)
+    # the search index of the first user:
+    user = server.users[0].omeName.val
+    import ome_search
+    index = ome_search.SearchIndex(workdir)
+    ome_hrm.refresh_search_index(conn, index, user, 'secret')
+
+    def download():
+        """Download a number of images into a fresh directory."""
+        dest = tempfile.mkdtemp(dir=workdir)
+        os.mkdir(os.path.join(dest, 'hrm_previews'))
+        try:
+            for image in images:
+                if not ome_hrm.omero_to_hrm(
+                        conn, 'G:%s:Image:%s' % (gid, image.oid), dest):
+                    raise RuntimeError('download of image %s failed'
+                                       % image.oid)
+        finally:
+            shutil.rmtree(dest)
+
+    def export():
+        """Export an image as OME-TIFF (the fallback without a fileset)."""
+        tgt = os.path.join(workdir, 'export.ome.tif')
+        try:
+            if not ome_hrm.export_ome_tiff(conn, images[0].oid, tgt):
+                raise RuntimeError('export of image %s failed'
+                                   % images[0].oid)
+        finally:
+            if os.path.exists(tgt):
+                os.unlink(tgt)
+
+    def uncached_summary():
+        """Parse the parameter summary, bypassing the cache."""
+        import ome_summary
+        ome_summary.CACHE.clear()
+        return ome_hrm.gen_parameter_summary(summary)
+
+    benches = [
+        ('gen_base_tree', lambda: ome_hrm.gen_base_tree(conn),
+         len(server.groups) - 1, 'groups'),
+        ('gen_base_tree_per_group',
+         lambda: ome_hrm.gen_base_tree_per_group(conn),
+         len(server.groups) - 1, 'groups'),
+        ('gen_children (user)', lambda: ome_hrm.gen_children(conn, user_node),
+         args.projects, 'nodes'),
+        ('gen_children (dataset)',
+         lambda: ome_hrm.gen_children(conn, dset_node),
+         args.images, 'nodes'),
+        ('gen_children (dataset, paged)',
+         lambda: ome_hrm.gen_children(conn, dset_node, 0, args.page_size),
+         min(args.page_size, args.images), 'nodes'),
+        ('retrieveChildren (not modified)',
+         lambda: ome_hrm.print_children_json(conn, dset_node,
+                                             if_none_match=dset_etag),
+         args.images, 'nodes'),
+        ('gen_subtree (user, depth 3)',
+         lambda: ome_hrm.gen_subtree(conn, user_node, 3),
+         args.projects * args.datasets * (args.images + 1), 'nodes'),
+        ('tree_to_json (user subtree)',
+         lambda: ome_hrm.tree_to_json(subtree),
+         args.projects * args.datasets * (args.images + 1), 'nodes'),
+        ('write_json_nodes (user subtree)',
+         lambda: ome_hrm.write_json_nodes(subtree, NullWriter()),
+         args.projects * args.datasets * (args.images + 1), 'nodes'),
+        ('omero_to_hrm', download, len(images) * server.file_size, 'bytes'),
+        ('export_ome_tiff', export, fake_gateway.image_bytes(), 'bytes'),
+        ('sync_dataset (up to date)',
+         lambda: ome_hrm.sync_dataset(conn, dset_node, mirror),
+         args.images, 'images'),
+        ('refresh_search_index (unchanged)',
+         lambda: ome_hrm.refresh_search_index(conn, index, user, 'secret'),
+         len(server.groups) - 1, 'groups'),
+        ('search (index)', lambda: index.search(user, 'image_0012 user'),
+         1, 'queries'),
+        ('gen_parameter_summary', uncached_summary,
+         3 * args.summary_rows, 'rows'),
+        ('gen_parameter_summary (cached)',
+         lambda: ome_hrm.gen_parameter_summary(summary),
+         3 * args.summary_rows, 'rows'),
+    ]
+    return benches
+
+
+def format_rate(units, seconds, unit_name):
+    """Format a throughput, bytes are reported in MB/s."""
+    if seconds <= 0:
+        return '-'
+    if unit_name == 'bytes':
+        return '%.1f MB/s' % (units / seconds / 1024.0 / 1024.0)
+    return '%.0f %s/s' % (units / seconds, unit_name)
+
+
+def compare(results, baseline, tolerance):
+    """Compare the median times to a baseline, return the regressions."""
+    regressions = []
+    for (name, res) in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ref = baseline[name]['median']
+        if ref > 0 and res['median'] > ref * (1 + tolerance):
+            regressions.append((name, ref, res['median']))
+    return regressions
+
+
+def parse_arguments():
+    """Parse the commandline arguments."""
+    argparser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--groups', type=int, default=3,
+                           help='number of groups (besides "user")')
+    argparser.add_argument('--users', type=int, default=5,
+                           help='number of users (members of all groups)')
+    argparser.add_argument('--projects', type=int, default=2,
+                           help='projects per user and group')
+    argparser.add_argument('--datasets', type=int, default=3,
+                           help='datasets per project')
+    argparser.add_argument('--images', type=int, default=200,
+                           help='images per dataset')
+    argparser.add_argument('--file-size', type=int, default=4 * 1024 * 1024,
+                           help='size of the original files in bytes')
+    argparser.add_argument('--latency', type=float, default=0.0,
+                           help='latency of every server call in ms')
+    argparser.add_argument('--page-size', type=int, default=50,
+                           help='page size for the paged children query')
+    argparser.add_argument('--downloads', type=int, default=5,
+                           help='number of images to download per run')
+    argparser.add_argument('--summary-rows', type=int, default=50,
+                           help='rows per table of the parameter summary')
+    argparser.add_argument('-r', '--repeat', type=int, default=5,
+                           help='number of runs per benchmark')
+    argparser.add_argument('--json', type=str,
+                           help='write the results to this file')
+    argparser.add_argument('--baseline', type=str,
+                           help='results of a previous run to compare with')
+    argparser.add_argument('--tolerance', type=float, default=0.2,
+                           help='allowed slowdown relative to the baseline')
+    return argparser.parse_args()
+
+
+def main():
+    """Run the benchmarks, report and compare the results."""
+    args = parse_arguments()
+    workdir = tempfile.mkdtemp(prefix='hrm_omero_bench_')
+    try:
+        ome_hrm = setup_connector(workdir)
+        server = fake_gateway.FakeServer(
+            args.groups, args.users, args.projects, args.datasets,
+            args.images, args.file_size, args.latency / 1000.0)
+        results = dict()
+        print("%-32s %10s %10s %10s  %s" % (
+            'benchmark', 'min', 'median', 'max', 'throughput (median)'))
+        for (name, func, units, unit_name) in benchmarks(ome_hrm, server,
+                                                         workdir, args):
+            times = run(func, args.repeat)
+            results[name] = {'min': min(times), 'median': median(times),
+                             'max': max(times)}
+            print("%-32s %8.2fms %8.2fms %8.2fms  %s" % (
+                name, min(times) * 1000, median(times) * 1000,
+                max(times) * 1000,
+                format_rate(units, median(times), unit_name)))
+    finally:
+        shutil.rmtree(workdir)
+
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(results, outfile, indent=4, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+        regressions = compare(results, baseline, args.tolerance)
+        for (name, ref, now) in regressions:
+            print("REGRESSION: %s took %.2fms (baseline %.2fms)" % (
+                name, now * 1000, ref * 1000))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""Compare the parameter summary parser with the former BeautifulSoup code.
+
+Generates HRM-like HTML parameter summaries of increasing size, checks that
+the streaming parser of the connector (bin/ome_summary.py) produces the same
+text as the BeautifulSoup based implementation it replaced and reports the
+time of both, as well as the time for a cached lookup. BeautifulSoup is only
+required for the comparison, without it just the new parser is measured:
+
+$ python bench_summary.py [--rows 50 500 5000] [--repeat 5]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', '..', '..', 'bin')
+sys.path.insert(0, BIN_DIR)
+
+import ome_summary
+from bench_connector import gen_summary_html, median
+
+
+def summary_beautifulsoup(fname, soup_class):
+    """The former implementation of gen_parameter_summary() in ome_hrm."""
+    try:
+        soup = soup_class(open(fname, 'r'))
+    except IOError:
+        return None
+    summary = ''
+    for table in soup.findAll('table'):
+        rows = table.findAll('tr')
+        # the table header:
+        summary += "%s\n" % rows[0].findAll('td')[0].text
+        summary += "==============================\n"
+        # and the table body:
+        for row in rows[2:]:
+            cols = row.findAll('td')
+            summary += "%s [Ch: %s]: %s\n" % (
+                cols[0].text.replace('&mu;m', 'um').replace(u'\u03bc', 'u'),
+                cols[1].text,
+                cols[3].text)
+        summary += '\n'
+    return summary
+
+
+def import_beautifulsoup():
+    """Get the BeautifulSoup class, None if it's not installed."""
+    try:
+        from bs4 import BeautifulSoup
+    except ImportError:
+        try:
+            from BeautifulSoup import BeautifulSoup
+        except ImportError:
+            return None
+    return BeautifulSoup
+
+
+def timed(func, repeat):
+    """Run func() `repeat` times, return the last result and median time."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        times.append(time.time() - start)
+    return (result, median(times))
+
+
+def main():
+    """Run the comparison for all requested summary sizes."""
+    argparser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--rows', type=int, nargs='+',
+                           default=[50, 500, 5000],
+                           help='rows per table of the generated summaries')
+    argparser.add_argument('-r', '--repeat', type=int, default=5,
+                           help='number of runs per measurement')
+    args = argparser.parse_args()
+
+    soup_class = import_beautifulsoup()
+    if soup_class is None:
+        print("BeautifulSoup is not installed, skipping the comparison.")
+    workdir = tempfile.mkdtemp(prefix='hrm_summary_bench_')
+    retval = 0
+    print("%8s %10s %12s %12s %12s %8s" % (
+        'rows', 'size', 'streaming', 'cached', 'soup', 'speedup'))
+    try:
+        for rows in args.rows:
+            fname = os.path.join(workdir, 'summary_%s.html' % rows)
+            gen_summary_html(fname, rows)
+
+            def parse():
+                """Parse the summary, bypassing the cache."""
+                ome_summary.CACHE.clear()
+                return ome_summary.CACHE.summary(fname)
+
+            new, t_new = timed(parse, args.repeat)
+            _, t_cached = timed(lambda: ome_summary.CACHE.summary(fname),
+                                args.repeat)
+            t_soup = None
+            if soup_class is not None:
+                old, t_soup = timed(
+                    lambda: summary_beautifulsoup(fname, soup_class),
+                    args.repeat)
+                if old != new:
+                    print("ERROR: the summaries for %s rows differ!" % rows)
+                    retval = 1
+            print("%8s %9.0fk %10.2fms %10.3fms %12s %8s" % (
+                rows, os.path.getsize(fname) / 1024.0, t_new * 1000,
+                t_cached * 1000,
+                '%.2fms' % (t_soup * 1000) if t_soup else '-',
+                '%.1fx' % (t_soup / t_new) if t_soup else '-'))
+    finally:
+        shutil.rmtree(workdir)
+    return retval
+
+
+if __name__ == "__main__":
+    sys.exit(main())
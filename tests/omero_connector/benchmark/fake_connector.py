@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+"""Run the HRM-OMERO connector against the fake OMERO server.
+
+Takes the same arguments as bin/ome_hrm.py and runs it as a separate process,
+just like the HRM does, but with the OMERO bindings replaced by fake_gateway.
+This is used by the load test (see load_connector.py), which sets these
+environment variables:
+
+- HRM_CONFIG_FILE: the HRM config to use (see bench_connector.setup_connector)
+- FAKE_OMERO_SERVER: the arguments of fake_gateway.FakeServer as a JSON list
+- FAKE_OMERO_LOGIN: the latency of a login in ms (optional)
+
+Every process builds the same synthetic model, so the object IDs are known to
+the caller. Changes (e.g. uploads) are not shared between processes.
+"""
+
+import json
+import os
+import sys
+import time
+
+import fake_gateway
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', '..', '..', 'bin')
+
+
+def main():
+    """Run the connector with the fake OMERO server."""
+    fake_gateway.install_fake_omero()
+    sys.path.insert(0, BIN_DIR)
+    import ome_hrm
+    server = fake_gateway.FakeServer(
+        *json.loads(os.environ['FAKE_OMERO_SERVER']))
+    login_latency = float(os.environ.get('FAKE_OMERO_LOGIN', 0)) / 1000.0
+    users = dict((user.omeName.val, user) for user in server.users)
+
+    def omero_login(user, passwd, host, port, cached=True):
+        # pylint: disable=unused-argument
+        """Log into the fake server (every password is accepted)."""
+        if user not in users:
+            raise ValueError('unknown user: %s' % user)
+        time.sleep(login_latency)
+        return fake_gateway.FakeGateway(server, users[user])
+
+    ome_hrm.omero_login = omero_login
+    return ome_hrm.bool_to_exitstatus(ome_hrm.main())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
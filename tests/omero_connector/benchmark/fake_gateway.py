@@ -0,0 +1,837 @@
+#!/usr/bin/env python
+
+"""In-process stand-in for an OMERO server and the BlitzGateway.
+
+Provides just enough of the OMERO Python API to run the tree and transfer
+functions of the HRM-OMERO connector (bin/ome_hrm.py) without a server:
+
+- a synthetic data model (groups, users, projects, datasets, images and their
+  original files) of configurable size
+- a fake BlitzGateway answering the connector's queries on that model
+- logins checking the password, creating sessions that can be joined later
+- a raw file store delivering deterministic file content with valid hashes
+- a raw pixels store delivering the (deterministic) planes of the images
+- a CLI importing files as new images
+- an optional latency injected into every call going "over the wire"
+
+As the OMERO bindings are usually not available where this is used (e.g. in
+CI), install_fake_omero() registers minimal "omero", "omero.gateway" and
+"omero.sys" modules, which has to happen before the connector imports them.
+
+This module is not meant to be executed directly and doesn't do anything in
+this case.
+"""
+
+import hashlib
+import os
+import sys
+import time
+import types
+
+
+# the content of all files is made of repetitions of this block:
+PATTERN = (''.join(chr(i) for i in range(251)) * 4200)[:1024 * 1024]
+
+# the dimensions (x, y, z, c, t) and pixel type of all images:
+IMAGE_SIZES = (256, 256, 8, 2, 1)
+PIXEL_TYPE = 'uint16'
+BYTES_PER_PIXEL = 2
+
+# the server that connections created like a real BlitzGateway log into (see
+# LoginGateway) and the password of all of its users:
+SERVER = None
+PASSWORD = 'omero'
+
+
+class RType(object):
+
+    """Minimal stand-in for the rtypes wrapping OMERO model values."""
+
+    def __init__(self, val):
+        self.val = val
+
+    def __repr__(self):
+        return 'RType(%r)' % (self.val,)
+
+
+class Model(object):
+
+    """Generic model object, attributes are wrapped as rtypes."""
+
+    def __init__(self, **attrs):
+        for (name, value) in attrs.items():
+            setattr(self, name, RType(value))
+
+
+class Permissions(object):
+
+    """Group permissions, only distinguishing private and readable groups."""
+
+    def __init__(self, group_read):
+        self._group_read = group_read
+
+    def isGroupRead(self):  # pylint: disable=invalid-name
+        """True unless the group is private."""
+        return self._group_read
+
+
+class Details(object):
+
+    """The details of a model object (permissions only)."""
+
+    def __init__(self, permissions):
+        self.permissions = permissions
+
+
+class GroupExperimenterMap(object):
+
+    """Link between a group and one of its members."""
+
+    def __init__(self, child):
+        self.child = child
+
+
+class Experimenter(Model):
+
+    """An OMERO user."""
+
+    def __init__(self, uid, name):
+        Model.__init__(self, id=uid, omeName=name, firstName='First',
+                       lastName=name.capitalize())
+
+
+class ExperimenterGroup(Model):
+
+    """An OMERO group, having its members attached."""
+
+    def __init__(self, gid, name, group_read, members):
+        Model.__init__(self, id=gid, name=name)
+        self.details = Details(Permissions(group_read))
+        self._maps = [GroupExperimenterMap(exp) for exp in members]
+
+    def copyGroupExperimenterMap(self):  # pylint: disable=invalid-name
+        """The group-experimenter maps, giving access to the members."""
+        return list(self._maps)
+
+
+class ChecksumAlgorithm(Model):
+
+    """The hasher of an original file."""
+
+    def __init__(self, name):
+        Model.__init__(self, value=name)
+
+
+class OriginalFile(Model):
+
+    """An original file with its size and SHA1 hash."""
+
+    def __init__(self, fid, name, size):
+        Model.__init__(self, id=fid, name=name, size=size,
+                       hash=content_hash(size))
+        self.hasher = ChecksumAlgorithm('SHA1-160')
+
+
+class Container(object):
+
+    """A project, dataset or image of the synthetic model."""
+
+    def __init__(self, cls, oid, name, gid, owner, parent=None):
+        self.cls = cls
+        self.oid = oid
+        self.name = name
+        self.gid = gid
+        self.owner = owner
+        self.parent = parent
+        self.fileset = None
+        self.files = []
+        # the ID of the last update event:
+        self.version = oid
+
+
+def content(offset, length, size):
+    """Get the (deterministic) content of a file of `size` bytes."""
+    end = min(offset + length, size)
+    chunks = []
+    pos = offset
+    while pos < end:
+        start = pos % len(PATTERN)
+        count = min(len(PATTERN) - start, end - pos)
+        chunks.append(PATTERN[start:start + count])
+        pos += count
+    return ''.join(chunks)
+
+
+HASHES = dict()
+
+
+def content_hash(size):
+    """The SHA1 hash of a file of `size` bytes (see content())."""
+    if size not in HASHES:
+        hasher = hashlib.sha1()
+        for offset in range(0, size, len(PATTERN)):
+            hasher.update(content(offset, len(PATTERN), size))
+        HASHES[size] = hasher.hexdigest()
+    return HASHES[size]
+
+
+class FakeServer(object):
+
+    """Synthetic OMERO data model.
+
+    Every user is a member of every group, every other group is private. In
+    each group, every user owns `projects` projects with `datasets` datasets
+    each, containing `images` images having a single original file of
+    `file_size` bytes.
+    """
+
+    def __init__(self, groups=3, users=5, projects=2, datasets=3, images=10,
+                 file_size=1024 * 1024, latency=0.0):
+        self.latency = latency
+        self.file_size = file_size
+        self._ids = 0
+        self.users = [Experimenter(self._next_id(), 'user%02d' % num)
+                      for num in range(users)]
+        # like in OMERO, everyone is a member of the 'user' group:
+        self.groups = [ExperimenterGroup(self._next_id(), 'user', False,
+                                         self.users)]
+        self.groups.extend(
+            ExperimenterGroup(self._next_id(), 'group%02d' % num,
+                              num % 2 == 0, self.users)
+            for num in range(groups))
+        self.objects = dict()
+        self.by_parent = dict()
+        self.files = dict()
+        # the users of the open sessions by their keys, the number of logins
+        # with a password:
+        self.sessions = dict()
+        self.logins = 0
+        for group in self.groups[1:]:
+            for user in self.users:
+                self._populate(group.id.val, user, projects, datasets, images)
+
+    def _next_id(self):
+        """Get a new object ID."""
+        self._ids += 1
+        return self._ids
+
+    def _add(self, cls, name, gid, owner, parent=None):
+        """Create a container object and register it."""
+        obj = Container(cls, self._next_id(), name, gid, owner, parent)
+        self.objects[(cls, obj.oid)] = obj
+        self.by_parent.setdefault((cls, parent), []).append(obj)
+        return obj
+
+    def _populate(self, gid, owner, projects, datasets, images):
+        """Create the projects, datasets and images of a user in a group."""
+        for pnum in range(projects):
+            proj = self._add('Project', 'project_%02d' % pnum, gid, owner,
+                             owner.id.val)
+            for dnum in range(datasets):
+                dset = self._add('Dataset', 'dataset_%02d' % dnum, gid, owner,
+                                 proj.oid)
+                for inum in range(images):
+                    name = 'image_%04d.tif' % inum
+                    image = self._add('Image', name, gid, owner, dset.oid)
+                    ofile = OriginalFile(self._next_id(), name, self.file_size)
+                    self.files[ofile.id.val] = ofile
+                    image.files.append(ofile)
+                    image.fileset = self._next_id()
+
+    def delay(self):
+        """Simulate the round trip time of a remote call."""
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def children(self, parent_cls, parent_ids, gid):
+        """Get the children of some objects within a group."""
+        child_cls = {'Experimenter': 'Project', 'Project': 'Dataset',
+                     'Dataset': 'Image'}[parent_cls]
+        children = []
+        for parent in parent_ids:
+            children.extend(
+                obj for obj in self.by_parent.get((child_cls, parent), [])
+                if gid == '-1' or str(obj.gid) == str(gid))
+        return children
+
+
+class ServiceOpts(object):
+
+    """The service options of a connection (the group context only)."""
+
+    def __init__(self):
+        self.group = '-1'
+
+    def setOmeroGroup(self, gid):  # pylint: disable=invalid-name
+        """Switch the group context."""
+        self.group = str(gid)
+
+    def getOmeroGroup(self):  # pylint: disable=invalid-name
+        """Get the current group context."""
+        return self.group
+
+
+class QueryService(object):
+
+    """Answers the HQL queries used by the connector."""
+
+    def __init__(self, server):
+        self._server = server
+
+    def findAllByQuery(self, query, params, ctx=None):
+        # pylint: disable=invalid-name,unused-argument
+        """Return model objects for the group and original file queries."""
+        self._server.delay()
+        ids = set(params.map.get('ids', []))
+        if 'from ExperimenterGroup' in query:
+            return [grp for grp in self._server.groups
+                    if grp.id.val in ids and grp.name.val != 'user']
+        elif 'from OriginalFile' in query:
+            return [self._server.files[fid] for fid in ids
+                    if fid in self._server.files]
+        raise ValueError('query not supported by the fake server: %s' % query)
+
+    def projection(self, query, params, ctx=None):
+        """Return rows for the child node queries (see CHILD_QUERIES)."""
+        self._server.delay()
+        if 'i.fileset' in query:
+            return self._dataset_files(params.map['id'])
+        if 'from Project p' in query:
+            parent_cls = 'Experimenter'
+        elif 'ProjectDatasetLink' in query:
+            parent_cls = 'Project'
+        elif 'DatasetImageLink' in query:
+            parent_cls = 'Dataset'
+        else:
+            raise ValueError('query not supported by the fake server: %s'
+                             % query)
+        gid = (ctx or {}).get('omero.group', '-1')
+        if 'count(' in query:
+            return self._signatures(parent_cls, params.map.get('ids', []),
+                                    gid)
+        objs = self._server.children(parent_cls, params.map.get('ids', []),
+                                     gid)
+        objs.sort(key=lambda obj: (obj.name, obj.oid))
+        if params.theFilter is not None:
+            offset, limit = params.theFilter
+            objs = objs[offset:offset + limit if limit else None]
+        return [[RType(obj.parent), RType(obj.oid), RType(obj.name),
+                 obj.owner.omeName] for obj in objs]
+
+    def _signatures(self, parent_cls, parent_ids, gid):
+        """Rows of child count, last child and last update per parent."""
+        rows = []
+        for parent in parent_ids:
+            objs = self._server.children(parent_cls, [parent], gid)
+            if objs:
+                rows.append([RType(parent), RType(len(objs)),
+                             RType(max(obj.oid for obj in objs)),
+                             RType(max(obj.version for obj in objs))])
+        return rows
+
+    def _dataset_files(self, dset_id):
+        """Rows for the original files of a dataset's images."""
+        rows = []
+        for image in self._server.children('Dataset', [dset_id], '-1'):
+            if not image.files:
+                rows.append([RType(image.oid), None, None, None, None, None,
+                             None])
+            for ofile in image.files:
+                rows.append([RType(image.oid), RType(image.fileset), ofile.id,
+                             ofile.name, ofile.size, ofile.hash,
+                             ofile.hasher.value])
+        return rows
+
+
+class RawFileStore(object):
+
+    """Delivers the content of original files in chunks."""
+
+    def __init__(self, server):
+        self._server = server
+        self._size = 0
+
+    def setFileId(self, fid, ctx=None):  # pylint: disable=invalid-name
+        """Select the file to read from."""
+        # pylint: disable=unused-argument
+        self._server.delay()
+        self._size = self._server.files[fid].size.val
+
+    def read(self, offset, length):
+        """Read a chunk of the file."""
+        self._server.delay()
+        return content(offset, length, self._size)
+
+    def close(self):
+        """Close the store."""
+        pass
+
+
+class RawPixelsStore(object):
+
+    """Delivers the pixel data of images, the content of an image is the same
+    as that of a file with the size of all its planes (see content())."""
+
+    def __init__(self, server):
+        self._server = server
+
+    def setPixelsId(self, pid, bypass, ctx=None):
+        # pylint: disable=invalid-name,unused-argument
+        """Select the pixels to read from."""
+        self._server.delay()
+
+    def getTile(self, z_idx, c_idx, t_idx, x_pos, y_pos, width, height):
+        # pylint: disable=invalid-name,too-many-arguments
+        """Read a tile of a plane (only full rows are supported)."""
+        self._server.delay()
+        size_x, size_y, size_z, size_c = IMAGE_SIZES[:4]
+        assert x_pos == 0 and width == size_x
+        plane = (t_idx * size_c + c_idx) * size_z + z_idx
+        row_bytes = size_x * BYTES_PER_PIXEL
+        offset = (plane * size_y + y_pos) * row_bytes
+        return content(offset, height * row_bytes, image_bytes())
+
+    def close(self):
+        """Close the store."""
+        pass
+
+
+def image_bytes():
+    """The size of the pixel data of an image."""
+    total = BYTES_PER_PIXEL
+    for size in IMAGE_SIZES:
+        total *= size
+    return total
+
+
+class ServiceFactory(object):
+
+    """The session's service factory."""
+
+    def __init__(self, server):
+        self._server = server
+
+    def createRawFileStore(self):  # pylint: disable=invalid-name
+        """Create a new raw file store."""
+        self._server.delay()
+        return RawFileStore(self._server)
+
+    def createRawPixelsStore(self):  # pylint: disable=invalid-name
+        """Create a new raw pixels store."""
+        self._server.delay()
+        return RawPixelsStore(self._server)
+
+
+class Client(object):
+
+    """The omero.client of a connection."""
+
+    def __init__(self, server, session='fake-session'):
+        self.server = server
+        self.session = session
+        self.sf = ServiceFactory(server)  # pylint: disable=invalid-name
+
+    def getSessionId(self):  # pylint: disable=invalid-name
+        """The session key."""
+        return self.session
+
+    def detachOnDestroy(self):  # pylint: disable=invalid-name
+        """Keep the session alive when the client goes away."""
+        pass
+
+
+class CLI(object):
+
+    """Minimal omero.cli.CLI, supporting the import of a single file."""
+
+    def __init__(self):
+        self._client = None
+
+    def loadplugins(self):  # pylint: disable=no-self-use
+        """Nothing to load."""
+        pass
+
+    def invoke(self, args, strict=False):  # pylint: disable=unused-argument
+        """Run "import -d <dataset> [options] <file>".
+
+        The file is read in chunks (each one being a remote call) and added
+        to the dataset as a new image with a single original file.
+        """
+        server = self._client.server
+        dset = server.objects[('Dataset', int(args[args.index('-d') + 1]))]
+        fname = args[-1]
+        size = 0
+        with open(fname, 'rb') as infile:
+            while True:
+                data = infile.read(1024 * 1024)
+                if not data:
+                    break
+                server.delay()
+                size += len(data)
+        name = os.path.basename(fname)
+        image = server._add(  # pylint: disable=protected-access
+            'Image', name, dset.gid, dset.owner, dset.oid)
+        ofile = OriginalFile(
+            server._next_id(), name, size)  # pylint: disable=protected-access
+        server.files[ofile.id.val] = ofile
+        image.files.append(ofile)
+        image.fileset = server._next_id()  # pylint: disable=protected-access
+
+
+class EventContext(object):
+
+    """The event context of the logged-in user."""
+
+    def __init__(self, server, user):
+        self.userId = user.id.val  # pylint: disable=invalid-name
+        self.userName = user.omeName.val  # pylint: disable=invalid-name
+        self.memberOfGroups = [  # pylint: disable=invalid-name
+            grp.id.val for grp in server.groups]
+        self.leaderOfGroups = []  # pylint: disable=invalid-name
+
+
+class ObjectWrapper(object):
+
+    """Minimal version of the BlitzObjectWrapper classes."""
+
+    OMERO_CLASS = None
+
+    def __init__(self, conn, obj):
+        self._conn = conn
+        self._obj = obj
+
+    def getId(self):  # pylint: disable=invalid-name
+        """The object ID."""
+        return self._obj.id.val
+
+    def getName(self):  # pylint: disable=invalid-name
+        """The object name."""
+        return self._obj.name.val
+
+
+class ExperimenterGroupWrapper(ObjectWrapper):
+
+    """Wrapper for groups."""
+
+    OMERO_CLASS = 'ExperimenterGroup'
+
+
+class ExperimenterWrapper(ObjectWrapper):
+
+    """Wrapper for users."""
+
+    OMERO_CLASS = 'Experimenter'
+
+    def getName(self):  # pylint: disable=invalid-name
+        """The user name."""
+        return self._obj.omeName.val
+
+    def getFullName(self):  # pylint: disable=invalid-name
+        """The full name of the user."""
+        return '%s %s' % (self._obj.firstName.val, self._obj.lastName.val)
+
+
+class FileWrapper(object):
+
+    """Wrapper for the original files of a fileset."""
+
+    def __init__(self, ofile):
+        self._ofile = ofile
+
+    def getId(self):  # pylint: disable=invalid-name
+        """The original file ID."""
+        return self._ofile.id.val
+
+    def getName(self):  # pylint: disable=invalid-name
+        """The original file name."""
+        return self._ofile.name.val
+
+
+class FilesetWrapper(object):
+
+    """Wrapper for the fileset of an image."""
+
+    def __init__(self, files):
+        self._files = files
+
+    def listFiles(self):  # pylint: disable=invalid-name
+        """The original files of the fileset."""
+        return [FileWrapper(ofile) for ofile in self._files]
+
+
+class ImageWrapper(object):
+
+    """Wrapper for images."""
+
+    OMERO_CLASS = 'Image'
+
+    def __init__(self, image):
+        self._image = image
+
+    def getId(self):  # pylint: disable=invalid-name
+        """The image ID."""
+        return self._image.oid
+
+    def getName(self):  # pylint: disable=invalid-name
+        """The image name."""
+        return self._image.name
+
+    def getFileset(self):  # pylint: disable=invalid-name
+        """The fileset of the image, None if it has no original files."""
+        if not self._image.files:
+            return None
+        return FilesetWrapper(self._image.files)
+
+    # pylint: disable=invalid-name,missing-docstring
+    def getSizeX(self):
+        return IMAGE_SIZES[0]
+
+    def getSizeY(self):
+        return IMAGE_SIZES[1]
+
+    def getSizeZ(self):
+        return IMAGE_SIZES[2]
+
+    def getSizeC(self):
+        return IMAGE_SIZES[3]
+
+    def getSizeT(self):
+        return IMAGE_SIZES[4]
+
+    def getPixelsType(self):
+        return PIXEL_TYPE
+
+    def getPixelSizeX(self):
+        return 0.065
+
+    def getPixelSizeY(self):
+        return 0.065
+
+    def getPixelSizeZ(self):
+        return 0.2
+
+    def getChannels(self):
+        return [ChannelWrapper(num) for num in range(IMAGE_SIZES[3])]
+
+    def getPrimaryPixels(self):
+        return PixelsWrapper(self._image.oid)
+    # pylint: enable=invalid-name,missing-docstring
+
+
+class ChannelWrapper(object):
+
+    """Wrapper for the channels of an image."""
+
+    def __init__(self, num):
+        self._num = num
+
+    # pylint: disable=invalid-name,missing-docstring
+    def getLabel(self):
+        return 'ch%s' % self._num
+
+    def getExcitationWave(self):
+        return 488 + 100 * self._num
+
+    def getEmissionWave(self):
+        return 520 + 100 * self._num
+    # pylint: enable=invalid-name,missing-docstring
+
+
+class PixelsWrapper(object):
+
+    """Wrapper for the pixels of an image."""
+
+    def __init__(self, pid):
+        self._pid = pid
+
+    def getId(self):  # pylint: disable=invalid-name
+        """The pixels ID."""
+        return self._pid
+
+
+class FakeGateway(object):
+
+    """Stand-in for an established omero.gateway.BlitzGateway connection."""
+
+    def __init__(self, server, user=None):
+        self._server = server
+        self._user = user or server.users[0]
+        self.c = Client(server)  # pylint: disable=invalid-name
+        self.SERVICE_OPTS = ServiceOpts()  # pylint: disable=invalid-name
+
+    def isConnected(self):  # pylint: disable=invalid-name
+        """The connection is always established."""
+        return True
+
+    def keepAlive(self):  # pylint: disable=invalid-name
+        """Ping the server."""
+        self._server.delay()
+        return True
+
+    def close(self, hard=True):
+        # pylint: disable=unused-argument
+        """Close the connection."""
+        pass
+
+    def getUserId(self):  # pylint: disable=invalid-name
+        """The ID of the logged-in user."""
+        return self._user.id.val
+
+    def getEventContext(self):  # pylint: disable=invalid-name
+        """The event context of the logged-in user."""
+        self._server.delay()
+        return EventContext(self._server, self._user)
+
+    def getQueryService(self):  # pylint: disable=invalid-name
+        """The query service."""
+        return QueryService(self._server)
+
+    def getGroupsMemberOf(self):  # pylint: disable=invalid-name
+        """The groups of the user (except for the 'user' group)."""
+        self._server.delay()
+        return [ExperimenterGroupWrapper(self, grp)
+                for grp in self._server.groups[1:]]
+
+    def getUser(self):  # pylint: disable=invalid-name
+        """The logged-in user."""
+        return ExperimenterWrapper(self, self._user)
+
+    def _context_group(self):
+        """The group of the current group context."""
+        gid = int(self.SERVICE_OPTS.getOmeroGroup())
+        for grp in self._server.groups:
+            if grp.id.val == gid:
+                return grp
+        return self._server.groups[1]
+
+    def getGroupFromContext(self):  # pylint: disable=invalid-name
+        """The group of the current group context."""
+        self._server.delay()
+        return ExperimenterGroupWrapper(self, self._context_group())
+
+    def listColleagues(self):  # pylint: disable=invalid-name
+        """The other members of the current group (none if private)."""
+        self._server.delay()
+        group = self._context_group()
+        if not group.details.permissions.isGroupRead():
+            return []
+        return [ExperimenterWrapper(self, gem.child)
+                for gem in group.copyGroupExperimenterMap()
+                if gem.child is not self._user]
+
+    def getObject(self, obj_type, oid, opts=None):
+        # pylint: disable=invalid-name
+        """Get an image by its ID (in the group context or `opts`)."""
+        self._server.delay()
+        image = self._server.objects.get((obj_type, int(oid)))
+        gid = (opts or {}).get('omero.group',
+                               self.SERVICE_OPTS.getOmeroGroup())
+        if image is None or gid not in ('-1', str(image.gid)):
+            return None
+        return ImageWrapper(image)
+
+    def getThumbnailSet(self, image_ids, max_size=64):
+        # pylint: disable=invalid-name,unused-argument
+        """Get (JPEG) thumbnails for a list of images."""
+        self._server.delay()
+        return dict((iid, '\xff\xd8\xff\xe0fake-jpeg-%s' % iid)
+                    for iid in image_ids
+                    if ('Image', int(iid)) in self._server.objects)
+
+
+class LoginGateway(FakeGateway):
+
+    """Stand-in for a new BlitzGateway, connecting to SERVER on request.
+
+    A login requires PASSWORD and opens a new session, which lasts until the
+    connection is closed with `hard` set (like OMERO sessions of detached
+    clients).
+    """
+
+    # pylint: disable=too-many-arguments,unused-argument
+    def __init__(self, username=None, passwd=None, host=None, port=None,
+                 secure=False, useragent=None):
+        FakeGateway.__init__(self, SERVER)
+        self._login = (username, passwd)
+        self._connected = False
+
+    def isConnected(self):  # pylint: disable=invalid-name
+        """Whether connect() has succeeded."""
+        return self._connected
+
+    def connect(self, sUuid=None):  # pylint: disable=invalid-name
+        """Log in with the username and password or join a session."""
+        self._server.delay()
+        if sUuid is None:
+            self._server.logins += 1
+            users = dict((user.omeName.val, user)
+                         for user in self._server.users)
+            user = users.get(self._login[0])
+            if self._login[1] != PASSWORD:
+                user = None
+        else:
+            user = self._server.sessions.get(sUuid)
+        if user is None:
+            return False
+        if sUuid is None:
+            sUuid = 'fake-session-%s' % self._server.logins
+            self._server.sessions[sUuid] = user
+        self._user = user
+        self.c = Client(self._server, sUuid)
+        self._connected = True
+        return True
+
+    def close(self, hard=True):
+        """Close the connection, ending the session if `hard` is set."""
+        if hard and self._connected:
+            self._server.sessions.pop(self.c.getSessionId(), None)
+        self._connected = False
+
+
+class ParametersI(object):
+
+    """Minimal omero.sys.ParametersI (IDs and paging only)."""
+
+    def __init__(self):
+        self.map = dict()
+        self.theFilter = None  # pylint: disable=invalid-name
+
+    def addId(self, oid):  # pylint: disable=invalid-name
+        """Set the :id parameter."""
+        self.map['id'] = oid
+        return self
+
+    def addIds(self, ids):  # pylint: disable=invalid-name
+        """Set the :ids parameter."""
+        self.map['ids'] = list(ids)
+        return self
+
+    def page(self, offset, limit):
+        """Restrict the results to a page."""
+        self.theFilter = (offset, limit)  # pylint: disable=invalid-name
+        return self
+
+
+def install_fake_omero():
+    """Register the fake OMERO modules, replacing any real ones."""
+    omero = types.ModuleType('omero')
+    gateway = types.ModuleType('omero.gateway')
+    gateway.BlitzGateway = LoginGateway
+    gateway.ExperimenterGroupWrapper = ExperimenterGroupWrapper
+    gateway.ExperimenterWrapper = ExperimenterWrapper
+    omero_sys = types.ModuleType('omero.sys')
+    omero_sys.ParametersI = ParametersI
+    omero_cli = types.ModuleType('omero.cli')
+    omero_cli.CLI = CLI
+    omero.gateway = gateway
+    omero.sys = omero_sys
+    omero.cli = omero_cli
+    sys.modules['omero'] = omero
+    sys.modules['omero.gateway'] = gateway
+    sys.modules['omero.sys'] = omero_sys
+    sys.modules['omero.cli'] = omero_cli
+
+
+if __name__ == "__main__":
+    print __doc__
+    sys.exit(1)
@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+
+"""Multi-user load test for the HRM-OMERO connector.
+
+Simulates a number of HRM users working at the same time, each one issuing a
+random mix of "checkCredentials", "retrieveChildren", "OMEROtoHRM" and
+"HRMtoOMERO" requests with some think time in between. Like in the HRM, every
+request runs the connector as a separate process (see fake_connector.py),
+optionally as a thin client of a connector daemon ("--daemon"). OMERO is
+replaced by the fake server of fake_gateway, with a configurable latency per
+remote call and per login, so no OMERO installation is required:
+
+$ python load_connector.py --users 30 --duration 60 [--daemon]
+
+The latency percentiles and the throughput are reported per action, together
+with the peak number of connector processes running at once and their peak
+total resident memory (RSS, sampled from /proc, so this requires Linux). Use
+"--json" to keep the results, e.g. for comparing different setups.
+
+NOTE: every connector process builds the synthetic model of the fake server
+on startup, which adds a few milliseconds to each request (depending on the
+model size, see "--images" etc.).
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fake_gateway
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CONNECTOR = os.path.join(HERE, 'fake_connector.py')
+
+ACTIONS = ['checkCredentials', 'retrieveChildren', 'OMEROtoHRM',
+           'HRMtoOMERO']
+PERCENTILES = [50, 90, 95, 99]
+# interval in seconds for sampling the connector processes:
+SAMPLE_INTERVAL = 0.05
+
+
+def percentile(values, pct):
+    """The nearest-rank percentile of a list of numbers."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(0, rank - 1)]
+
+
+def parse_mix(text):
+    """Parse a request mix like "checkCredentials=1,retrieveChildren=6"."""
+    mix = []
+    for item in text.split(','):
+        action, weight = item.split('=')
+        if action not in ACTIONS:
+            raise ValueError('unknown action: %s' % action)
+        mix.append((action, float(weight)))
+    return mix
+
+
+def choose(mix, rnd):
+    """Pick an action from a weighted mix."""
+    pick = rnd.uniform(0, sum(weight for (_, weight) in mix))
+    for (action, weight) in mix:
+        pick -= weight
+        if pick <= 0:
+            return action
+    return mix[-1][0]
+
+
+def process_tree(root_pid):
+    """Get the PIDs of all descendants of a process (from /proc)."""
+    children = dict()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as infile:
+                stat = infile.read()
+        except IOError:
+            continue
+        # the command may contain spaces, the fields after it are fixed:
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    found = []
+    pending = [root_pid]
+    while pending:
+        pids = children.get(pending.pop(), [])
+        found.extend(pids)
+        pending.extend(pids)
+    return found
+
+
+def rss_kb(pid):
+    """The resident memory of a process in kB, 0 if it's gone."""
+    try:
+        with open('/proc/%s/status' % pid) as infile:
+            for line in infile:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+class Sampler(threading.Thread):
+
+    """Track the peak number and total RSS of the connector processes."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='sampler')
+        self.daemon = True
+        self.peak_procs = 0
+        self.peak_rss = 0
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            pids = process_tree(os.getpid())
+            self.peak_procs = max(self.peak_procs, len(pids))
+            self.peak_rss = max(self.peak_rss, sum(rss_kb(pid)
+                                                   for pid in pids))
+            self._done.wait(SAMPLE_INTERVAL)
+
+    def stop(self):
+        """Stop sampling."""
+        self._done.set()
+        self.join()
+
+
+class User(object):
+
+    """A simulated HRM user with the nodes and files to work with."""
+
+    def __init__(self, server, num, workdir, upload_size):
+        user = server.users[num]
+        self.name = user.omeName.val
+        gid = server.groups[1].id.val
+        uid = user.id.val
+        self.nodes = ['ROOT', 'G:%s:Experimenter:%s' % (gid, uid)]
+        self.datasets = []
+        self.images = []
+        for proj in server.by_parent.get(('Project', uid), []):
+            if proj.gid != gid:
+                continue
+            self.nodes.append('G:%s:Project:%s' % (gid, proj.oid))
+            for dset in server.by_parent.get(('Dataset', proj.oid), []):
+                self.datasets.append('G:%s:Dataset:%s' % (gid, dset.oid))
+                self.images.extend(
+                    'G:%s:Image:%s' % (gid, image.oid)
+                    for image in server.by_parent.get(('Image', dset.oid), []))
+        self.nodes.extend(self.datasets)
+        self.home = os.path.join(workdir, self.name)
+        os.makedirs(self.home)
+        # a deconvolved image to upload (without a parameter summary):
+        self.upload = os.path.join(self.home, 'result_0123456789abc_hrm.tif')
+        with open(self.upload, 'wb') as outfile:
+            outfile.write(os.urandom(upload_size))
+
+    def request(self, action, rnd):
+        """Assemble the arguments of a request and a directory to clean up.
+
+        Returns
+        =======
+        (list, str) - the connector arguments and the directory to remove
+                      after the request (or None)
+        """
+        args = ['-u', self.name, '-w', 'secret', action]
+        if action == 'retrieveChildren':
+            # like OmeroConnection::getChildren():
+            return (args + ['--id', rnd.choice(self.nodes), '--limit', '500',
+                            '--etag'], None)
+        elif action == 'OMEROtoHRM':
+            dest = tempfile.mkdtemp(dir=self.home)
+            os.mkdir(os.path.join(dest, 'hrm_previews'))
+            return (args + ['-i', rnd.choice(self.images), '-d', dest], dest)
+        elif action == 'HRMtoOMERO':
+            return (args + ['-d', rnd.choice(self.datasets), '-f',
+                            self.upload], None)
+        return (args, None)
+
+
+def simulate(user, args, env, deadline, seed, results, lock):
+    """Issue requests as a single user until the deadline."""
+    rnd = random.Random(seed)
+    mix = parse_mix(args.mix)
+    # don't let all users start at the same instant:
+    time.sleep(rnd.uniform(0, args.think / 1000.0))
+    while time.time() < deadline:
+        action = choose(mix, rnd)
+        cmd, cleanup = user.request(action, rnd)
+        start = time.time()
+        proc = subprocess.Popen([args.python, CONNECTOR] + cmd, env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        elapsed = time.time() - start
+        if cleanup is not None:
+            shutil.rmtree(cleanup, ignore_errors=True)
+        with lock:
+            results.append((action, start, elapsed, proc.returncode))
+        if proc.returncode != 0 and args.verbose:
+            sys.stderr.write('%s %s failed:\n%s\n' % (user.name, action,
+                                                      output))
+        if args.think > 0:
+            time.sleep(rnd.expovariate(1000.0 / args.think))
+
+
+def start_daemon(args, env, socket):
+    """Start a connector daemon and wait until it accepts requests."""
+    proc = subprocess.Popen([args.python, CONNECTOR, '--socket', socket,
+                             'daemon'], env=env)
+    for _ in range(100):
+        if os.path.exists(socket):
+            return proc
+        if proc.poll() is not None:
+            break
+        time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError('the connector daemon did not start')
+
+
+def summarize(results, duration, sampler):
+    """Compute the statistics per action and in total."""
+    summary = dict()
+    for action in ACTIONS + ['total']:
+        times = [elapsed for (name, _, elapsed, _) in results
+                 if action in (name, 'total')]
+        if not times:
+            continue
+        errors = len([ret for (name, _, _, ret) in results
+                      if action in (name, 'total') and ret != 0])
+        stats = {'requests': len(times), 'errors': errors,
+                 'throughput': len(times) / duration,
+                 'max': max(times)}
+        for pct in PERCENTILES:
+            stats['p%s' % pct] = percentile(times, pct)
+        summary[action] = stats
+    summary['peak_processes'] = sampler.peak_procs
+    summary['peak_rss_mb'] = sampler.peak_rss / 1024.0
+    return summary
+
+
+def report(summary, args):
+    """Print the statistics as a table."""
+    print("%d users, %.0f s, %s, latency %s ms per call" % (
+        args.users, args.duration,
+        'connector daemon' if args.daemon else 'one process per request',
+        args.latency))
+    print("%-18s %8s %6s %8s %9s %9s %9s %9s %9s" % (
+        'action', 'requests', 'errors', 'req/s', 'p50', 'p90', 'p95', 'p99',
+        'max'))
+    for action in ACTIONS + ['total']:
+        if action not in summary:
+            continue
+        stats = summary[action]
+        print("%-18s %8d %6d %8.2f %s" % (
+            action, stats['requests'], stats['errors'], stats['throughput'],
+            ' '.join('%7.0fms' % (stats[key] * 1000) for key in
+                     ['p%s' % pct for pct in PERCENTILES] + ['max'])))
+    print("peak connector processes: %d" % summary['peak_processes'])
+    print("peak total RSS: %.1f MB" % summary['peak_rss_mb'])
+
+
+def parse_arguments():
+    """Parse the commandline arguments."""
+    argparser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    argparser.add_argument('--users', type=int, default=10,
+                           help='number of concurrent users')
+    argparser.add_argument('--duration', type=float, default=30,
+                           help='length of the test in seconds')
+    argparser.add_argument('--think', type=float, default=500,
+                           help='mean think time between requests in ms')
+    argparser.add_argument(
+        '--mix', type=str,
+        default='checkCredentials=1,retrieveChildren=6,OMEROtoHRM=2,'
+        'HRMtoOMERO=1',
+        help='relative weights of the actions')
+    argparser.add_argument('--daemon', action='store_true', default=False,
+                           help='serve the requests by a connector daemon')
+    argparser.add_argument('--projects', type=int, default=1,
+                           help='projects per user')
+    argparser.add_argument('--datasets', type=int, default=2,
+                           help='datasets per project')
+    argparser.add_argument('--images', type=int, default=50,
+                           help='images per dataset')
+    argparser.add_argument('--file-size', type=int, default=4 * 1024 * 1024,
+                           help='size of the original files in bytes')
+    argparser.add_argument('--upload-size', type=int,
+                           default=4 * 1024 * 1024,
+                           help='size of the uploaded files in bytes')
+    argparser.add_argument('--latency', type=float, default=2.0,
+                           help='latency of every server call in ms')
+    argparser.add_argument('--login-latency', type=float, default=100.0,
+                           help='latency of a login in ms')
+    argparser.add_argument('--seed', type=int, default=0,
+                           help='seed for the random choices')
+    argparser.add_argument('--python', type=str, default=sys.executable,
+                           help='the interpreter to run the connector with')
+    argparser.add_argument('--json', type=str,
+                           help='write the results to this file')
+    argparser.add_argument('-v', '--verbose', action='store_true',
+                           help='print the output of failed requests')
+    return argparser.parse_args()
+
+
+def main():
+    """Run the load test and report the results."""
+    args = parse_arguments()
+    workdir = tempfile.mkdtemp(prefix='hrm_omero_load_')
+    daemon = None
+    try:
+        server_args = [1, args.users, args.projects, args.datasets,
+                       args.images, args.file_size, args.latency / 1000.0]
+        server = fake_gateway.FakeServer(*server_args)
+        conf = os.path.join(workdir, 'hrm.conf')
+        socket = os.path.join(workdir, 'connector.sock')
+        with open(conf, 'w') as outfile:
+            outfile.write('OMERO_PKG="%s"\n' % workdir)
+            outfile.write('OMERO_HOSTNAME="localhost"\n')
+            outfile.write('OMERO_CONNECTOR_CACHE="%s"\n' %
+                          os.path.join(workdir, 'cache'))
+            if args.daemon:
+                outfile.write('OMERO_CONNECTOR_SOCKET="%s"\n' % socket)
+        env = dict(os.environ)
+        env['HRM_CONFIG_FILE'] = conf
+        env['HRM_CONFIG_CACHE'] = ''
+        env['FAKE_OMERO_SERVER'] = json.dumps(server_args)
+        env['FAKE_OMERO_LOGIN'] = str(args.login_latency)
+        users = [User(server, num, workdir, args.upload_size)
+                 for num in range(args.users)]
+
+        sampler = Sampler()
+        sampler.start()
+        if args.daemon:
+            daemon = start_daemon(args, env, socket)
+        results = []
+        lock = threading.Lock()
+        start = time.time()
+        deadline = start + args.duration
+        threads = [threading.Thread(
+            target=simulate,
+            args=(user, args, env, deadline, args.seed + num, results, lock))
+                   for (num, user) in enumerate(users)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        # join with a timeout, so the main thread still receives
+        # KeyboardInterrupt:
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(1)
+        duration = time.time() - start
+        sampler.stop()
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    summary = summarize(results, duration, sampler)
+    report(summary, args)
+    if args.json:
+        with open(args.json, 'w') as outfile:
+            json.dump(summary, outfile, indent=4, sort_keys=True)
+    return 1 if summary.get('total', {}).get('errors') else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
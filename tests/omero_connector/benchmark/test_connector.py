@@ -0,0 +1,522 @@
+#!/usr/bin/env python
+
+"""Behaviour tests for the HRM-OMERO connector against the fake OMERO server.
+
+Unlike the benchmarks (see bench_connector), these check the results of the
+connector's functions: the OME-TIFF export, the tree cache, the transfer
+queue, the session cache and the search. Like the benchmarks, they need no
+OMERO installation, no server and no HRM config file. Run them from any
+directory:
+
+$ python test_connector.py [-v]
+"""
+
+import json
+import os
+import shutil
+import StringIO
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import bench_connector
+import fake_gateway
+
+# the connector can only be imported once per process, so all tests share its
+# settings (the cache directory in particular):
+WORKDIR = tempfile.mkdtemp(prefix='test_connector_')
+os.environ['HRM_CONFIG_SET_OMERO_QUEUE_BACKOFF'] = '0'
+OME_HRM = bench_connector.setup_connector(WORKDIR)
+
+import ome_cache  # noqa: E402 pylint: disable=wrong-import-position
+import ome_queue  # noqa: E402 pylint: disable=wrong-import-position
+import ome_sessions  # noqa: E402 pylint: disable=wrong-import-position
+import ome_tiff  # noqa: E402 pylint: disable=wrong-import-position
+
+
+def run_connector(*argv):
+    """Run the connector with the given arguments, capturing its output.
+
+    Returns
+    =======
+    (bool, str) - the return value of ome_hrm.main() and what it printed
+    """
+    stdout = sys.stdout
+    output = StringIO.StringIO()
+    sys.argv = ['ome_hrm.py'] + list(argv)
+    # the connector may wrap sys.stdout (see ome_hrm.capturing_stdout()):
+    sys.stdout = output
+    try:
+        retval = OME_HRM.main()
+    finally:
+        sys.stdout = stdout
+    return (retval, output.getvalue())
+
+
+def read_tiff(fname):
+    """Read the description and the pixel data of all planes of a TIFF.
+
+    Returns
+    =======
+    (bool, str, list) - whether the file is a BigTIFF, the description of the
+                        first directory and the data of each plane
+    """
+    with open(fname, 'rb') as infile:
+        data = infile.read()
+    order, magic = struct.unpack('>2sH', data[:4])
+    assert order == 'MM', 'not a big-endian TIFF'
+    bigtiff = magic == 43
+    if bigtiff:
+        (head, entry_fmt, field, entry_size) = ('>Q', '>HHQ', 8, 20)
+    else:
+        (head, entry_fmt, field, entry_size) = ('>H', '>HHI', 4, 12)
+    offset_fmt = '>Q' if bigtiff else '>I'
+    head_size = struct.calcsize(head)
+    offset = struct.unpack(offset_fmt,
+                           data[8:16] if bigtiff else data[4:8])[0]
+    description = None
+    planes = []
+    while offset:
+        count = struct.unpack(head, data[offset:offset + head_size])[0]
+        pos = offset + head_size
+        tags = dict()
+        for num in range(count):
+            entry = data[pos + num * entry_size:pos + (num + 1) * entry_size]
+            tag, code, values = struct.unpack(entry_fmt,
+                                              entry[:entry_size - field])
+            value = entry[entry_size - field:]
+            fmt = {2: 'B', 3: 'H', 4: 'I', 16: 'Q'}[code]
+            size = struct.calcsize(fmt) * values
+            if size > field:
+                start = struct.unpack(offset_fmt, value)[0]
+                value = data[start:start + size]
+            tags[tag] = struct.unpack('>%s%s' % (values, fmt), value[:size])
+        if 270 in tags:
+            description = ''.join(chr(c) for c in tags[270]).rstrip('\0')
+        planes.append(''.join(data[start:start + size] for (start, size)
+                              in zip(tags[273], tags[279])))
+        pos += count * entry_size
+        offset = struct.unpack(offset_fmt, data[pos:pos + field])[0]
+    return (bigtiff, description, planes)
+
+
+class ConnectorTest(unittest.TestCase):
+
+    """Base class providing a fake server and a temporary directory.
+
+    The messages the connector prints are discarded.
+    """
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = bench_connector.NullWriter()
+        self.tmpdir = tempfile.mkdtemp(dir=WORKDIR)
+        self.server = fake_gateway.FakeServer(2, 2, 1, 1, 3, 1000)
+        fake_gateway.SERVER = self.server
+        self.conn = fake_gateway.FakeGateway(self.server)
+        self.gid = self.server.groups[1].id.val
+        owner = self.server.users[0].id.val
+        proj = self.server.by_parent[('Project', owner)][0]
+        self.dset = self.server.by_parent[('Dataset', proj.oid)][0]
+        self.images = self.server.by_parent[('Image', self.dset.oid)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        sys.stdout = self.stdout
+
+    def image_id(self, image):
+        """The node ID string of an image."""
+        return 'G:%s:Image:%s' % (self.gid, image.oid)
+
+
+class OmeTiffTest(ConnectorTest):
+
+    """Exporting images without original files as OME-TIFF."""
+
+    def setUp(self):
+        ConnectorTest.setUp(self)
+        self.chunk_size = OME_HRM.CHUNK_SIZE
+        self.classic_limit = ome_tiff.CLASSIC_LIMIT
+        # an image imported before OMERO 5.0:
+        self.images[0].files = []
+        os.mkdir(os.path.join(self.tmpdir, 'hrm_previews'))
+
+    def tearDown(self):
+        OME_HRM.CHUNK_SIZE = self.chunk_size
+        ome_tiff.CLASSIC_LIMIT = self.classic_limit
+        ConnectorTest.tearDown(self)
+
+    def export(self):
+        """Export the image, returning the contents of the file."""
+        self.assertTrue(OME_HRM.omero_to_hrm(
+            self.conn, self.image_id(self.images[0]), self.tmpdir))
+        tgt = os.path.join(self.tmpdir, 'image_0000.ome.tif')
+        self.assertFalse(os.path.exists(tgt + '.part'))
+        return read_tiff(tgt)
+
+    def check_pixels(self, planes):
+        """Compare the exported planes with the pixel data in OMERO."""
+        sizes = fake_gateway.IMAGE_SIZES
+        self.assertEqual(len(planes), sizes[2] * sizes[3] * sizes[4])
+        total = fake_gateway.image_bytes()
+        self.assertEqual(''.join(planes),
+                         fake_gateway.content(0, total, total))
+
+    def test_classic(self):
+        """A small image is written as classic TIFF with OME-XML."""
+        bigtiff, description, planes = self.export()
+        self.assertFalse(bigtiff)
+        self.check_pixels(planes)
+        self.assertIn('<Pixels', description)
+        self.assertIn('SizeX="%s"' % fake_gateway.IMAGE_SIZES[0], description)
+        self.assertIn('Type="%s"' % fake_gateway.PIXEL_TYPE, description)
+
+    def test_bigtiff_strips(self):
+        """Large images are written as BigTIFF, planes split into strips."""
+        ome_tiff.CLASSIC_LIMIT = 0
+        OME_HRM.CHUNK_SIZE = 10000
+        bigtiff, description, planes = self.export()
+        self.assertTrue(bigtiff)
+        self.check_pixels(planes)
+        self.assertIn('<Pixels', description)
+
+    def test_existing_target(self):
+        """An existing file is never overwritten."""
+        tgt = os.path.join(self.tmpdir, 'image_0000.ome.tif')
+        with open(tgt, 'w') as outfile:
+            outfile.write('original')
+        self.assertFalse(OME_HRM.omero_to_hrm(
+            self.conn, self.image_id(self.images[0]), self.tmpdir))
+        with open(tgt) as infile:
+            self.assertEqual(infile.read(), 'original')
+
+
+class Clock(object):
+
+    """Replacement for the time module, only moving forward on request."""
+
+    def __init__(self, now=1000000.0):
+        self.now = now
+
+    def time(self):
+        """The current (fake) time."""
+        return self.now
+
+
+class TreeCacheTest(ConnectorTest):
+
+    """Expiry, eviction and invalidation of cached tree nodes."""
+
+    def setUp(self):
+        ConnectorTest.setUp(self)
+        self.clock = Clock()
+        ome_cache.time = self.clock
+        self.cache = ome_cache.TreeCache(self.tmpdir, ttl=60, max_size=25)
+
+    def tearDown(self):
+        self.cache.close()
+        ome_cache.time = __import__('time')
+        ConnectorTest.tearDown(self)
+
+    def test_ttl(self):
+        """Nodes expire `ttl` seconds after they were stored."""
+        self.cache.put('user', 'G:1:Project:2', 'data')
+        self.clock.now += 30
+        self.assertEqual(self.cache.get('user', 'G:1:Project:2'), 'data')
+        # accessing a node doesn't extend its lifetime:
+        self.clock.now += 31
+        self.assertIsNone(self.cache.get('user', 'G:1:Project:2'))
+
+    def test_users(self):
+        """Every user has their own nodes."""
+        self.cache.put('user', 'G:1:Project:2', 'data')
+        self.assertIsNone(self.cache.get('other', 'G:1:Project:2'))
+
+    def test_eviction(self):
+        """The least recently accessed nodes are evicted first."""
+        for num in range(2):
+            self.cache.put('user', 'G:1:Dataset:%s' % num, '0123456789')
+            self.clock.now += 1
+        self.cache.get('user', 'G:1:Dataset:0')
+        self.clock.now += 1
+        self.cache.put('user', 'G:1:Dataset:2', '0123456789')
+        self.assertIsNotNone(self.cache.get('user', 'G:1:Dataset:0'))
+        self.assertIsNone(self.cache.get('user', 'G:1:Dataset:1'))
+        self.assertIsNotNone(self.cache.get('user', 'G:1:Dataset:2'))
+
+    def test_invalidate(self):
+        """Invalidating drops all pages and versions, for all users."""
+        cache = ome_cache.TreeCache(self.tmpdir, ttl=60)
+        try:
+            nodes = ['G:1:Dataset:5', 'G:1:Dataset:5@0+100',
+                     'G:1:Dataset:5#etag', 'G:2:Dataset:5']
+            for node in nodes:
+                cache.put('user', node, 'data')
+                cache.put('other', node, 'data')
+            cache.put('user', 'G:1:Dataset:6', 'data')
+            cache.invalidate('G:1:Dataset:5')
+            for node in nodes:
+                self.assertIsNone(cache.get('user', node))
+                self.assertIsNone(cache.get('other', node))
+            self.assertEqual(cache.get('user', 'G:1:Dataset:6'), 'data')
+        finally:
+            cache.close()
+
+    def test_split_node_id(self):
+        """Page specifications and version tokens are ignored."""
+        for node in ['G:1:Dataset:5', 'G:1:Dataset:5@0+100',
+                     'G:1:Dataset:5#etag', 'G:1:Dataset:5@0+100#etag']:
+            self.assertEqual(ome_cache.split_node_id(node),
+                             ('1', 'Dataset', '5'))
+
+
+def dead_pid():
+    """Get the PID of a process that has terminated."""
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    return proc.pid
+
+
+class TransferQueueTest(ConnectorTest):
+
+    """Claiming, retrying, recovering and reporting queued jobs."""
+
+    def setUp(self):
+        ConnectorTest.setUp(self)
+        self.queue = ome_queue.TransferQueue(self.tmpdir, 2, 0)
+
+    def tearDown(self):
+        self.queue.close()
+        ConnectorTest.tearDown(self)
+
+    def enqueue(self, user, num=0):
+        """Add a job for a user."""
+        return self.queue.enqueue(user, 'pw', 'OMEROtoHRMBatch',
+                                  {'action': 'OMEROtoHRMBatch', 'num': num})
+
+    def test_fairness(self):
+        """Users with fewer running jobs are served first."""
+        jobs = [self.enqueue('alice', num) for num in range(3)]
+        jobs.append(self.enqueue('bob'))
+        claimed = [self.queue.claim(os.getpid())['id'] for _ in range(3)]
+        self.assertEqual(claimed, [jobs[0], jobs[3], jobs[1]])
+        self.queue.complete(jobs[0], 0, '')
+        self.assertEqual(self.queue.claim(os.getpid())['id'], jobs[2])
+        self.assertIsNone(self.queue.claim(os.getpid()))
+
+    def test_retry(self):
+        """Failed jobs are retried until the maximum number of attempts."""
+        job_id = self.enqueue('alice')
+        job = self.queue.claim(os.getpid())
+        self.assertEqual(job['password'], 'pw')
+        self.assertEqual(job['attempts'], 1)
+        self.assertEqual(self.queue.complete(job_id, 1, 'failed'),
+                         ome_queue.QUEUED)
+        job = self.queue.claim(os.getpid())
+        self.assertEqual(job['attempts'], 2)
+        self.assertEqual(self.queue.complete(job_id, 1, 'failed again'),
+                         ome_queue.FAILED)
+        self.assertIsNone(self.queue.claim(os.getpid()))
+        status = self.queue.status('alice', 'pw', job_id)[0]
+        self.assertEqual(status['state'], ome_queue.FAILED)
+        self.assertEqual(status['output'], 'failed again')
+
+    def test_retry_request(self):
+        """A retry can run with a reduced request."""
+        job_id = self.enqueue('alice')
+        self.queue.claim(os.getpid())
+        self.queue.complete(job_id, 1, '', {'action': 'retry'})
+        self.assertEqual(self.queue.claim(os.getpid())['request'],
+                         {'action': 'retry'})
+
+    def test_backoff(self):
+        """Retries are delayed according to the backoff."""
+        queue = ome_queue.TransferQueue(self.tmpdir, 3, 60)
+        try:
+            job_id = queue.enqueue('alice', 'pw', 'OMEROtoHRM', {})
+            queue.claim(os.getpid())
+            queue.complete(job_id, 1, '')
+            self.assertIsNone(queue.claim(os.getpid()))
+        finally:
+            queue.close()
+        self.assertEqual(ome_queue.backoff_delay(1, 60), 60)
+        self.assertEqual(ome_queue.backoff_delay(3, 60), 240)
+        self.assertEqual(ome_queue.backoff_delay(100, 60),
+                         ome_queue.BACKOFF_MAX)
+
+    def test_recover(self):
+        """Jobs of dead workers are requeued, those of live ones are not."""
+        dead = self.enqueue('alice')
+        alive = self.enqueue('bob')
+        self.queue.claim(dead_pid())
+        self.queue.claim(os.getpid())
+        self.assertEqual(self.queue.recover(), 1)
+        self.assertEqual(self.queue.claim(os.getpid())['id'], dead)
+        states = [job['state'] for job in self.queue.status('bob', 'pw')]
+        self.assertEqual(states, [ome_queue.RUNNING])
+        self.assertNotEqual(dead, alive)
+
+    def test_password(self):
+        """Jobs are only reported and cancelled with their password."""
+        job_id = self.enqueue('alice')
+        self.assertEqual(self.queue.status('alice', 'wrong'), [])
+        self.assertEqual(self.queue.status('bob', 'pw'), [])
+        self.assertFalse(self.queue.cancel('alice', 'wrong', job_id)[0])
+        self.assertFalse(self.queue.cancel('bob', 'pw', job_id)[0])
+        self.assertTrue(self.queue.cancel('alice', 'pw', job_id)[0])
+        self.assertIsNone(self.queue.claim(os.getpid()))
+
+
+class WorkerTest(ConnectorTest):
+
+    """Running queued transfers with the connector's worker."""
+
+    def setUp(self):
+        ConnectorTest.setUp(self)
+        for fname in os.listdir(WORKDIR):
+            if fname.startswith('transfer_queue.db'):
+                os.unlink(os.path.join(WORKDIR, fname))
+        os.mkdir(os.path.join(self.tmpdir, 'hrm_previews'))
+        self.transfer_image = OME_HRM.transfer_image
+
+    def tearDown(self):
+        OME_HRM.transfer_image = self.transfer_image
+        ConnectorTest.tearDown(self)
+
+    def test_batch_retry(self):
+        """Retrying a batch only transfers the images that failed."""
+        user = self.server.users[0].omeName.val
+        failing = [self.images[1].oid]
+
+        def transfer_image(conn, image_id, downloads, workers=None, gid='-1'):
+            """Fail the first transfer of one of the images."""
+            if int(image_id) in failing:
+                failing.remove(int(image_id))
+                print('ERROR: simulated failure')
+                return False
+            return self.transfer_image(conn, image_id, downloads, workers,
+                                       gid)
+
+        OME_HRM.transfer_image = transfer_image
+        ids = [self.image_id(image) for image in self.images[:2]]
+        retval, output = run_connector(
+            '-u', user, '-w', fake_gateway.PASSWORD, 'enqueue',
+            'OMEROtoHRMBatch', '-i', ids[0], '-i', ids[1], '-d', self.tmpdir)
+        self.assertTrue(retval)
+        job_id = json.loads(output)['job']
+        self.assertTrue(run_connector('worker', '--once', '-j', '1')[0])
+        retval, output = run_connector(
+            '-u', user, '-w', fake_gateway.PASSWORD, 'status', '--job',
+            str(job_id))
+        job = json.loads(output)[0]
+        self.assertEqual(job['state'], ome_queue.DONE)
+        self.assertEqual(job['attempts'], 2)
+        # the output of the last attempt only covers the retried image:
+        self.assertEqual(json.loads(job['output']).keys(), [ids[1]])
+        self.assertEqual(
+            sorted(fname for fname in os.listdir(self.tmpdir)
+                   if fname.endswith('.tif')),
+            ['image_0000.tif', 'image_0001.tif'])
+
+
+class SessionTest(ConnectorTest):
+
+    """Logging in, joining cached sessions and verifying credentials."""
+
+    def setUp(self):
+        ConnectorTest.setUp(self)
+        self.user = self.server.users[0].omeName.val
+        self.sessions = ome_sessions.SessionCache(
+            OME_HRM.CACHE_DIR, OME_HRM.HOST, OME_HRM.PORT)
+        self.sessions.drop(self.user)
+
+    def login(self, passwd, cached=True):
+        """Log into the fake server with the connector."""
+        return OME_HRM.omero_login(self.user, passwd, OME_HRM.HOST,
+                                   OME_HRM.PORT, cached)
+
+    def test_cached_session(self):
+        """A session is re-used with the same password only."""
+        self.assertTrue(self.login(fake_gateway.PASSWORD).isConnected())
+        self.assertTrue(self.login(fake_gateway.PASSWORD).isConnected())
+        self.assertEqual(self.server.logins, 1)
+        self.assertFalse(self.login('wrong').isConnected())
+        self.assertEqual(self.server.logins, 2)
+
+    def test_check_credentials(self):
+        """Checking the credentials always logs into the server."""
+        self.login(fake_gateway.PASSWORD)
+        retval, output = run_connector(
+            '-u', self.user, '-w', fake_gateway.PASSWORD, 'checkCredentials')
+        self.assertTrue(retval)
+        self.assertEqual(self.server.logins, 2)
+        self.assertFalse(run_connector(
+            '-u', self.user, '-w', 'wrong', 'checkCredentials')[0])
+
+    def test_expiry(self):
+        """Sessions expire a fixed time after their creation."""
+        self.sessions.put(self.user, 'pw', 'key')
+        self.assertEqual(self.sessions.get(self.user, 'pw'), 'key')
+        self.assertIsNone(self.sessions.get(self.user, 'wrong'))
+        self.sessions.ttl = -1
+        self.assertIsNone(self.sessions.get(self.user, 'pw'))
+        self.sessions.ttl = ome_sessions.SESSION_TTL
+        self.assertIsNone(self.sessions.get(self.user, 'pw'))
+
+    def test_private_dir(self):
+        """Session keys are never stored in a directory others can read."""
+        shared = os.path.join(self.tmpdir, 'shared')
+        os.mkdir(shared)
+        os.chmod(shared, 0755)
+        self.assertRaises(OSError, ome_sessions.SessionCache, shared,
+                          OME_HRM.HOST, OME_HRM.PORT)
+
+
+class SearchTest(ConnectorTest):
+
+    """Searching the index of a user."""
+
+    def setUp(self):
+        ConnectorTest.setUp(self)
+        self.user = self.server.users[0].omeName.val
+        for fname in os.listdir(WORKDIR):
+            if fname.startswith('search'):
+                os.unlink(os.path.join(WORKDIR, fname))
+
+    def search(self, passwd, *args):
+        """Search for images of the user."""
+        return run_connector('-u', self.user, '-w', passwd, 'search',
+                             '-q', 'image_0001', *args)
+
+    def test_search(self):
+        """The first search builds the index, the results are nodes."""
+        retval, output = self.search(fake_gateway.PASSWORD)
+        self.assertTrue(retval)
+        nodes = json.loads(output)
+        self.assertTrue(nodes)
+        for node in nodes:
+            self.assertEqual(node['label'], 'image_0001.tif')
+            self.assertEqual(node['class'], 'Image')
+
+    def test_wrong_password(self):
+        """Without the right password, neither OMERO nor the index answer."""
+        retval, output = self.search('wrong')
+        self.assertFalse(retval)
+        self.assertTrue(output.startswith('ERROR'))
+        self.assertTrue(self.search(fake_gateway.PASSWORD)[0])
+        # the index exists now, but not for this password:
+        retval, output = self.search('wrong')
+        self.assertFalse(retval)
+        self.assertTrue(output.startswith('ERROR'))
+        retval, output = self.search('wrong', '--refresh')
+        self.assertFalse(retval)
+        self.assertTrue(output.startswith('ERROR'))
+
+
+if __name__ == "__main__":
+    try:
+        unittest.main()
+    finally:
+        shutil.rmtree(WORKDIR)
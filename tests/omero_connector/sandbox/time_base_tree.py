@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+"""Compare the timing of the bulk query and the per-group base tree.
+
+Needs a live OMERO server configured in cred.py and the HRM config file
+(/etc/hrm.conf) to be present, run it from this directory like this:
+
+$ python time_base_tree.py [repetitions]
+"""
+
+import sys
+import time
+
+sys.path.insert(0, '../../../bin')
+
+import ome_hrm
+from cred import HOST, USER, PASSWORD
+
+ome_hrm.load_settings()
+
+
+def timed(func, conn, reps):
+    """Run func(conn) `reps` times, return the last result and the times."""
+    times = []
+    for _ in range(reps):
+        start = time.time()
+        result = func(conn)
+        times.append(time.time() - start)
+    return (result, times)
+
+
+def by_id(tree):
+    """Make a base tree comparable regardless of the order of the groups."""
+    return sorted(tree, key=lambda group: group['id'])
+
+
+REPS = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+CONN = ome_hrm.omero_login(USER, PASSWORD, HOST, 4064)
+print "User %s is a member of %s group(s)." % (
+    USER, len(CONN.getEventContext().memberOfGroups))
+
+TREE_OLD, TIMES_OLD = timed(ome_hrm.gen_base_tree_per_group, CONN, REPS)
+TREE_NEW, TIMES_NEW = timed(ome_hrm.gen_base_tree, CONN, REPS)
+
+for (label, times) in [('per group', TIMES_OLD), ('bulk query', TIMES_NEW)]:
+    print "%-12s min %.3fs  avg %.3fs  max %.3fs" % (
+        label, min(times), sum(times) / len(times), max(times))
+print "speedup (avg): %.1fx" % (sum(TIMES_OLD) / sum(TIMES_NEW))
+
+if ome_hrm.tree_to_json(by_id(TREE_OLD)) != ome_hrm.tree_to_json(by_id(TREE_NEW)):
+    print "WARNING: the trees generated by the two methods differ!"
+    sys.exit(1)
+print "Both methods generated identical trees."
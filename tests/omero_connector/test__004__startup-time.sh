@@ -0,0 +1,31 @@
+#!/bin/bash
+#
+# Check that a cold start of the connector stays within a time budget, as the
+# HRM executes it for every single request. The budget (in milliseconds) can
+# be adjusted using the STARTUP_BUDGET_MS environment variable.
+
+set -e
+
+source global_variables.sh
+
+BUDGET_MS=${STARTUP_BUDGET_MS:-150}
+RUNS=5
+
+# use the fastest of a few runs to reduce the noise of a busy machine:
+BEST=""
+for RUN in $(seq $RUNS) ; do
+    START=$(date +%s%N)
+    $CONNECTOR_SCRIPT --help > /dev/null
+    END=$(date +%s%N)
+    ELAPSED=$(( (END - START) / 1000000 ))
+    if [ -z "$BEST" ] || [ $ELAPSED -lt $BEST ] ; then
+        BEST=$ELAPSED
+    fi
+done
+
+echo "Fastest connector startup: $BEST ms (budget: $BUDGET_MS ms)"
+if [ $BEST -gt $BUDGET_MS ] ; then
+    echo "ERROR: connector startup exceeds the budget of $BUDGET_MS ms!" >&2
+    $CONNECTOR_SCRIPT --profile-startup --help > /dev/null
+    exit 1
+fi
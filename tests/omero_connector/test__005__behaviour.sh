@@ -0,0 +1,9 @@
+#!/bin/bash
+#
+# Check the behaviour of the connector (OME-TIFF export, caches, transfer
+# queue, sessions and search) against the fake OMERO server, so this doesn't
+# require an OMERO server either.
+
+set -e
+
+python benchmark/test_connector.py